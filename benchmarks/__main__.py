@@ -0,0 +1,38 @@
+"""
+Run the benchmark suites with their default arguments, offline on loopback, and report all their results together.
+
+Usage (from the repository root):
+    python -m benchmarks [--suites parse,ingest,aggregations,capture_memory,listener_throughput] [--json PATH]
+
+Run a single suite as its own module (e.g. python -m benchmarks.ingest --help) to change its arguments.
+"""
+
+from __future__ import annotations
+
+import argparse
+from importlib import import_module
+from typing import List, Optional
+
+from benchmarks.common import Result, report
+
+SUITES = ("parse", "ingest", "aggregations", "capture_memory", "listener_throughput")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", default=",".join(SUITES))
+    parser.add_argument("--json", help="write the results as JSON to this path, or - for stdout")
+    args = parser.parse_args(argv)
+    results: List[Result] = []
+    for name in args.suites.split(","):
+        if name not in SUITES:
+            parser.error(f"unknown suite {name!r}, expected one of {', '.join(SUITES)}")
+        suite = import_module(f"benchmarks.{name}")
+        suite_parser = argparse.ArgumentParser()
+        suite.add_arguments(suite_parser)
+        results.extend(suite.run(suite_parser.parse_args([])))
+    report(results, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measure the aggregations and tag filters of a large capture, which are queried repeatedly in soak tests.
+
+Usage (from the repository root):
+    python -m benchmarks.aggregations [--metrics N] [--json PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+from typing import List, Optional
+
+from benchmarks.common import Result, best_time, report
+from yellowbox_statsd.metrics import (
+    CapturedMetric,
+    CountCapturedMetric,
+    GaugeCapturedMetric,
+    HistogramCapturedMetric,
+    MetricTags,
+)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--metrics", type=int, default=1_000_000)
+    parser.add_argument("--number", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+
+
+def run(args: argparse.Namespace) -> List[Result]:
+    tag_sets = [MetricTags.interned([f"route:/r{i % 100}", f"status:{200 + i % 3}", "env:bench"]) for i in range(300)]
+    metrics = [
+        CapturedMetric([str(i % 1000)], 0.5 if i % 2 else None, tag_sets[i % len(tag_sets)], None, None)
+        for i in range(args.metrics)
+    ]
+    gauges = [CapturedMetric([f"+{i % 10}" if i % 3 else str(i)], None, None, None, None) for i in range(args.metrics)]
+    count = CountCapturedMetric(metrics)
+    histogram = HistogramCapturedMetric(metrics)
+    gauge = GaugeCapturedMetric(gauges)
+    del metrics, gauges
+    queries = {
+        "count.total": count.total,
+        "histogram.avg": histogram.avg,
+        "histogram.max": histogram.max,
+        "histogram.p99": lambda: histogram.percentile(99),
+        "gauge.last": gauge.last,
+        "gauge.max": gauge.max,
+        "filter": lambda: count.filter(route="/r7", status="200"),
+        "filter_not": lambda: count.filter_not(env="bench"),
+        "split": lambda: count.split("route"),
+        "tag_values": lambda: count.tag_values("route"),
+    }
+    return [
+        {
+            "suite": "aggregations",
+            "case": name,
+            "metrics": args.metrics,
+            "ms": best_time(query, args.number, args.repeat) * 1000,
+        }
+        for name, query in queries.items()
+    ]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--json", help="write the results as JSON to this path, or - for stdout")
+    args = parser.parse_args(argv)
+    report(run(args), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Measure the memory held by a large capture, with interned tags versus a tags object per metric line, and of an
+aggregate capture.
+
+Usage (from the repository root):
+    python -m benchmarks.capture_memory [--metrics N] [--tag-sets N] [--json PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+import tracemalloc
+from typing import List, Optional
+
+from benchmarks.common import Result, report
+from yellowbox_statsd.aggregates import AggregatedMetricsCollection
+from yellowbox_statsd.metrics import CapturedMetricsCollection, Metric, MetricTags
+
+
+def build_capture(metrics: int, tag_sets: int, interned: bool, aggregate: bool = False) -> int:
+    """
+    Returns the number of bytes allocated by the capture.
+    """
+    lines = [f"app.requests:1|c|#route:/r{i},status:200,env:bench".encode() for i in range(tag_sets)]
+    tracemalloc.start()
+    capture = AggregatedMetricsCollection() if aggregate else CapturedMetricsCollection()
+    for i in range(metrics):
+        metric = Metric.parse_datagram(lines[i % tag_sets])[0]
+        if not interned:
+            # emulate a new tags object with an eagerly built index for every line
+            metric.tags = MetricTags(metric.tags)
+            metric.tags.assigned  # noqa: B018
+        capture.append(metric)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--metrics", type=int, default=1_000_000)
+    parser.add_argument("--tag-sets", type=int, default=100)
+
+
+def run(args: argparse.Namespace) -> List[Result]:
+    results = []
+    for mode, interned, aggregate in (("per-line", False, False), ("interned", True, False), ("aggregate", True, True)):
+        allocated = build_capture(args.metrics, args.tag_sets, interned, aggregate)
+        results.append(
+            {
+                "suite": "capture_memory",
+                "case": mode,
+                "mib": allocated / 2**20,
+                "bytes_per_metric": allocated / args.metrics,
+            }
+        )
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--json", help="write the results as JSON to this path, or - for stdout")
+    args = parser.parse_args(argv)
+    report(run(args), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Helpers shared by the benchmarks, to time them and report their results.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from timeit import repeat
+from typing import Any, Callable, Dict, List, Optional
+
+Result = Dict[str, Any]
+
+
+def best_time(func: Callable[[], Any], number: int, repeats: int) -> float:
+    """
+    The fastest time of a single call to func, in seconds. The minimum of the repeats is the least affected by noise
+    from other processes.
+    """
+    return min(repeat(func, number=number, repeat=repeats)) / number
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit: Optional[str] = subprocess.run(
+            ["git", "rev-parse", "HEAD"],  # noqa: S607
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def format_result(result: Result) -> str:
+    fields = " ".join(
+        f"{k}={v:,.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items() if k not in ("suite", "case")
+    )
+    return f"{result['suite']:<20} {result['case']:<30} {fields}"
+
+
+def report(results: List[Result], json_path: Optional[str] = None) -> None:
+    """
+    Print the results, and if json_path is set, write them along with the environment as a JSON document (to stdout if
+    json_path is "-").
+    """
+    document = {"environment": environment(), "results": results}
+    if json_path == "-":
+        json.dump(document, sys.stdout, indent=2)
+        print()  # noqa: T201
+        return
+    for result in results:
+        print(format_result(result))  # noqa: T201
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(document, f, indent=2)
@@ -0,0 +1,68 @@
+"""
+Measure the rate of ingesting parsed metrics into a capture, at various tag cardinalities.
+
+Usage (from the repository root):
+    python -m benchmarks.ingest [--metrics N] [--cardinalities 1,100,10000] [--json PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+from math import ceil
+from time import perf_counter
+from typing import List, Optional
+
+from benchmarks.common import Result, report
+from yellowbox_statsd.aggregates import AggregatedMetricsCollection
+from yellowbox_statsd.metrics import CapturedMetricsCollection, Metric
+
+COLLECTIONS = {"raw": CapturedMetricsCollection, "aggregate": AggregatedMetricsCollection}
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--metrics", type=int, default=200_000)
+    parser.add_argument("--cardinalities", default="1,100,10000")
+    parser.add_argument("--batch-size", type=int, default=64)
+
+
+def run(args: argparse.Namespace) -> List[Result]:
+    results = []
+    for cardinality in (int(c) for c in args.cardinalities.split(",")):
+        # the routes of consecutive batches continue each other, so that the capture reaches the full cardinality
+        batches = [
+            Metric.parse_datagram(
+                b"\n".join(
+                    f"app.{kind}:{i % 100}|{kind[0]}|#route:/r{route % cardinality},env:bench".encode()
+                    for i, route in enumerate(range(b * args.batch_size, (b + 1) * args.batch_size))
+                    for kind in ("count", "histogram", "gauge")
+                )
+            )
+            for b in range(ceil(cardinality / args.batch_size))
+        ]
+        batch_count = max(args.metrics // len(batches[0]), 1)
+        for mode, collection_cls in COLLECTIONS.items():
+            collection = collection_cls()
+            start = perf_counter()
+            for b in range(batch_count):
+                collection.extend(batches[b % len(batches)])
+            elapsed = perf_counter() - start
+            results.append(
+                {
+                    "suite": "ingest",
+                    "case": f"{mode}-cardinality-{cardinality}",
+                    "metrics_per_sec": batch_count * len(batches[0]) / elapsed,
+                }
+            )
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--json", help="write the results as JSON to this path, or - for stdout")
+    args = parser.parse_args(argv)
+    report(run(args), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Measure the datagrams/sec a StatsdService can ingest from a burst of local senders.
+
+Usage (from the repository root):
+    python -m benchmarks.listener_throughput [--datagrams N] [--senders N] [--batch-sizes 1,64] [--workers 1,4]
+        [--parse-processes N] [--receive-buffer-size BYTES] [--transports udp,uds] [--json PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+from contextlib import suppress
+from multiprocessing import Barrier, Process, synchronize
+from socket import AF_INET, AF_UNIX, SOCK_DGRAM, socket
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from typing import List, Optional, Tuple, Union
+
+from benchmarks.common import Result, report
+from yellowbox_statsd import StatsdService
+
+# how often the capture is polled while the listener is receiving, and for how long it has to be idle to be done
+POLL_SECONDS = 0.001
+IDLE_SECONDS = 0.05
+
+DATAGRAM = b"app.requests:1|c|#route:/x,status:200,env:bench\napp.latency:12.5|ms|@0.5|#route:/x,env:bench"
+
+
+def send_burst(address: Union[str, Tuple[str, int]], count: int, ready: synchronize.Barrier) -> None:
+    # a unix socket sender blocks while the listener's queue is full, rather than having its datagrams dropped
+    sock = socket(AF_UNIX if isinstance(address, str) else AF_INET, SOCK_DGRAM)
+    sock.connect(address)
+    # all the senders start sending together, once they were spawned
+    ready.wait()
+    for _ in range(count):
+        with suppress(OSError):
+            sock.send(DATAGRAM)
+    sock.close()
+
+
+def run_once(  # noqa: PLR0913
+    batch_size: int,
+    datagrams: int,
+    senders: int,
+    workers: int = 1,
+    parse_processes: int = 0,
+    *,
+    receive_buffer_size: Optional[int] = None,
+    socket_path: Optional[str] = None,
+) -> Result:
+    service = StatsdService(
+        batch_size=batch_size,
+        workers=workers,
+        parse_processes=parse_processes,
+        receive_buffer_size=receive_buffer_size,
+        socket_path=socket_path,
+    )
+    with service.start() as statsd, statsd.capture() as capture:
+        per_sender = datagrams // senders
+        address = ("127.0.0.1", statsd.port) if socket_path is None else socket_path
+        ready = Barrier(senders + 1)
+        procs = [Process(target=send_burst, args=(address, per_sender, ready)) for _ in range(senders)]
+        for proc in procs:
+            proc.start()
+        ready.wait()
+        start = last_received = perf_counter()
+        # the listener is done once the senders are done and no datagram was received for IDLE_SECONDS, the time it
+        # took is up to the last datagram it received
+        received = 0
+        while any(proc.is_alive() for proc in procs) or perf_counter() - last_received < IDLE_SECONDS:
+            sleep(POLL_SECONDS)
+            count = len(capture.get(("app.requests", "c"), ()))
+            if count != received:
+                received = count
+                last_received = perf_counter()
+        elapsed = last_received - start
+        for proc in procs:
+            proc.join()
+    sent = per_sender * senders
+    stats = statsd.stats()
+    transport = "udp" if socket_path is None else "uds"
+    return {
+        "suite": "listener_throughput",
+        "case": f"{transport}-workers-{workers}-batch-{batch_size}",
+        "transport": transport,
+        "batch_size": batch_size,
+        "workers": workers,
+        "parse_processes": parse_processes,
+        "sent": sent,
+        "received": received,
+        "loss_rate": 1 - received / sent,
+        "datagrams_per_sec": received / elapsed,
+        "kernel_drops": stats.kernel_drops,
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--datagrams", type=int, default=200_000)
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--batch-sizes", default="1,64")
+    parser.add_argument("--workers", default="1")
+    parser.add_argument("--parse-processes", type=int, default=0)
+    parser.add_argument("--receive-buffer-size", type=int, default=None)
+    parser.add_argument("--transports", default="udp", help="udp, uds (a unix datagram socket), or both")
+
+
+def run(args: argparse.Namespace) -> List[Result]:
+    ret: List[Result] = []
+    with TemporaryDirectory() as tmp_dir:
+        for transport in args.transports.split(","):
+            if transport not in ("udp", "uds"):
+                raise ValueError(f"unknown transport {transport!r}")
+            for workers in (int(w) for w in args.workers.split(",")):
+                # a unix socket can't be shared between listeners
+                if transport == "uds" and workers > 1:
+                    continue
+                ret.extend(
+                    run_once(
+                        batch_size,
+                        args.datagrams,
+                        args.senders,
+                        workers,
+                        args.parse_processes,
+                        receive_buffer_size=args.receive_buffer_size,
+                        socket_path=f"{tmp_dir}/statsd.sock" if transport == "uds" else None,
+                    )
+                    for batch_size in (int(b) for b in args.batch_sizes.split(","))
+                )
+    return ret
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--json", help="write the results as JSON to this path, or - for stdout")
+    args = parser.parse_args(argv)
+    report(run(args), args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Compare the regex metric parser with the bytes-level parser on realistic DogStatsD lines.
+
+Usage (from the repository root):
+    python -m benchmarks.parse [--number N] [--json PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+from typing import List, Optional
+
+from benchmarks.common import Result, best_time, report
+from yellowbox_statsd.metrics import Metric, MetricParseCache
+
+LINES = [
+    b"app.requests:1|c|#route:/x,status:200,env:bench",
+    b"app.latency:12.5|ms|@0.5|#route:/x,env:bench",
+    b"app.queue.depth:+3|g|#queue:ingest",
+    b"app.payload.size:512:1024:2048|d|#route:/upload,env:bench|c:83bf8a51|T1700000000",
+    b"app.users:42|s",
+]
+DATAGRAM = b"\n".join(LINES)
+
+
+def regex_parse_datagram(data: bytes) -> List[Metric]:
+    return [Metric.parse(line) for line in str(data, "utf-8").strip().splitlines()]
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--number", type=int, default=2_000)
+    parser.add_argument("--repeat", type=int, default=20)
+
+
+def run(args: argparse.Namespace) -> List[Result]:
+    parsers = {
+        "regex": regex_parse_datagram,
+        "bytes": Metric.parse_datagram,
+        # the same datagram is parsed repeatedly, so this measures cache hits
+        "cached": MetricParseCache().parse_datagram,
+    }
+    results = []
+    for parser_name, parse in parsers.items():
+        elapsed = best_time(lambda: parse(DATAGRAM), args.number, args.repeat)  # noqa: B023
+        results.append({"suite": "parse", "case": parser_name, "lines_per_sec": len(LINES) / elapsed})
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--json", help="write the results as JSON to this path, or - for stdout")
+    args = parser.parse_args(argv)
+    report(run(args), args.json)
+
+
+if __name__ == "__main__":
+    main()
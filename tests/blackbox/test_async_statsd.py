@@ -0,0 +1,112 @@
+from asyncio import gather, get_running_loop
+from unittest.mock import AsyncMock, MagicMock
+
+from aiodogstatsd import Client
+
+from yellowbox_statsd import AsyncStatsdService
+from yellowbox_statsd.dispatch import LoopCallbackDispatcher
+from yellowbox_statsd.metrics import Metric, MetricTags
+
+
+async def test_startup():
+    async with AsyncStatsdService() as statsd:
+        assert statsd.is_alive()
+        assert statsd.port != 0
+    assert not statsd.is_alive()
+
+
+async def test_send_metrics():
+    async with AsyncStatsdService() as statsd, statsd.capture() as capture:
+        client = Client(host="127.0.0.1", port=statsd.port, namespace="testns", constant_tags={"tag1": "a"})
+        await client.connect()
+        client.increment("test.counter")
+        client.increment("test.counter", value=3, tags={"tag2": "b"})
+        client.gauge("test.gauge", value=12)
+        await client.close()
+        await capture.async_wait_for_metrics(3, timeout=1)
+    assert capture.count("testns.test.counter").total() == 4
+    assert capture.count("testns.test.counter").filter(tag2="b").total() == 3
+    assert capture.gauge("testns.test.gauge").last() == 12
+
+
+async def test_callbacks():
+    dgram_cb = MagicMock()
+    metric_cb = AsyncMock()
+    async with AsyncStatsdService() as statsd, statsd.capture() as capture:
+        statsd.add_datagram_callback(dgram_cb)
+        statsd.add_metric_callback(metric_cb)
+        client = Client(host="127.0.0.1", port=statsd.port, namespace="testns")
+        await client.connect()
+        client.increment("test.counter", tags={"tag1": "a"})
+        await client.close()
+        # callbacks are called (or scheduled) along with capturing the metrics, scheduled callbacks are awaited when
+        # the service stops
+        await capture.async_wait_for_metrics(1, timeout=1)
+    dgram_cb.assert_called_once_with(b"testns.test.counter:1|c|#tag1:a")
+    metric_cb.assert_awaited_once_with(
+        Metric("testns.test.counter", ["1"], "c", None, MetricTags(["tag1:a"]), None, None)
+    )
+
+
+async def test_async_callback_error(capsys):
+    async def cb(metric):
+        raise ValueError("oops")
+
+    async with AsyncStatsdService() as statsd, statsd.capture() as capture:
+        statsd.add_metric_callback(cb)
+        client = Client(host="127.0.0.1", port=statsd.port)
+        await client.connect()
+        client.increment("test.counter")
+        await client.close()
+        await capture.async_wait_for_metrics(1, timeout=1)
+    assert "unexpected error when calling message callback" in capsys.readouterr().out
+
+
+async def test_sync_callback_error(capsys):
+    def cb(metric):
+        raise ValueError("oops")
+
+    async with AsyncStatsdService() as statsd, statsd.capture() as capture:
+        statsd.add_metric_callback(cb)
+        client = Client(host="127.0.0.1", port=statsd.port)
+        await client.connect()
+        client.increment("test.counter")
+        await client.close()
+        await capture.async_wait_for_metrics(1, timeout=1)
+    assert "unexpected error when calling message callback" in capsys.readouterr().out
+    assert statsd.stats().callback_errors == 1
+
+
+async def test_loop_dispatcher():
+    metric_cb = AsyncMock()
+    batch_cb = MagicMock()
+    dispatcher = LoopCallbackDispatcher(get_running_loop())
+    async with AsyncStatsdService(callback_dispatcher=dispatcher) as statsd, statsd.capture() as capture:
+        statsd.add_metric_callback(metric_cb)
+        statsd.add_metric_batch_callback(batch_cb)
+        client = Client(host="127.0.0.1", port=statsd.port)
+        await client.connect()
+        client.increment("test.counter")
+        await client.close()
+        await capture.async_wait_for_metrics(1, timeout=1)
+    metric = Metric("test.counter", ["1"], "c", None, None, None, None)
+    metric_cb.assert_awaited_once_with(metric)
+    batch_cb.assert_called_once_with([metric])
+
+
+async def test_routed_captures_across_tasks():
+    async def run_test(statsd, test_id):
+        async with statsd.capture(tag=f"test_id:{test_id}") as capture:
+            assert statsd.current_capture() is capture
+            client = Client(host="127.0.0.1", port=statsd.port)
+            await client.connect()
+            client.increment("a", value=test_id, tags={"test_id": str(test_id)})
+            await client.close()
+            await capture.async_wait_for_count("a", test_id, timeout=1)
+            return capture
+
+    async with AsyncStatsdService() as statsd, statsd.capture(name_prefix="a") as everything:
+        captures = await gather(*(run_test(statsd, i) for i in range(1, 4)))
+        assert statsd.current_capture() is everything
+    assert [capture.count("a").total() for capture in captures] == [1, 2, 3]
+    assert everything.count("a").total() == 6
@@ -1,13 +1,20 @@
-from asyncio import DatagramProtocol, get_running_loop, sleep as asleep
-from time import sleep
+from asyncio import DatagramProtocol, get_running_loop
+from pathlib import Path
+from socket import AF_INET, AF_UNIX, SO_SNDBUF, SOCK_DGRAM, SOL_SOCKET, socket
+from threading import Event, Thread
+from time import perf_counter, sleep
 from unittest.mock import MagicMock
 
 from aiodogstatsd import Client
 from datadog.dogstatsd import DogStatsd
+from pytest import mark, raises, warns
 from yellowbox.containers import create_and_pull, removing
 
 from yellowbox_statsd import StatsdService
+from yellowbox_statsd.dispatch import ThreadCallbackDispatcher
 from yellowbox_statsd.metrics import Metric, MetricTags
+from yellowbox_statsd.recording import DatagramRecorder, replay_recording
+from yellowbox_statsd.statsd import DATAGRAM_OVERHEAD, MAX_DATAGRAM_SIZE, SUPPORTS_AUTO_BUFFER_SIZE
 
 
 def test_startup():
@@ -15,19 +22,172 @@ def test_startup():
         assert statsd.is_alive()
 
 
+def test_stop_immediately():
+    statsd = StatsdService().start()
+    start = perf_counter()
+    statsd.stop()
+    assert perf_counter() - start < 0.05
+    assert not statsd.listening_thread.is_alive()
+
+
+def test_polling_time_deprecated():
+    with warns(DeprecationWarning, match="polling_time"):
+        StatsdService(polling_time=0.1)
+
+
 def test_send_metrics():
     with StatsdService().start() as statsd:
         with statsd.capture() as capture:
             dogstatsd = DogStatsd(host="localhost", port=statsd.port, namespace="testns")
             dogstatsd.increment("test.counter", tags=["tag1:a", "tag2"])
             dogstatsd.increment("test.counter", value=3, tags=["tag1:a", "tag3"])
-            sleep(0.1)
+            capture.wait_for_count("testns.test.counter", 4, timeout=1)
         assert capture.count("testns.test.counter").filter(tag1="a").total() == 4
         assert capture.count("testns.test.counter").filter_not("tag2").total() == 3
         assert capture.count("testns.test.counter").filter_not(tag1="a").total() == 0
         assert set(capture.count("testns.test.counter").tags()) == {"tag1:a", "tag2", "tag3"}
 
 
+def test_send_metrics_aggregate():
+    with StatsdService().start() as statsd:
+        with statsd.capture(mode="aggregate") as capture:
+            dogstatsd = DogStatsd(host="localhost", port=statsd.port, namespace="testns")
+            dogstatsd.increment("test.counter", tags=["tag1:a", "tag2"])
+            dogstatsd.increment("test.counter", value=3, tags=["tag1:a", "tag3"])
+            dogstatsd.gauge("test.gauge", 5, tags=["tag1:a"])
+            dogstatsd.timing("test.timing", 10)
+            dogstatsd.timing("test.timing", 20)
+            capture.wait_for_metrics(5, timeout=1)
+        assert capture.count("testns.test.counter").filter(tag1="a").total() == 4
+        assert capture.count("testns.test.counter").filter_not("tag2").total() == 3
+        assert set(capture.count("testns.test.counter").tags()) == {"tag1:a", "tag2", "tag3"}
+        assert capture.gauge("testns.test.gauge").last() == 5
+        assert capture.timing("testns.test.timing").avg() == 15
+
+
+def test_capture_unknown_mode():
+    statsd = StatsdService()
+    with raises(ValueError, match="capture mode"), statsd.capture(mode="bla"):  # type: ignore[call-overload]
+        pass
+
+
+def test_stats():
+    def bad_callback(metric):
+        raise ValueError(metric)
+
+    with StatsdService(buffer_size=64).start() as statsd:
+        statsd.add_metric_callback(bad_callback)
+        with statsd.capture() as capture:
+            sender = socket(AF_INET, SOCK_DGRAM)
+            sender.sendto(b"a:1|c\nb:2|c", ("localhost", statsd.port))
+            sender.sendto(b"a:" + b"1" * 100 + b"|c", ("localhost", statsd.port))
+            sender.sendto(b"not a metric", ("localhost", statsd.port))
+            sender.sendto(b"a:1|c", ("localhost", statsd.port))
+            capture.wait_for_count("a", 2, timeout=1)
+    # the service is stopped, so that the callbacks of the last batch are done
+    stats = statsd.stats()
+    assert stats.datagrams == 4
+    assert stats.bytes == 11 + 64 + 12 + 5
+    assert stats.lines == 3
+    assert stats.parse_failures == 2
+    assert stats.truncated_datagrams == 1
+    assert stats.kernel_drops == 0
+    assert stats.callback_errors == 3
+    exported = stats.as_dict()
+    assert {"recv", "parse", "capture", "callback:test_stats.<locals>.bad_callback"} <= exported["latencies"].keys()
+    assert exported["latencies"]["callback:test_stats.<locals>.bad_callback"]["count"] == 3
+    assert exported["parse_failures"] == 2
+
+
+RMEM_MAX_PATH = "/proc/sys/net/core/rmem_max"
+
+
+def test_receive_buffer_size():
+    with StatsdService(receive_buffer_size=65536).start() as statsd:
+        assert statsd.receive_buffer_size_granted >= 65536
+    with warns(RuntimeWarning, match="rmem_max"), StatsdService(receive_buffer_size=2**31 - 1).start() as statsd:
+        assert statsd.receive_buffer_size_granted < 2**31 - 1
+
+
+@mark.skipif(not Path(RMEM_MAX_PATH).exists(), reason="net.core.rmem_max is only available on linux")
+def test_receive_buffer_size_doubled():
+    rmem_max = int(Path(RMEM_MAX_PATH).read_text())
+    # the kernel doubles the capped size, which is still larger than the requested size
+    with warns(RuntimeWarning, match="rmem_max"), StatsdService(
+        receive_buffer_size=rmem_max * 3 // 2
+    ).start() as statsd:
+        assert statsd.receive_buffer_size_granted == 2 * rmem_max
+
+
+@mark.skipif(not SUPPORTS_AUTO_BUFFER_SIZE, reason="auto buffer size is only supported on linux")
+def test_auto_buffer_size():
+    with StatsdService(buffer_size=64, auto_buffer_size=True).start() as statsd:
+        with statsd.capture() as capture:
+            sender = socket(AF_INET, SOCK_DGRAM)
+            sender.sendto(b"a:1|c|#t:" + b"x" * 1000, ("localhost", statsd.port))
+            sender.sendto(b"a:2|c", ("localhost", statsd.port))
+            capture.wait_for_count("a", 3, timeout=1)
+        assert capture.count("a").tag_values("t") == ["x" * 1000]
+        assert statsd.buffer_size == 1024
+    assert statsd.stats().truncated_datagrams == 0
+
+
+def test_for_rate():
+    statsd = StatsdService.for_rate(100_000, batch_size=128)
+    assert statsd.receive_buffer_size == 100_000 * 0.5 * (1432 + DATAGRAM_OVERHEAD)
+    assert statsd.batch_size == 128
+    assert statsd.buffer_size == 1432
+    assert statsd.auto_buffer_size == SUPPORTS_AUTO_BUFFER_SIZE
+    assert StatsdService.for_rate(10).batch_size == 64
+
+
+def test_send_metrics_burst():
+    with StatsdService(batch_size=8).start() as statsd:
+        with statsd.capture() as capture:
+            dogstatsd = DogStatsd(host="localhost", port=statsd.port, namespace="testns")
+            for i in range(100):
+                dogstatsd.increment("test.counter", value=i)
+            capture.wait_for_count("testns.test.counter", sum(range(100)), timeout=1)
+        assert capture.count("testns.test.counter").total() == sum(range(100))
+
+
+@mark.parametrize(("workers", "parse_processes"), [(3, 0), (1, 2), (2, 1)])
+def test_send_metrics_sharded(workers, parse_processes):
+    with StatsdService(workers=workers, parse_processes=parse_processes).start() as statsd:
+        assert len({sock.getsockname() for sock in statsd.socks}) == 1
+        with statsd.capture() as capture:
+            for i in range(20):
+                dogstatsd = DogStatsd(host="localhost", port=statsd.port, namespace="testns")
+                dogstatsd.increment("test.counter", value=i, tags=[f"client:{i}"])
+            capture.wait_for_count("testns.test.counter", sum(range(20)), timeout=5)
+        assert set(capture.count("testns.test.counter").tag_values("client")) == {str(i) for i in range(20)}
+    assert not any(thread.is_alive() for thread in statsd.listening_threads)
+
+
+def test_parse_processes_interned_tags():
+    with StatsdService(parse_processes=2).start() as statsd:
+        sender = socket(AF_INET, SOCK_DGRAM)
+        with statsd.capture() as capture:
+            # every datagram is parsed in a separate batch
+            for i in range(1, 11):
+                sender.sendto(b"a:1|c|#x:1,y:2", ("localhost", statsd.port))
+                capture.wait_for_metrics(i, timeout=5)
+    # tags parsed in the worker processes are interned when they are unpickled
+    assert len({id(metric.tags) for metric in capture.count("a")}) == 1
+
+
+def test_send_metrics_parse_cache():
+    with StatsdService(parse_cache_size=16).start() as statsd:
+        with statsd.capture() as capture:
+            dogstatsd = DogStatsd(host="localhost", port=statsd.port, namespace="testns")
+            for _ in range(10):
+                dogstatsd.increment("test.counter", tags=["tag1:a"])
+            capture.wait_for_count("testns.test.counter", 10, timeout=1)
+        assert capture.count("testns.test.counter").filter(tag1="a").total() == 10
+        assert statsd.parse_cache.misses == 1
+        assert statsd.parse_cache.hits == 9
+
+
 def test_send_metrics_many_clients():
     with StatsdService().start() as statsd:
         with statsd.capture() as capture:
@@ -39,7 +199,7 @@ def test_send_metrics_many_clients():
             dogstatsd.increment("test.counter", tags=["tag1:a", "tag4"])
             dogstatsd.increment("test.counter", value=3, tags=["tag1:b"])
 
-            sleep(0.1)
+            capture.wait_for_count("testns.test.counter", 8, timeout=1)
         assert capture.count("testns.test.counter").filter(tag1="a").total() == 5
 
     split = capture.count("testns.test.counter").split("tag1")
@@ -59,7 +219,7 @@ def test_repeat_split_metrics():
             dogstatsd.increment("test.counter", value=3, tags=["tag1:b"])
             dogstatsd.increment("test.counter", value=3)
 
-            sleep(0.1)
+            capture.wait_for_count("testns.test.counter", 11, timeout=1)
         assert capture.count("testns.test.counter").filter(tag1="a").total() == 5
 
     split = capture.count("testns.test.counter").split("tag1")
@@ -76,7 +236,7 @@ def test_multi_split_metrics():
         dogstatsd.increment("test.counter", value=10, tags=["tag1:b", "tag2:a"])
         dogstatsd.increment("test.counter", value=3, tags=["tag1:b"])
 
-        sleep(0.1)
+        capture.wait_for_count("testns.test.counter", 17, timeout=1)
 
     split = capture.count("testns.test.counter").split(("tag1", "tag2"))
     assert split.keys() == {("a", "a"), ("a", "b"), ("b", "a")}
@@ -92,7 +252,7 @@ def test_gauge():
             dogstatsd.gauge("test.counter", value=10, tags=["tag1:a", "tag2"])
             dogstatsd.gauge("test.counter", value=3, tags=["tag1:a", "tag3"])
             dogstatsd.gauge("test.counter", value=30, tags=["tag1:b", "tag3"])
-            sleep(0.1)
+            capture.wait_for_metrics(3, timeout=1)
         assert capture.gauge("testns.test.counter").filter(tag1="a").last() == 3
 
 
@@ -103,7 +263,7 @@ def test_histogram():
             dogstatsd.histogram("test.counter", value=10, tags=["tag1:a", "tag2"])
             dogstatsd.histogram("test.counter", value=3, tags=["tag1:a", "tag3"])
             dogstatsd.histogram("test.counter", value=30, tags=["tag1:b", "tag3"])
-            sleep(0.1)
+            capture.wait_for_metrics(3, timeout=1)
         assert capture.histogram("testns.test.counter").filter(tag1="a").avg() == 13 / 2
         assert capture.histogram("testns.test.counter").filter(tag1="a").max() == 10
         assert capture.histogram("testns.test.counter").filter(tag1="a").min() == 3
@@ -116,7 +276,7 @@ def test_timing():
             dogstatsd.timing("test.counter", value=10, tags=["tag1:a", "tag2"])
             dogstatsd.timing("test.counter", value=3, tags=["tag1:a", "tag3"])
             dogstatsd.timing("test.counter", value=30, tags=["tag1:b", "tag3"])
-            sleep(0.1)
+            capture.wait_for_metrics(3, timeout=1)
         assert capture.timing("testns.test.counter").filter(tag1="a").avg() == 13 / 2
         assert capture.timing("testns.test.counter").filter(tag1="a").max() == 10
         assert capture.timing("testns.test.counter").filter(tag1="a").min() == 3
@@ -129,7 +289,7 @@ def test_distribution():
             dogstatsd.distribution("test.counter", value=10, tags=["tag1:a", "tag2"])
             dogstatsd.distribution("test.counter", value=3, tags=["tag1:a", "tag3"])
             dogstatsd.distribution("test.counter", value=30, tags=["tag1:b", "tag3"])
-            sleep(0.1)
+            capture.wait_for_metrics(3, timeout=1)
         assert capture.distribution("testns.test.counter").filter(tag1="a").avg() == 13 / 2
         assert capture.distribution("testns.test.counter").filter(tag1="a").max() == 10
         assert capture.distribution("testns.test.counter").filter(tag1="a").min() == 3
@@ -142,7 +302,7 @@ def test_set():
             dogstatsd.set("test.counter", value=10, tags=["tag1:a", "tag2"])
             dogstatsd.set("test.counter", value=3, tags=["tag1:a", "tag3"])
             dogstatsd.set("test.counter", value=30, tags=["tag1:b", "tag3"])
-            sleep(0.1)
+            capture.wait_for_metrics(3, timeout=1)
         assert capture.set("testns.test.counter").filter(tag1="a").unique() == {10, 3}
 
 
@@ -156,7 +316,74 @@ def test_from_container(docker_client):
         container.start()
         with removing(container):
             container.wait()
-            sleep(0.1)
+            capture.wait_for_count("mymet", 1, timeout=1)
+    assert capture.count("mymet").total() == 1
+
+
+def test_unix_socket(tmp_path):
+    socket_path = str(tmp_path / "statsd.sock")
+    with StatsdService(socket_path=socket_path).start() as statsd:
+        assert statsd.auto_buffer_size == SUPPORTS_AUTO_BUFFER_SIZE
+        with statsd.capture() as capture:
+            dogstatsd = DogStatsd(socket_path=socket_path, namespace="testns")
+            dogstatsd.increment("test.counter", tags=["tag1:a"])
+            dogstatsd.flush()
+            capture.wait_for_count("testns.test.counter", 1, timeout=1)
+    assert capture.count("testns.test.counter").filter(tag1="a").total() == 1
+    # the socket is removed when the service stops
+    assert not (tmp_path / "statsd.sock").exists()
+
+
+@mark.skipif(not SUPPORTS_AUTO_BUFFER_SIZE, reason="auto_buffer_size is only supported on linux")
+def test_unix_socket_large_datagram(tmp_path):
+    socket_path = str(tmp_path / "statsd.sock")
+    # datagrams over unix sockets may be larger than the maximum size of a udp datagram
+    datagram = b"\n".join([b"a:1|c"] * 20_000)
+    assert len(datagram) > MAX_DATAGRAM_SIZE
+    with StatsdService(socket_path=socket_path).start() as statsd, statsd.capture() as capture:
+        sender = socket(AF_UNIX, SOCK_DGRAM)
+        sender.setsockopt(SOL_SOCKET, SO_SNDBUF, len(datagram) * 2)
+        sender.sendto(datagram, socket_path)
+        capture.wait_for_count("a", 20_000, timeout=1)
+    assert statsd.stats().truncated_datagrams == 0
+
+
+def test_unix_socket_stale(tmp_path):
+    socket_path = str(tmp_path / "statsd.sock")
+    stale = socket(AF_UNIX, SOCK_DGRAM)
+    stale.bind(socket_path)
+    stale.close()
+    with StatsdService(socket_path=socket_path).start() as statsd:
+        assert statsd.container_volumes() == {str(tmp_path): {"bind": "/var/run/datadog", "mode": "rw"}}
+        assert statsd.container_socket_path() == "/var/run/datadog/statsd.sock"
+
+
+def test_unix_socket_invalid(tmp_path):
+    with raises(ValueError):
+        StatsdService(socket_path=str(tmp_path / "statsd.sock"), workers=2)
+    with raises(ValueError):
+        StatsdService().container_volumes()
+
+
+def test_from_container_unix_socket(docker_client, tmp_path):
+    with StatsdService(socket_path=str(tmp_path / "statsd.sock")).start() as statsd, statsd.capture() as capture:
+        container = create_and_pull(
+            docker_client,
+            "python:3.12-slim",
+            [
+                "python",
+                "-c",
+                (
+                    "import socket; socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)"
+                    f".sendto(b'mymet:1|c', {statsd.container_socket_path()!r})"
+                ),
+            ],
+            volumes=statsd.container_volumes(),
+        )
+        container.start()
+        with removing(container):
+            container.wait()
+            capture.wait_for_count("mymet", 1, timeout=1)
     assert capture.count("mymet").total() == 1
 
 
@@ -202,6 +429,121 @@ def test_message_callback():
         assert cb.call_count == 1
 
 
+def test_batch_callbacks():
+    metric_batches = []
+    datagram_batches = []
+    with StatsdService().start() as statsd, statsd.capture() as capture:
+        statsd.add_metric_batch_callback(metric_batches.append)
+        statsd.add_datagram_batch_callback(datagram_batches.append)
+        sender = socket(AF_INET, SOCK_DGRAM)
+        sender.sendto(b"a:1|c\nb:2|c", ("localhost", statsd.port))
+        capture.wait_for_metrics(2, timeout=1)
+    assert [[m.name for m in batch] for batch in metric_batches] == [["a", "b"]]
+    assert datagram_batches == [[b"a:1|c\nb:2|c"]]
+
+
+def test_dispatched_callbacks():
+    entered = Event()
+    release = Event()
+    called = []
+
+    def slow_callback(metric):
+        entered.set()
+        release.wait()
+        called.append(metric.name)
+
+    dispatcher = ThreadCallbackDispatcher(max_queue_size=1, full_policy="drop_newest")
+    with StatsdService(callback_dispatcher=dispatcher).start() as statsd, statsd.capture() as capture:
+        statsd.add_metric_callback(slow_callback)
+        sender = socket(AF_INET, SOCK_DGRAM)
+        for name in ("a", "b", "c"):
+            sender.sendto(f"{name}:1|c".encode(), ("localhost", statsd.port))
+            # the listener is not stalled by the callback
+            capture.wait_for_count(name, 1, timeout=1)
+            assert entered.wait(1)
+        release.set()
+    # the first batch is being called, the second is queued, and the third is dropped
+    assert called == ["a", "b"]
+    stats = statsd.stats()
+    assert stats.callbacks_dropped == 1
+    assert stats.callback_queue_full == 1
+
+
+def test_overlapping_captures():
+    with StatsdService().start() as statsd:
+        sender = socket(AF_INET, SOCK_DGRAM)
+        outer = statsd.capture()
+        inner = statsd.capture(tag="test_id:1")
+        outer_capture = outer.__enter__()
+        inner_capture = inner.__enter__()
+        assert statsd.current_capture() is inner_capture
+        sender.sendto(b"a:1|c|#test_id:1\na:2|c|#test_id:2", ("localhost", statsd.port))
+        outer_capture.wait_for_metrics(2, timeout=1)
+        # captures don't need to be exited in the reverse order they were entered in
+        outer.__exit__(None, None, None)
+        assert statsd.current_capture() is inner_capture
+        sender.sendto(b"a:4|c|#test_id:1", ("localhost", statsd.port))
+        inner_capture.wait_for_count("a", 5, timeout=1)
+        inner.__exit__(None, None, None)
+        assert statsd.current_capture() is None
+    assert outer_capture.count("a").total() == 3
+    assert inner_capture.count("a").total() == 5
+
+
+def test_routed_captures_across_threads():
+    results = {}
+
+    def run_test(test_id):
+        with statsd.capture(tag=f"test_id:{test_id}") as capture:
+            sender = socket(AF_INET, SOCK_DGRAM)
+            for _ in range(10):
+                sender.sendto(f"a:{test_id}|c|#test_id:{test_id}".encode(), ("localhost", statsd.port))
+            capture.wait_for_count("a", 10 * test_id, timeout=1)
+            assert statsd.current_capture() is capture
+        results[test_id] = capture
+
+    with StatsdService().start() as statsd:
+        threads = [Thread(target=run_test, args=(i,)) for i in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert {test_id: capture.count("a").total() for test_id, capture in results.items()} == {
+        i: 10 * i for i in range(1, 5)
+    }
+    assert all(capture.count("a").tag_values("test_id") == [str(i)] for i, capture in results.items())
+
+
+def test_filtered_capture():
+    with StatsdService().start() as statsd:
+        sender = socket(AF_INET, SOCK_DGRAM)
+        with statsd.capture(names=["a"], prefixes=["ns."], types=["c"]) as capture:
+            sender.sendto(b"b:1|c\na:2|g\nns.b:3|c\na:4|c", ("localhost", statsd.port))
+            capture.wait_for_metrics(2, timeout=1)
+    assert sorted(capture.keys()) == [("a", "c"), ("ns.b", "c")]
+    # the line of "b" was skipped by the parser, since no capture was interested in it
+    assert statsd.stats().lines == 3
+
+
+def test_capture_snapshot():
+    with StatsdService().start() as statsd:
+        sender = socket(AF_INET, SOCK_DGRAM)
+        with statsd.capture() as capture:
+            sender.sendto(b"a:1|c\nb:1|g", ("localhost", statsd.port))
+            capture.wait_for_metrics(2, timeout=1)
+            before = capture.snapshot()
+            sender.sendto(b"a:2|c\na:3|c", ("localhost", statsd.port))
+            capture.wait_for_metrics(4, timeout=1)
+            after = capture.snapshot()
+            sender.sendto(b"a:4|c", ("localhost", statsd.port))
+            capture.wait_for_metrics(5, timeout=1)
+    assert before.count("a").total() == 1
+    assert after.count("a").total() == 6
+    delta = after - before
+    assert list(delta) == [("a", "c")]
+    assert delta.count("a").total() == 5
+
+
 class MyProtocol(DatagramProtocol):
     def __init__(self):
         self.on_lost = get_running_loop().create_future()
@@ -220,7 +562,7 @@ async def test_async_send_raw():
             )
             transport.sendto(b"testns.test.counter:1:4|c")
             transport.close()
-            await asleep(0.1)
+            await capture.async_wait_for_count("testns.test.counter", 5, timeout=1)
             assert await protocol.on_lost is None
         assert capture.count("testns.test.counter").total() == 5
 
@@ -233,5 +575,38 @@ async def test_async_send_metrics():
             client.increment("test.counter")
             client.increment("test.counter", value=3)
             await client.close()
-            sleep(0.1)
+            await capture.async_wait_for_count("testns.test.counter", 4, timeout=1)
         assert capture.count("testns.test.counter").total() == 4
+
+
+def test_record_and_replay(tmp_path):
+    path = tmp_path / "burst.rec"
+    with StatsdService().start() as statsd, statsd.capture() as capture, DatagramRecorder(path) as recorder:
+        statsd.add_datagram_callback(recorder)
+        dogstatsd = DogStatsd(host="localhost", port=statsd.port)
+        for i in range(10):
+            dogstatsd.increment("test.counter", value=i)
+        capture.wait_for_count("test.counter", 45, timeout=1)
+        statsd.remove_datagram_callback(recorder)
+    assert recorder.count == 10
+
+    for speed in (1000.0, None):
+        with StatsdService().start() as statsd, statsd.capture() as capture:
+            assert replay_recording(path, "127.0.0.1", statsd.port, speed) == 10
+            capture.wait_for_count("test.counter", 45, timeout=1)
+        assert capture.count("test.counter").total() == 45
+
+
+def test_replay_original_speed(tmp_path):
+    path = tmp_path / "burst.rec"
+    with DatagramRecorder(path) as recorder:
+        recorder(b"test.counter:1|c")
+        sleep(0.2)
+        recorder(b"test.counter:1|c")
+    with StatsdService().start() as statsd:
+        start = perf_counter()
+        replay_recording(path, "127.0.0.1", statsd.port)
+        assert perf_counter() - start >= 0.2
+        start = perf_counter()
+        replay_recording(path, "127.0.0.1", statsd.port, speed=10)
+        assert perf_counter() - start < 0.2
@@ -0,0 +1,87 @@
+from random import Random
+
+from pytest import approx, raises
+
+from yellowbox_statsd.aggregates import AggregatedMetricsCollection
+from yellowbox_statsd.metrics import CapturedMetricsCollection, Metric
+
+
+def random_metrics(seed, n=500):
+    rng = Random(seed)  # noqa: S311
+    for i in range(n):
+        metric_type = rng.choice(["c", "g", "ms", "s"])
+        values = [str(rng.randint(0, 100)) for _ in range(rng.randint(1, 3))]
+        if metric_type == "g" and rng.random() < 0.5:
+            values = [rng.choice("+-") + v for v in values]
+        line = f"m{i % 3}:{':'.join(values)}|{metric_type}"
+        if rng.random() < 0.5:
+            line += f"|@{rng.choice([0.1, 0.5, 1])}"
+        if rng.random() < 0.8:
+            line += f"|#a:{rng.randint(0, 3)},b:{rng.randint(0, 1)}"
+        yield Metric.parse(line)
+
+
+def test_aggregate_matches_raw():
+    raw = CapturedMetricsCollection()
+    aggregated = AggregatedMetricsCollection()
+    for metric in random_metrics(0):
+        raw.append(metric)
+        aggregated.append(metric)
+    assert aggregated.metrics_count() == raw.metrics_count()
+    assert sorted(aggregated) == sorted(raw)
+    for name in ("m0", "m1", "m2"):
+        assert aggregated.count(name).total() == approx(raw.count(name).total())
+        assert aggregated.count(name).filter(a="1").total() == approx(raw.count(name).filter(a="1").total())
+        assert aggregated.count(name).filter_not(b="1").total() == approx(raw.count(name).filter_not(b="1").total())
+        assert aggregated.count(name).tag_values("a") == raw.count(name).tag_values("a")
+        for key, split in raw.count(name).split(("a", "b")).items():
+            assert aggregated.count(name).split(("a", "b"))[key].total() == approx(split.total())
+        assert aggregated.timing(name).avg() == approx(raw.timing(name).avg())
+        assert aggregated.timing(name).min() == raw.timing(name).min()
+        assert aggregated.timing(name).max() == raw.timing(name).max()
+        assert aggregated.timing(name).quantiles(10) == raw.timing(name).quantiles(10)
+        assert aggregated.set(name).unique_count() == approx(raw.set(name).unique_count(), rel=0.05)
+        for split in raw.gauge(name).split(("a", "b")).values():
+            key = next(iter(split)).tags
+            gauge = aggregated.gauge(name).filter(tags=key)
+            assert gauge.last() == approx(split.last())
+            assert gauge.min() == approx(split.min())
+            assert gauge.max() == approx(split.max())
+        assert aggregated.gauge(name).last() in {g.last() for g in raw.gauge(name).split(("a", "b")).values()}
+
+
+def test_aggregate_filter_is_a_snapshot():
+    aggregated = AggregatedMetricsCollection()
+    aggregated.append(Metric.parse("a:1|c|#t:1"))
+    filtered = aggregated.count("a").filter(t="1")
+    aggregated.append(Metric.parse("a:2|c|#t:1"))
+    assert filtered.total() == 1
+    assert aggregated.count("a").filter(t="1").total() == 3
+    assert len(aggregated.count("a")) == 2
+
+
+def test_aggregate_wait_for():
+    aggregated = AggregatedMetricsCollection()
+    aggregated.extend([Metric.parse("a:1|c"), Metric.parse("a:2|c|#t:1")])
+    aggregated.wait_for_count("a", 3, timeout=0)
+    aggregated.wait_for_count("a", t="1", timeout=0)
+    with raises(TimeoutError):
+        aggregated.wait_for_count("a", 4, timeout=0.01)
+
+
+def test_aggregate_empty():
+    aggregated = AggregatedMetricsCollection()
+    assert aggregated.get_count("a").total() == 0
+    assert aggregated.get_gauge("a").last() == 0
+    assert aggregated.get_gauge("a").max(4) == 4
+    with raises(ValueError):
+        aggregated.get_gauge("a").min()
+    with raises(KeyError):
+        aggregated.count("a")
+
+
+def test_aggregate_invalid_value():
+    aggregated = AggregatedMetricsCollection()
+    aggregated.append(Metric.parse("a:1.2.3|c"))
+    with raises(ValueError):
+        aggregated.count("a").total()
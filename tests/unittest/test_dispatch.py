@@ -0,0 +1,77 @@
+from asyncio import get_running_loop, sleep as asleep
+from threading import Event, Thread
+
+from pytest import mark, raises
+
+from yellowbox_statsd.dispatch import CallbackDispatcher, LoopCallbackDispatcher, ThreadCallbackDispatcher
+
+
+@mark.parametrize(("policy", "expected"), [("drop_newest", [0, 1]), ("drop_oldest", [2, 3])])
+def test_drop_policies(policy, expected):
+    called = []
+    dispatcher = ThreadCallbackDispatcher(max_queue_size=2, full_policy=policy)
+    # the dispatcher is not started, so the queue is only drained once started
+    for i in range(4):
+        dispatcher.submit(called.append, i)
+    assert len(dispatcher) == 2
+    assert dispatcher.full == 2
+    assert dispatcher.dropped == 2
+    dispatcher.start()
+    dispatcher.stop()
+    assert called == expected
+
+
+def test_block_policy():
+    called = []
+    release = Event()
+
+    def slow(i):
+        release.wait()
+        called.append(i)
+
+    dispatcher = ThreadCallbackDispatcher(max_queue_size=1)
+    dispatcher.start()
+    dispatcher.submit(slow, 0)
+    submitter = Thread(target=lambda: [dispatcher.submit(slow, i) for i in (1, 2)])
+    submitter.start()
+    submitter.join(0.1)
+    # the worker is stuck on the first callback, the second is queued, and the third blocks the submitter
+    assert submitter.is_alive()
+    release.set()
+    submitter.join()
+    dispatcher.stop()
+    assert called == [0, 1, 2]
+    assert dispatcher.full >= 1
+    assert dispatcher.dropped == 0
+
+
+def test_stopped_dispatcher_drops_nothing_queued():
+    called = []
+    dispatcher = ThreadCallbackDispatcher(workers=2)
+    dispatcher.start()
+    for i in range(100):
+        dispatcher.submit(called.append, i)
+    dispatcher.stop()
+    dispatcher.submit(called.append, 100)
+    assert sorted(called) == list(range(100))
+
+
+def test_invalid_arguments():
+    with raises(ValueError):
+        CallbackDispatcher(full_policy="drop_everything")
+    with raises(ValueError):
+        CallbackDispatcher(max_queue_size=0)
+    with raises(ValueError):
+        ThreadCallbackDispatcher(workers=0)
+
+
+async def test_loop_dispatcher():
+    called = []
+    dispatcher = LoopCallbackDispatcher(get_running_loop())
+    dispatcher.start()
+    thread = Thread(target=lambda: [dispatcher.submit(called.append, i) for i in range(10)])
+    thread.start()
+    thread.join()
+    await asleep(0.01)
+    dispatcher.stop()
+    assert called == list(range(10))
@@ -1,7 +1,15 @@
-from pytest import mark, raises
+from copy import deepcopy
+from pickle import dumps, loads
+from threading import Event, Thread, Timer
+from unittest.mock import patch
+
+from pytest import approx, mark, raises
 
 from yellowbox_statsd.metrics import (
+    NUMPY_MIN_SIZE,
     CapturedMetric,
+    CapturedMetrics,
+    CapturedMetricsCollection,
     CountCapturedMetric,
     GaugeCapturedMetric,
     HistogramCapturedMetric,
@@ -104,6 +112,27 @@ def test_histogram_capture():
     assert cap.max() == 7
 
 
+def test_histogram_percentile():
+    cap = HistogramCapturedMetric(mk_tagged_metric([str(i)], f"t:{i % 3}") for i in range(1, 1001))
+    assert cap.percentile(50) == approx(500, rel=0.01)
+    assert cap.percentile(99) == approx(990, rel=0.01)
+    assert cap.percentile(100) == 1000
+    assert cap.quantiles() == approx([250, 500, 750], rel=0.01)
+    split = cap.split("t")
+    assert split["0"].percentile(50) == approx(501, rel=0.01)
+    merged = split["0"].sketch()
+    merged.merge(split["1"].sketch())
+    merged.merge(split["2"].sketch())
+    assert merged.quantile(0.5) == cap.percentile(50)
+    assert cap.filter_not(t="0").sketch().count == len(split["1"]) + len(split["2"])
+
+
+def test_histogram_percentile_sample_rate():
+    cap = HistogramCapturedMetric([mk_metric(["1"], 0.1), mk_metric(["100"], None)])
+    assert cap.percentile(90) == approx(1, rel=0.01)
+    assert cap.percentile(95) == approx(100, rel=0.01)
+
+
 def test_gauge_capture():
     cap = GaugeCapturedMetric(
         [
@@ -148,6 +177,23 @@ def test_gauge_capture_empty():
     assert cap.min(-3) == -3
 
 
+def test_gauge_value_at():
+    cap = GaugeCapturedMetric(
+        [
+            mk_metric(["1", "+6"], None),
+            mk_metric(["3", "+7.2"], None),
+            mk_metric(["-2"], None),
+        ]
+    )
+
+    assert [cap.value_at(i) for i in range(3)] == [7, 10.2, 8.2]
+    assert cap.value_at(-1) == cap.last()
+    with raises(IndexError):
+        cap.value_at(3)
+    with raises(TypeError):
+        cap.value_at()
+
+
 def test_set_capture():
     cap = SetCapturedMetric(
         [
@@ -158,3 +204,395 @@ def test_set_capture():
     )
 
     assert cap.unique() == {1, 2, 3}
+
+
+def test_capture_columns_follow_mutations():
+    cap = CountCapturedMetric([mk_metric(["1"], None), mk_metric(["2", "3"], 0.5)])
+    cap.append(mk_metric(["4"], None))
+    assert cap.total() == 15
+    cap.insert(0, mk_metric(["10"], None))
+    assert cap.total() == 25
+    del cap[1]
+    assert cap.total() == 24
+    cap[0] = mk_metric(["1"], 0.25)
+    assert cap.total() == 18
+    cap.pop()
+    assert cap.total() == 14
+    cap += [mk_metric(["1"], None)]
+    assert cap.total() == 15
+    cap.clear()
+    assert cap.total() == 0
+
+
+def test_capture_copy():
+    cap = CountCapturedMetric([mk_metric(["1"], None), mk_metric(["2"], 0.5)])
+    copied = deepcopy(cap)
+    copied.append(mk_metric(["3"], None))
+    assert copied.total() == 8
+    assert cap.total() == 5
+    assert loads(dumps(cap)).total() == 5  # noqa: S301
+
+
+def test_capture_invalid_value():
+    cap = HistogramCapturedMetric([mk_metric(["1"], None), mk_metric(["1.2.3"], None)])
+    with raises(ValueError):
+        cap.avg()
+    with raises(ValueError):
+        cap.max()
+
+
+@mark.parametrize("size", [10, NUMPY_MIN_SIZE])
+def test_histogram_capture_large(size):
+    cap = HistogramCapturedMetric(mk_metric([str(i)], 0.5) for i in range(size))
+    assert cap.avg() == approx((size - 1) / 2)
+    assert cap.min() == 0
+    assert cap.max() == size - 1
+    assert CountCapturedMetric(cap).total() == approx(size * (size - 1))
+
+
+def mk_tagged_metric(values, *tags):
+    return CapturedMetric(values, None, MetricTags.interned(tags) if tags else None, None, None)
+
+
+def test_filter_index():
+    cap = GaugeCapturedMetric(
+        [
+            mk_tagged_metric(["1"], "a:1", "b:1"),
+            mk_tagged_metric(["+2"], "a:2"),
+            mk_tagged_metric(["3"]),
+            mk_tagged_metric(["4", "+1"], "a:1", "c"),
+            mk_tagged_metric(["-5"], "a:1", "b:1"),
+        ]
+    )
+    for args, kwargs in [((), {}), (("c",), {}), ((), {"a": "1"}), (("c",), {"a": "1"}), ((), {"a": "3"})]:
+        expected = [m for m in cap if m.tags_match(*args, **kwargs)]
+        assert cap.filter(*args, **kwargs) == expected
+        assert list(cap.filter(*args, **kwargs).values()) == list(GaugeCapturedMetric(expected).values())
+        expected_not = [m for m in cap if not m.tags_match(*args, **kwargs)]
+        assert cap.filter_not(*args, **kwargs) == expected_not
+        assert list(cap.filter_not(*args, **kwargs).values()) == list(GaugeCapturedMetric(expected_not).values())
+    assert cap.filter(a="1").last() == 0
+    assert cap.tags() == ["a:1", "a:2", "b:1", "c"]
+    split = cap.split("a")
+    assert list(split) == ["1", "2"]
+    assert split["1"] == cap.filter(a="1")
+    assert split["1"].last() == 0
+    assert cap.split(("a", "b")) == {("1", "1"): cap.filter(a="1", b="1")}
+
+
+def test_filter_ingesting():
+    histograms = HistogramCapturedMetric([mk_tagged_metric(["1"], "x:0"), mk_tagged_metric(["2"], "x:0")])
+    # a metric whose values were ingested, but that was not indexed yet, as seen by a query while it is captured
+    histograms._ingest_values(mk_tagged_metric(["1000"], "x:0"))  # noqa: SLF001
+    filtered = histograms.filter(x="0")
+    assert len(filtered) == 2
+    assert filtered.sketch().max == 2
+    assert filtered.percentile(100) == approx(2, rel=0.01)
+
+
+def test_filter_memoized():
+    cap = CountCapturedMetric([mk_tagged_metric(["1"], "a:1"), mk_tagged_metric(["2"], "a:2")])
+    assert cap.filter(a="1").total() == 1
+    assert cap.filter(a="1").total() == 1
+    cap.append(mk_tagged_metric(["3"], "a:1"))
+    assert cap.filter(a="1").total() == 4
+    del cap[0]
+    assert cap.filter(a="1").total() == 3
+    assert cap.filter_not(a="1").total() == 2
+
+
+@mark.parametrize("size", [10, NUMPY_MIN_SIZE])
+def test_running_aggregates(size):
+    metrics = [
+        CapturedMetric(
+            [str(i % 7), f"+{i % 3}"] if i % 5 == 0 else [f"-{i % 4}" if i % 2 else str(i % 11)],
+            0.5 if i % 3 == 0 else None,
+            MetricTags.interned([f"a:{i % 3}", "b"] if i % 4 else [f"a:{i % 3}"]),
+            None,
+            None,
+        )
+        for i in range(size)
+    ]
+    counts = CountCapturedMetric(metrics)
+    histograms = HistogramCapturedMetric(metrics)
+    gauges = GaugeCapturedMetric(metrics)
+
+    def list_total(cap):
+        return sum(float(v) / (m.sample_rate or 1) for m in cap for v in m.values)
+
+    def list_count(cap):
+        return sum(1 / (m.sample_rate or 1) for m in cap for _ in m.values)
+
+    def list_gauge(cap):
+        ret = [0.0]
+        for v in (v for m in cap for v in m.values):
+            ret.append(ret[-1] + float(v) if v.startswith(("+", "-")) else float(v))
+        return ret[1:]
+
+    for counts_subset, histograms_subset, gauges_subset in [
+        (counts, histograms, gauges),
+        (counts.filter("b"), histograms.filter("b"), gauges.filter("b")),
+        (counts.split("a")["1"], histograms.split("a")["1"], gauges.split("a")["1"]),
+    ]:
+        assert counts_subset.total() == approx(list_total(counts_subset))
+        assert histograms_subset.total() == approx(list_total(histograms_subset))
+        assert histograms_subset.weighted_count() == approx(list_count(histograms_subset))
+        assert histograms_subset.avg() == approx(list_total(histograms_subset) / list_count(histograms_subset))
+        assert histograms_subset.min() == min(float(v) for m in histograms_subset for v in m.values)
+        assert histograms_subset.max() == max(float(v) for m in histograms_subset for v in m.values)
+        gauge_values = list_gauge(gauges_subset)
+        assert list(gauges_subset.values()) == approx(gauge_values)
+        assert gauges_subset.last() == approx(gauge_values[-1])
+        assert gauges_subset.min() == approx(min(gauge_values))
+        assert gauges_subset.max() == approx(max(gauge_values))
+    assert counts.filtered_total("b") == approx(counts.filter("b").total())
+    assert counts.filtered_total(a="2") == approx(counts.filter(a="2").total())
+    assert counts.filtered_total("c") == 0
+    # the aggregates follow mutations
+    del counts[0]
+    assert counts.total() == approx(list_total(counts))
+    assert counts.filtered_total("b") == approx(counts.filter("b").total())
+    gauges.append(CapturedMetric(["+2.5"], None, None, None, None))
+    assert gauges.last() == approx(list_gauge(gauges)[-1])
+    gauges.reverse()
+    assert gauges.max() == approx(max(list_gauge(gauges)))
+    histograms.clear()
+    with raises(ValueError):
+        histograms.min()
+
+
+def test_wait_for_count_tags():
+    collection = CapturedMetricsCollection()
+    collection.extend(Metric.parse(f"a:{i}|c|@0.5|#x:{i % 2}") for i in range(10))
+    collection.wait_for_count("a", 50, x="1", timeout=0)
+    with raises(TimeoutError):
+        collection.wait_for_count("a", 51, x="1", timeout=0)
+    with raises(TimeoutError):
+        collection.wait_for_count("b", 1, timeout=0)
+
+
+def mk_timed_collection():
+    # a batch of two metrics every second, from time 10
+    collection = CapturedMetricsCollection()
+    for t in range(10, 20):
+        with patch("yellowbox_statsd.metrics.monotonic", return_value=float(t)):
+            collection.extend(Metric.parse_datagram(f"a:{t}|c|#x:{t % 2}\na:1|c|@0.5|#x:{t % 2}".encode()))
+    return collection
+
+
+def test_between():
+    counts = mk_timed_collection().count("a")
+    assert counts.between(12, 14).total() == 12 + 2 + 13 + 2
+    assert len(counts.between(12.5, 13.5)) == 2
+    assert counts.between(20, 30) == []
+    assert counts.filter(x="0").between(12, 14).total() == 12 + 2
+    assert counts.between(12, 14).filter(x="0").total() == 12 + 2
+
+
+def test_between_percentile():
+    collection = CapturedMetricsCollection()
+    for t, values in [(1, range(1, 101)), (2, range(1000, 1010))]:
+        with patch("yellowbox_statsd.metrics.monotonic", return_value=float(t)):
+            collection.extend(Metric.parse_datagram("\n".join(f"lat:{v}|ms" for v in values).encode()))
+    timings = collection.timing("lat")
+    first = timings.between(1, 2)
+    assert first.max() == 100
+    assert first.percentile(99) == approx(99, rel=0.01)
+    assert first.percentile(50) == approx(50, rel=0.01)
+    second = timings.between(2, 3)
+    assert second.percentile(50) == approx(1004.5, rel=0.01)
+    # a filter of all the metrics shares the sketch
+    assert timings.filter().percentile(99) == timings.percentile(99)
+
+
+def test_between_gauge():
+    collection = CapturedMetricsCollection()
+    for t, value in enumerate(["10", "+5", "+1", "-4"]):
+        with patch("yellowbox_statsd.metrics.monotonic", return_value=float(t)):
+            collection.append(Metric.parse(f"g:{value}|g"))
+    gauges = collection.gauge("g")
+    assert gauges.between(2, 3).last() == 16
+    assert list(gauges.between(1, 4).values()) == [15, 16, 12]
+    assert gauges.between(1, 4).min() == 12
+    assert [bucket.last() for _, bucket in gauges.resample(2)] == [15, 12]
+    # relative changes of a filter apply to the gauge before them in the filter
+    assert gauges.between(2, 3).filter().last() == 1
+
+
+def test_rate():
+    counts = mk_timed_collection().count("a")
+    assert counts.rate(5, end=20) == (15 + 16 + 17 + 18 + 19 + 2 * 5) / 5
+    assert CapturedMetrics.rate(counts, 5, end=20) == 2
+    assert counts.rate(5, end=30) == 0
+
+
+def test_resample():
+    counts = mk_timed_collection().count("a")
+    buckets = counts.resample(4)
+    assert [start for start, _ in buckets] == [10, 14, 18]
+    assert [len(bucket) for _, bucket in buckets] == [8, 8, 4]
+    assert sum(bucket.total() for _, bucket in buckets) == counts.total()
+    assert [len(bucket) for _, bucket in counts.resample(5, start=0, end=15)] == [0, 0, 10]
+    with raises(ValueError):
+        counts.resample(0)
+
+
+def test_resample_empty():
+    counts = CountCapturedMetric()
+    assert counts.resample(1) == []
+    assert counts.resample(1, end=100) == []
+    assert [len(bucket) for _, bucket in counts.resample(1, start=10, end=12)] == [0, 0]
+
+
+def test_gauge_value_at_time():
+    collection = CapturedMetricsCollection()
+    for t in range(10, 15):
+        with patch("yellowbox_statsd.metrics.monotonic", return_value=float(t)):
+            collection.extend(Metric.parse_datagram(f"g:+{t}|g|#x:{t % 2}".encode()))
+    gauges = collection.gauge("g")
+    assert gauges.value_at(time=12.5) == 10 + 11 + 12
+    assert gauges.value_at(time=100) == gauges.last()
+    assert gauges.filter(x="0").value_at(time=12.5) == 10 + 12
+    with raises(IndexError):
+        gauges.value_at(time=9)
+
+
+def test_received_follow_mutations():
+    counts = mk_timed_collection().count("a")
+    received = list(counts._received)  # noqa: SLF001
+    counts.sort(key=lambda m: m.tags)
+    # the receive times are kept in order
+    assert list(counts._received) == sorted(counts._received)  # noqa: SLF001
+    del counts[-1]
+    assert counts.between(0, 100).total() == counts.total()
+    unpickled = loads(dumps(mk_timed_collection().count("a")))  # noqa: S301
+    assert list(unpickled._received) == received  # noqa: SLF001
+    assert list(mk_timed_collection().count("a").unbunch()._received) == received  # noqa: SLF001
+
+
+def test_snapshot():
+    collection = CapturedMetricsCollection()
+    collection.extend(Metric.parse_datagram(b"a:1|c|#x:0\na:2|c|#x:1\nb:5|g"))
+    first = collection.snapshot()
+    collection.extend(Metric.parse_datagram(b"a:3|c|#x:0\nc:1|ms"))
+    second = collection.snapshot()
+    collection.extend(Metric.parse_datagram(b"a:4|c"))
+
+    assert sorted(first) == [("a", "c"), ("b", "g")]
+    assert first.count("a").total() == 3
+    assert first.get_count("a", x="0").total() == 1
+    assert first.metrics_count() == 3
+    assert second.count("a").total() == 6
+    delta = second - first
+    assert sorted(delta) == [("a", "c"), ("c", "ms")]
+    assert delta.count("a") == [CapturedMetric(["3"], None, MetricTags.interned(["x:0"]), None, None)]
+    assert delta.metrics_count() == 2
+    assert (collection.snapshot() - second).count("a").total() == 4
+    assert first - second == {}
+    with raises(KeyError, match="available metrics"):
+        delta.gauge("b")
+
+
+def test_snapshot_delta_aggregates():
+    collection = CapturedMetricsCollection()
+    collection.extend(Metric.parse_datagram("\n".join(f"lat:{v}|ms" for v in range(1, 101)).encode()))
+    collection.extend(Metric.parse_datagram(b"g:10|g\ng:+5|g"))
+    first = collection.snapshot()
+    collection.extend(Metric.parse_datagram("\n".join(f"lat:{v}|ms" for v in range(1000, 1010)).encode()))
+    collection.append(Metric.parse("g:+1|g"))
+    second = collection.snapshot()
+    delta = second - first
+    assert delta.timing("lat").min() == 1000
+    assert delta.timing("lat").percentile(50) == approx(1004.5, rel=0.01)
+    # values captured after the snapshot are not in its sketches
+    assert first.timing("lat").percentile(99) == approx(99, rel=0.01)
+    assert delta.gauge("g").last() == 16
+    assert list(delta.gauge("g").values()) == [16]
+
+
+def test_snapshot_modified():
+    collection = CapturedMetricsCollection()
+    collection.extend(Metric.parse_datagram(b"a:1|c\na:2|c"))
+    first = collection.snapshot()
+    collection.count("a").reverse()
+    with raises(RuntimeError):
+        first.count("a")
+    with raises(RuntimeError):
+        collection.snapshot() - first
+    with raises(ValueError):
+        first - CapturedMetricsCollection().snapshot()
+
+
+def test_snapshot_cleared_gauge():
+    collection = CapturedMetricsCollection()
+    collection.extend(Metric.parse_datagram(b"g:10|g\ng:+5|g"))
+    first = collection.snapshot()
+    collection.append(Metric.parse("g:+1|g"))
+    second = collection.snapshot()
+    collection.gauge("g").clear()
+    with raises(RuntimeError):
+        (second - first).gauge("g")
+    with raises(RuntimeError):
+        second.gauge("g")
+
+
+def test_snapshot_concurrent():
+    collection = CapturedMetricsCollection()
+    collection.extend(Metric.parse_datagram(b"a:1|c\nb:1|c"))
+    stop = Event()
+
+    def capture():
+        while not stop.is_set():
+            collection.extend(Metric.parse_datagram(b"a:1|c\nb:1|c"))
+
+    thread = Thread(target=capture)
+    thread.start()
+    try:
+        snapshots = [collection.snapshot() for _ in range(100)]
+    finally:
+        stop.set()
+        thread.join()
+    prev = snapshots[0]
+    for snapshot in snapshots[1:]:
+        delta = snapshot - prev
+        # both names are captured in the same batches
+        assert delta.get_count("a").total() == delta.get_count("b").total() == delta.metrics_count() / 2
+        assert snapshot.count("a").total() == prev.count("a").total() + delta.get_count("a").total()
+        prev = snapshot
+
+
+def test_wait_for():
+    collection = CapturedMetricsCollection()
+    Timer(0.01, collection.extend, ([Metric.parse("a:1|c"), Metric.parse("a:2|c|#t:1")],)).start()
+    collection.wait_for_count("a", 3, timeout=1)
+    assert collection.metrics_count() == 2
+    collection.wait_for_count("a", t="1", timeout=1)
+    collection.wait_for_metrics(2, timeout=0)
+    collection.wait_for(lambda c: ("a", "c") in c)
+
+
+def test_wait_for_timeout():
+    collection = CapturedMetricsCollection()
+    collection.append(Metric.parse("a:1|c"))
+    with raises(TimeoutError):
+        collection.wait_for_count("a", 2, timeout=0.01)
+    with raises(TimeoutError):
+        collection.wait_for_metrics(2, timeout=0.01)
+
+
+async def test_async_wait_for():
+    collection = CapturedMetricsCollection()
+    Timer(0.01, collection.append, (Metric.parse("a:3|c"),)).start()
+    await collection.async_wait_for_count("a", 3, timeout=1)
+    with raises(TimeoutError):
+        await collection.async_wait_for_metrics(2, timeout=0.01)
+
+
+def test_collection_deepcopy():
+    collection = CapturedMetricsCollection()
+    collection.append(Metric.parse("a:1|c"))
+    copied = deepcopy(collection)
+    assert copied == collection
+    copied.append(Metric.parse("a:2|c"))
+    assert copied.count("a").total() == 3
+    assert collection.count("a").total() == 1
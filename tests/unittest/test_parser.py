@@ -0,0 +1,120 @@
+from random import Random
+
+from pytest import mark, raises
+
+from yellowbox_statsd.metrics import Metric, MetricParseCache
+
+ALPHABET = "abcxyzAZ019_.:|@#,+-/\\Tc!\x00 \t\n\r\x0b\x1c\u2028é"
+
+
+def random_line(rng: Random) -> str:
+    name = rng.choice(["a", "ns.metric_1", "35.ns_bloo", "été"])
+    values = ":".join(rng.choice(["1", "+2.5", "-3", "0.1.2", "10"]) for _ in range(rng.randint(1, 3)))
+    line = f"{name}:{values}|{rng.choice(['c', 'ms', 'g', 'h', 's', 'd'])}"
+    if rng.random() < 0.5:
+        line += f"|@{rng.choice(['0.5', '1', '0.1.2'])}"
+    if rng.random() < 0.5:
+        line += "|#" + ",".join(rng.choice(["tag1:a", "tag2", "t/x", "t\\y", "k:v:w", "é:1"]) for _ in range(3))
+    if rng.random() < 0.3:
+        line += f"|c:{rng.choice(['abc123', 'blabla'])}"
+    if rng.random() < 0.3:
+        line += f"|T{rng.randint(0, 2**40)}"
+    return line
+
+
+def mutate(rng: Random, line: str) -> str:
+    chars = list(line)
+    for _ in range(rng.randint(0, 3)):
+        op = rng.random()
+        pos = rng.randrange(len(chars) + 1)
+        if op < 0.4:
+            chars.insert(pos, rng.choice(ALPHABET))
+        elif chars and op < 0.7:
+            del chars[min(pos, len(chars) - 1)]
+        elif chars:
+            chars[min(pos, len(chars) - 1)] = rng.choice(ALPHABET)
+    return "".join(chars)
+
+
+def regex_parse_datagram(data: bytes):
+    return [Metric.parse(line) for line in str(data, "utf-8").strip().splitlines()]
+
+
+def assert_same_outcome(fast, slow, arg):
+    try:
+        expected = slow(arg)
+    except ValueError:
+        with raises(ValueError):
+            fast(arg)
+    else:
+        assert fast(arg) == expected
+
+
+@mark.parametrize("seed", range(10))
+def test_parse_bytes_fuzz(seed):
+    rng = Random(seed)  # noqa: S311
+    for _ in range(2000):
+        line = mutate(rng, random_line(rng)).encode("utf-8")
+        assert_same_outcome(Metric.parse_bytes, lambda b: Metric.parse(b.decode("utf-8")), line)
+
+
+@mark.parametrize("seed", range(10))
+def test_parse_datagram_fuzz(seed):
+    rng = Random(seed)  # noqa: S311
+    for _ in range(500):
+        lines = [mutate(rng, random_line(rng)) if rng.random() < 0.2 else random_line(rng) for _ in range(3)]
+        data = rng.choice(["\n", "\r\n", "\x0b"]).join(lines).encode("utf-8")
+        assert_same_outcome(Metric.parse_datagram, regex_parse_datagram, data)
+
+
+def test_parse_bytes():
+    assert Metric.parse_bytes(b"ns.a:1:+2|c|@0.5|#tag1:a,tag2|c:abc|T12") == Metric(
+        "ns.a", ["1", "+2"], "c", 0.5, Metric.parse("a:1|c|#tag1:a,tag2").tags, 12, "abc"
+    )
+
+
+def test_parse_datagram_invalid():
+    with raises(ValueError):
+        Metric.parse_datagram(b"a:1|c\nb:|c")
+
+
+@mark.parametrize("parse_datagram", [Metric.parse_datagram, MetricParseCache().parse_datagram])
+def test_parse_datagram_name_filter(parse_datagram):
+    def name_filter(name):
+        return name.startswith(b"a")
+
+    assert parse_datagram(b"a:1|c\nb:2|c\nab:3|ms", name_filter) == [Metric.parse("a:1|c"), Metric.parse("ab:3|ms")]
+    # rejected lines are skipped before they are parsed
+    assert parse_datagram(b"a:1|c\nb:invalid", name_filter) == [Metric.parse("a:1|c")]
+    # lines that fall back to the regex parser are filtered after they are parsed
+    assert parse_datagram("aé:1|c\nb:2|c".encode(), name_filter) == [Metric.parse("aé:1|c")]
+
+
+def test_parse_cache():
+    cache = MetricParseCache(2)
+    datagram = b"a:1|c|#tag1:a\nb:2:3|ms"
+    first = cache.parse_datagram(datagram)
+    assert first == Metric.parse_datagram(datagram)
+    assert (cache.hits, cache.misses, len(cache)) == (0, 2, 2)
+    second = cache.parse_datagram(datagram)
+    assert second == first
+    assert (cache.hits, cache.misses) == (2, 2)
+    # the cached values are not shared between metrics
+    assert second[1].values is not first[1].values
+    second[1].values.append("4")
+    assert cache.parse_datagram(b"b:2:3|ms")[0].values == ["2", "3"]
+
+    cache.parse_datagram(b"c:1|c")
+    assert len(cache) == 2
+    cache.clear()
+    assert (cache.hits, cache.misses, len(cache)) == (0, 0, 0)
+
+
+@mark.parametrize("seed", range(3))
+def test_parse_cache_fuzz(seed):
+    rng = Random(seed)  # noqa: S311
+    cache = MetricParseCache(16)
+    for _ in range(500):
+        lines = [mutate(rng, random_line(rng)) if rng.random() < 0.2 else random_line(rng) for _ in range(3)]
+        data = rng.choice(["\n", "\x0b"]).join(lines).encode("utf-8")
+        assert_same_outcome(cache.parse_datagram, regex_parse_datagram, data)
@@ -0,0 +1,72 @@
+from pytest import raises
+
+from yellowbox_statsd.aggregates import AggregatedMetricsCollection
+from yellowbox_statsd.recording import (
+    RECORD_HEADER,
+    DatagramRecorder,
+    capture_recording,
+    iter_recording,
+)
+
+
+def test_record_and_iterate(tmp_path):
+    path = tmp_path / "burst.rec"
+    with DatagramRecorder(path) as recorder:
+        recorder(b"a.b:1|c")
+        recorder(b"a.b:2|c\nx.y:3|g")
+    assert recorder.count == 2
+    records = [(timestamp, bytes(datagram)) for timestamp, datagram in iter_recording(path)]
+    assert [datagram for _, datagram in records] == [b"a.b:1|c", b"a.b:2|c\nx.y:3|g"]
+    assert records[0][0] <= records[1][0]
+
+
+def test_record_append(tmp_path):
+    path = tmp_path / "burst.rec"
+    with DatagramRecorder(path) as recorder:
+        recorder(b"a.b:1|c")
+    with DatagramRecorder(path, append=True) as recorder:
+        recorder(b"a.b:2|c")
+    assert [bytes(datagram) for _, datagram in iter_recording(path)] == [b"a.b:1|c", b"a.b:2|c"]
+    with DatagramRecorder(path) as recorder:
+        recorder(b"a.b:3|c")
+    assert [bytes(datagram) for _, datagram in iter_recording(path)] == [b"a.b:3|c"]
+
+
+def test_incomplete_record(tmp_path):
+    path = tmp_path / "burst.rec"
+    with DatagramRecorder(path) as recorder:
+        recorder(b"a.b:1|c")
+        recorder(b"a.b:2|c")
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 1)
+    assert [bytes(datagram) for _, datagram in iter_recording(path)] == [b"a.b:1|c"]
+
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path / "burst.rec"
+    path.write_bytes(RECORD_HEADER.pack(0, 1) + b"x")
+    with raises(ValueError):
+        list(iter_recording(path))
+    with raises(ValueError):
+        DatagramRecorder(path, append=True)
+
+
+def test_capture_recording(tmp_path):
+    path = tmp_path / "burst.rec"
+    with DatagramRecorder(path) as recorder:
+        for i in range(100):
+            recorder(f"a.b:{i}|c|#i:{i % 2}\nx.y:{i}|g".encode())
+        recorder(b"\xff")
+    capture = capture_recording(path, batch_size=16)
+    assert capture.count("a.b").total() == sum(range(100))
+    assert capture.count("a.b").filter(i="1").total() == sum(range(1, 100, 2))
+    assert capture.gauge("x.y").last() == 99
+
+
+def test_capture_recording_aggregate(tmp_path):
+    path = tmp_path / "burst.rec"
+    with DatagramRecorder(path) as recorder:
+        for i in range(10):
+            recorder(f"a.b:{i}|c".encode())
+    capture = capture_recording(path, AggregatedMetricsCollection())
+    assert capture.count("a.b").total() == 45
@@ -0,0 +1,88 @@
+from pytest import raises
+
+from yellowbox_statsd.metrics import CapturedMetricsCollection, Metric
+from yellowbox_statsd.routing import CaptureFilter, CaptureRoute, CaptureRouter
+
+METRICS = Metric.parse_datagram(
+    b"a.x:1|c|#test_id:1\nb.x:2|c|#test_id:2,env:ci\nb.y:3|c|c:abc\na.y:4|c|#test_id:1|c:abc\nc:5|c"
+)
+
+
+def routed_values(router):
+    return {id(cap): [m.values[0] for m in metrics] for cap, metrics in router.route(METRICS)}
+
+
+def test_unrouted():
+    router = CaptureRouter()
+    assert not router
+    a = CapturedMetricsCollection()
+    b = CapturedMetricsCollection()
+    router.add(a)
+    router.add(b)
+    assert list(router) == [a, b]
+    assert [(cap, metrics) for cap, metrics in router.route(METRICS)] == [(a, METRICS), (b, METRICS)]
+
+
+def test_routes():
+    router = CaptureRouter()
+    everything = CapturedMetricsCollection()
+    test_1 = CapturedMetricsCollection()
+    test_2 = CapturedMetricsCollection()
+    container = CapturedMetricsCollection()
+    prefix = CapturedMetricsCollection()
+    nothing = CapturedMetricsCollection()
+    router.add(everything)
+    router.add(test_1, CaptureRoute(tag="test_id:1"))
+    router.add(test_2, CaptureRoute(tag="test_id:2"))
+    router.add(container, CaptureRoute(container_id="abc"))
+    router.add(prefix, CaptureRoute(name_prefix="b."))
+    router.add(nothing, CaptureRoute(tag="test_id:3"))
+    # the results are the same whether or not the routes are cached
+    for _ in range(2):
+        assert routed_values(router) == {
+            id(everything): ["1", "2", "3", "4", "5"],
+            id(test_1): ["1", "4"],
+            id(test_2): ["2"],
+            id(container): ["3", "4"],
+            id(prefix): ["2", "3"],
+        }
+    router.remove(test_1)
+    router.remove(everything)
+    assert id(test_1) not in routed_values(router)
+    assert len(router) == 4
+
+
+def test_invalid_routes():
+    router = CaptureRouter()
+    with raises(ValueError):
+        router.add(CapturedMetricsCollection(), CaptureRoute(tag="a:b", name_prefix="a"))
+    with raises(ValueError):
+        router.remove(CapturedMetricsCollection())
+
+
+def test_filters():
+    router = CaptureRouter()
+    everything = CapturedMetricsCollection()
+    names = CapturedMetricsCollection()
+    tagged = CapturedMetricsCollection()
+    gauges = CapturedMetricsCollection()
+    routed = CapturedMetricsCollection()
+    router.add(everything)
+    router.add(names, capture_filter=CaptureFilter(names=["c"], prefixes=["a."]))
+    router.add(tagged, capture_filter=CaptureFilter(tags={"env": "ci"}))
+    router.add(gauges, capture_filter=CaptureFilter(types=["g"]))
+    router.add(routed, CaptureRoute(container_id="abc"), CaptureFilter(prefixes=["b."]))
+    assert routed_values(router) == {
+        id(everything): ["1", "2", "3", "4", "5"],
+        id(names): ["1", "4", "5"],
+        id(tagged): ["2"],
+        id(routed): ["3"],
+    }
+    # a capture that accepts any name means no lines can be skipped
+    assert router.name_filter() is None
+    router.remove(everything)
+    assert router.name_filter() is None
+    router.remove(tagged)
+    router.remove(gauges)
+    name_filter = router.name_filter()
+    assert [name for name in (b"a.x", b"b.y", b"c", b"cd", b"d") if name_filter(name)] == [b"a.x", b"b.y", b"c"]
@@ -0,0 +1,128 @@
+import os
+import sys
+from json import dumps, loads
+from random import Random
+from subprocess import run
+
+from pytest import approx, mark, raises
+
+from yellowbox_statsd.sketches import DDSketch, HyperLogLog
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[max(0, int(q * len(values) + 0.5) - 1)]
+
+
+@mark.parametrize("seed", range(5))
+def test_ddsketch_relative_error(seed):
+    rng = Random(seed)  # noqa: S311
+    values = [rng.lognormvariate(3, 2) for _ in range(5000)]
+    sketch = DDSketch(relative_accuracy=0.01)
+    for v in values:
+        sketch.add(v)
+    for q in (0, 0.1, 0.5, 0.9, 0.95, 0.99, 1):
+        expected = exact_quantile(values, q)
+        assert sketch.quantile(q) == approx(expected, rel=0.0201)
+    assert sketch.min == min(values)
+    assert sketch.max == max(values)
+
+
+def test_ddsketch_negative_and_zero():
+    sketch = DDSketch()
+    for v in (-10, -1, 0, 0, 1, 10):
+        sketch.add(v)
+    assert sketch.quantile(0) == approx(-10, rel=0.01)
+    assert sketch.quantile(0.5) == 0
+    assert sketch.quantile(1) == 10
+
+
+def test_ddsketch_weights():
+    sketch = DDSketch()
+    sketch.add(1, weight=9)
+    sketch.add(100)
+    assert sketch.count == 10
+    assert sketch.quantile(0.9) == approx(1, rel=0.01)
+    assert sketch.quantile(0.95) == approx(100, rel=0.01)
+
+
+def test_ddsketch_merge():
+    a = DDSketch()
+    b = DDSketch()
+    for v in range(1, 101):
+        (a if v % 2 else b).add(v)
+    merged = a.copy()
+    merged.merge(b)
+    assert merged.count == 100
+    assert merged.quantile(0.5) == approx(50, rel=0.02)
+    assert a.count == 50
+    with raises(ValueError):
+        a.merge(DDSketch(relative_accuracy=0.05))
+
+
+def test_ddsketch_bounded_bins():
+    sketch = DDSketch(max_bins=16)
+    for i in range(1000):
+        sketch.add(1.1**i)
+    assert len(sketch._positive) == 16  # noqa: SLF001
+    assert sketch.quantile(1) == approx(1.1**999, rel=0.01)
+
+
+@mark.parametrize("value", [3, -3])
+def test_ddsketch_single_value(value):
+    sketch = DDSketch()
+    sketch.add(value)
+    assert sketch.quantiles([0, 0.5, 1]) == [value, value, value]
+
+
+def test_ddsketch_empty():
+    with raises(ValueError):
+        DDSketch().quantile(0.5)
+
+
+def test_ddsketch_to_dict():
+    sketch = DDSketch()
+    for value in (-5, 0, 1, 10, 100):
+        sketch.add(value, 2)
+    restored = DDSketch.from_dict(loads(dumps(sketch.to_dict())))
+    assert restored.quantiles([0, 0.25, 0.5, 1]) == sketch.quantiles([0, 0.25, 0.5, 1])
+    assert restored.count == 10
+    assert DDSketch.from_dict(DDSketch().to_dict()).count == 0
+
+
+@mark.parametrize("n", [0, 10, 1000, 100_000])
+def test_hyperloglog(n):
+    hll = HyperLogLog()
+    for i in range(n):
+        hll.add(str(i))
+        hll.add(str(i))
+    assert hll.estimate() == approx(n, rel=0.05, abs=1)
+
+
+def test_hyperloglog_merge():
+    a = HyperLogLog()
+    b = HyperLogLog()
+    for i in range(1000):
+        a.add(str(i))
+        b.add(str(i + 500))
+    merged = a.copy()
+    merged.merge(b)
+    assert merged.estimate() == approx(1500, rel=0.05)
+    assert a.estimate() == approx(1000, rel=0.05)
+
+
+def test_hyperloglog_stable_hash():
+    # the registers of estimators in processes with different str hash seeds can be merged
+    code = "from yellowbox_statsd.sketches import HyperLogLog\nh = HyperLogLog()\nh.add('a')\nprint(h._registers.hex())"
+    registers = {
+        run(  # noqa: S603
+            [sys.executable, "-c", code],
+            env={**os.environ, "PYTHONHASHSEED": seed, "PYTHONPATH": os.pathsep.join(sys.path)},
+            capture_output=True,
+            check=True,
+        ).stdout.strip()
+        for seed in ("1", "2")
+    }
+    hll = HyperLogLog()
+    hll.add("a")
+    assert registers == {hll._registers.hex().encode()}  # noqa: SLF001
@@ -0,0 +1,31 @@
+from yellowbox_statsd.stats import LatencyHistogram, ServiceStats
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for ns in (100, 1000, 1000, 5000):
+        histogram.record(ns)
+    assert histogram.count == 4
+    assert histogram.max_ns == 5000
+    assert histogram.percentile_ns(50) == 1024
+    assert histogram.percentile_ns(100) == 5000
+    exported = histogram.as_dict()
+    assert exported["mean_us"] == 1.775
+    assert exported["buckets"] == {128: 1, 1024: 2, 8192: 1}
+
+
+def test_service_stats_merge():
+    a = ServiceStats()
+    a.datagrams = 2
+    a.latency("parse").record(10)
+    b = ServiceStats()
+    b.datagrams = 3
+    b.kernel_drops = 1
+    b.latency("parse").record(20)
+    b.latency("recv").record(30)
+    a.merge(b)
+    exported = a.as_dict()
+    assert exported["datagrams"] == 5
+    assert exported["kernel_drops"] == 1
+    assert list(exported["latencies"]) == ["parse", "recv"]
+    assert exported["latencies"]["parse"]["count"] == 2
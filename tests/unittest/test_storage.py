@@ -0,0 +1,111 @@
+import mmap
+from pickle import dumps, loads
+from unittest.mock import patch
+
+from pytest import raises
+
+from yellowbox_statsd.metrics import CapturedMetricsCollection, Metric, MetricTags
+
+
+def mk_collection():
+    collection = CapturedMetricsCollection()
+    collection.extend(
+        Metric.parse_datagram(
+            b"a.count:1|c|#route:/x,env:prod\n"
+            b"a.count:2|c|@0.5|#route:/y,env:prod\n"
+            b"a.count:3|c\n"
+            b"a.gauge:5|g|#env:prod\n"
+            b"a.gauge:+2|g|#env:prod|c:abc\n"
+            b"a.timing:10:20:30|ms|#route:/x|T1700000000\n"
+            b"a.timing:40|ms|#route:/y\n"
+            b"a.set:1|s\n"
+            b"a.set:1.2.3|s"
+        )
+    )
+    return collection
+
+
+def test_save_load(tmp_path):
+    path = tmp_path / "capture.bin"
+    collection = mk_collection()
+    collection.save(path)
+    loaded = CapturedMetricsCollection.load(path)
+    assert set(loaded) == set(collection)
+    assert loaded.metrics_count() == collection.metrics_count()
+    for key, series in collection.items():
+        assert type(loaded[key]) is type(series)
+        assert list(loaded[key]) == list(series)
+        assert loaded[key]._received == series._received  # noqa: SLF001
+
+
+def test_load_lazily(tmp_path):
+    path = tmp_path / "capture.bin"
+    mk_collection().save(path)
+    loaded = CapturedMetricsCollection.load(path)
+    count = loaded.count("a.count")
+    assert len(count) == 3
+    assert count.total() == 8
+    assert count.filter(env="prod").total() == 5
+    assert count.tag_values("route") == ["/x", "/y"]
+    assert loaded.gauge("a.gauge").last() == 7
+    timing = loaded.timing("a.timing")
+    assert timing.max() == 40
+    assert timing.percentile(50) == timing.sketch().quantile(0.5)
+    assert timing.filter(route="/x").percentile(100) == 30
+    # only the accessed series were materialized, by the filters
+    assert timing._loader is None  # noqa: SLF001
+    assert loaded.gauge("a.gauge")._loader is not None  # noqa: SLF001
+    with raises(ValueError):
+        loaded.set("a.set").unique_count()
+
+
+def test_load_materialized(tmp_path):
+    path = tmp_path / "capture.bin"
+    collection = mk_collection()
+    collection.save(path)
+    loaded = CapturedMetricsCollection.load(path)
+    gauge = loaded.gauge("a.gauge")
+    assert gauge[-1].container_id == "abc"
+    assert gauge[0].tags is MetricTags.interned(["env:prod"])
+    assert loaded.timing("a.timing")[0].metric_timestamp == 1700000000
+    assert loaded.count("a.count")[1].sample_rate == 0.5
+    loaded.extend(Metric.parse_datagram(b"a.gauge:1|g\na.count:4|c"))
+    assert gauge.last() == 1
+    assert [m.values for m in gauge] == [["5"], ["+2"], ["1"]]
+    assert loaded.count("a.count").total() == 12
+    assert loads(dumps(loaded)).count("a.count").total() == 12  # noqa: S301
+
+
+def test_load_closes_mapping(tmp_path):
+    path = tmp_path / "capture.bin"
+    mk_collection().save(path)
+    mappings = []
+    real_mmap = mmap.mmap
+
+    def mapping(*args, **kwargs):
+        ret = real_mmap(*args, **kwargs)
+        mappings.append(ret)
+        return ret
+
+    with patch.object(mmap, "mmap", side_effect=mapping):
+        loaded = CapturedMetricsCollection.load(path)
+    (mapped,) = mappings
+    for series in list(loaded.values())[:-1]:
+        list(series)
+        assert not mapped.closed
+    list(list(loaded.values())[-1])
+    assert mapped.closed
+    assert loaded.count("a.count")[0].values == ["1"]
+
+
+def test_load_empty(tmp_path):
+    path = tmp_path / "capture.bin"
+    CapturedMetricsCollection().save(path)
+    assert CapturedMetricsCollection.load(path) == {}
+
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / "capture.bin"
+    path.write_bytes(b"hello")
+    with raises(ValueError):
+        CapturedMetricsCollection.load(path)
@@ -1,4 +1,6 @@
-from yellowbox_statsd.metrics import MetricTags
+import pickle
+
+from yellowbox_statsd.metrics import Metric, MetricTags
 
 
 def test_metric_tags():
@@ -21,3 +23,33 @@ def test_metric_tags():
     assert set(tags.keys()) == set(dict_to_match.keys())
     assert set(tags.values()) == set(dict_to_match.values())
     assert set(tags.items()) == set(dict_to_match.items())
+
+
+def test_metric_tags_interned():
+    tags = MetricTags.interned(["tag1:a", "tag2"])
+    assert MetricTags.interned(["tag2", "tag1:a", "tag2"]) is tags
+    assert tags == MetricTags(["tag1:a", "tag2"])
+    assert Metric.parse("a:1|c|#tag2,tag1:a").tags is tags
+    assert Metric.parse_bytes(b"a:1|c|#tag1:a,tag2").tags is tags
+
+
+def test_metric_tags_lazy_index():
+    tags = MetricTags(["tag1:a", "tag1:b"])
+    assert not hasattr(tags, "_assigned")
+    assert tags["tag1"] == frozenset(["a", "b"])
+    assert tags.assigned is tags.assigned
+
+
+def test_metric_tags_pickle():
+    tags = MetricTags(["tag1:a", "tag2"])
+    assert tags["tag1"] == frozenset(["a"])
+    loaded = pickle.loads(pickle.dumps(tags))  # noqa: S301
+    assert type(loaded) is MetricTags
+    assert loaded == tags
+    assert loaded["tag1"] == frozenset(["a"])
+
+
+def test_metric_tags_pickle_interned():
+    tags = MetricTags.interned(["tag1:a", "tag2"])
+    assert pickle.loads(pickle.dumps(tags)) is tags  # noqa: S301
+    assert pickle.loads(pickle.dumps(MetricTags(["tag2", "tag1:a"]))) is tags  # noqa: S301
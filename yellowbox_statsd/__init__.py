@@ -1,4 +1,5 @@
 from yellowbox_statsd._version import __version__
+from yellowbox_statsd.async_statsd import AsyncStatsdService
 from yellowbox_statsd.statsd import StatsdService
 
-__all__ = ["StatsdService", "__version__"]
+__all__ = ["AsyncStatsdService", "StatsdService", "__version__"]
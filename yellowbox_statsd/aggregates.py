@@ -0,0 +1,362 @@
+from __future__ import annotations
+
+from itertools import product
+from typing import (
+    Any,
+    ClassVar,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    overload,
+)
+
+from yellowbox_statsd.metrics import CapturedMetric, MetricsCollectionBase, MetricTags, _tags_to_match
+from yellowbox_statsd.sketches import DDSketch, HyperLogLog
+
+A = TypeVar("A", bound="Aggregate")
+
+
+class Aggregate:
+    """
+    The running aggregate of all the metrics of a single name, type and tag set, in constant memory.
+    """
+
+    def __init__(self):
+        self.metrics_count = 0
+        # the first value that could not be parsed as a number, values are only validated when queried
+        self.invalid_value: Optional[str] = None
+
+    def add(self, metric: CapturedMetric, sequence: int) -> None:
+        self.metrics_count += 1
+        sample_rate = metric.sample_rate or 1.0
+        for value in metric.values:
+            try:
+                number = float(value)
+            except ValueError:
+                if self.invalid_value is None:
+                    self.invalid_value = value
+                continue
+            self._add_value(value, number, 1 / sample_rate, sequence)
+
+    def _add_value(self, value: str, number: float, weight: float, sequence: int) -> None:
+        pass
+
+    def merge(self: A, other: A) -> None:
+        self.metrics_count += other.metrics_count
+        if self.invalid_value is None:
+            self.invalid_value = other.invalid_value
+
+    def copy(self: A) -> A:
+        ret = type(self)()
+        ret.merge(self)
+        return ret
+
+    def validate(self) -> None:
+        if self.invalid_value is not None:
+            # raise the same error the value would have raised when parsed
+            float(self.invalid_value)
+
+
+class CountAggregate(Aggregate):
+    def __init__(self):
+        super().__init__()
+        self.total = 0.0
+
+    def _add_value(self, value: str, number: float, weight: float, sequence: int) -> None:
+        self.total += number * weight
+
+    def merge(self, other: CountAggregate) -> None:
+        super().merge(other)
+        self.total += other.total
+
+
+class GaugeAggregate(Aggregate):
+    def __init__(self):
+        super().__init__()
+        self.last = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        # the sequence number of the last value, to find the latest gauge of multiple tag sets
+        self.last_sequence = -1
+
+    def _add_value(self, value: str, number: float, weight: float, sequence: int) -> None:
+        if value.startswith(("+", "-")):
+            self.last += number
+        else:
+            self.last = number
+        self.min = min(self.min, self.last)
+        self.max = max(self.max, self.last)
+        self.last_sequence = sequence
+
+    def merge(self, other: GaugeAggregate) -> None:
+        super().merge(other)
+        if other.last_sequence > self.last_sequence:
+            self.last = other.last
+            self.last_sequence = other.last_sequence
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+
+class HistogramAggregate(Aggregate):
+    def __init__(self):
+        super().__init__()
+        self.weighted_sum = 0.0
+        self.sketch = DDSketch()
+
+    def _add_value(self, value: str, number: float, weight: float, sequence: int) -> None:
+        self.weighted_sum += number * weight
+        self.sketch.add(number, weight)
+
+    def merge(self, other: HistogramAggregate) -> None:
+        super().merge(other)
+        self.weighted_sum += other.weighted_sum
+        self.sketch.merge(other.sketch)
+
+
+class SetAggregate(Aggregate):
+    def __init__(self):
+        super().__init__()
+        self.distinct = HyperLogLog()
+
+    def _add_value(self, value: str, number: float, weight: float, sequence: int) -> None:
+        # values are distinct by their number, like in SetCapturedMetric.unique
+        self.distinct.add(repr(number))
+
+    def merge(self, other: SetAggregate) -> None:
+        super().merge(other)
+        self.distinct.merge(other.distinct)
+
+
+Self = TypeVar("Self", bound="AggregatedMetrics")
+
+
+class AggregatedMetrics(Generic[A]):
+    """
+    The aggregates of metrics of the same name and type, by their tag sets. Queries merge the aggregates of all the
+    tag sets, filter and split select tag sets, like their counterparts in CapturedMetrics.
+    """
+
+    AGGREGATE_CLASS: ClassVar[Type[Aggregate]] = Aggregate
+
+    def __init__(self, aggregates: Optional[Mapping[Optional[MetricTags], A]] = None):
+        self.aggregates: Dict[Optional[MetricTags], A] = dict(aggregates or {})
+        self._sequence = 0
+
+    def append(self, metric: CapturedMetric) -> None:
+        aggregate = self.aggregates.get(metric.tags)
+        if aggregate is None:
+            aggregate = self.aggregates[metric.tags] = self.AGGREGATE_CLASS()  # type: ignore[assignment]
+        aggregate.add(metric, self._sequence)
+        self._sequence += 1
+
+    def _append_received(self, metric: CapturedMetric, received_at: float) -> None:
+        # aggregates don't keep the times that metrics were received at
+        self.append(metric)
+
+    def __len__(self) -> int:
+        return sum(aggregate.metrics_count for aggregate in list(self.aggregates.values()))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.aggregates!r})"
+
+    def merged(self) -> A:
+        """
+        A single aggregate of all the tag sets.
+        """
+        ret: A = self.AGGREGATE_CLASS()  # type: ignore[assignment]
+        for aggregate in list(self.aggregates.values()):
+            ret.merge(aggregate)
+        ret.validate()
+        return ret
+
+    def _select(self: Self, tag_sets: Iterable[Optional[MetricTags]]) -> Self:
+        # the aggregates are copied, so that the result is not updated as new metrics arrive
+        return type(self)({tag_set: self.aggregates[tag_set].copy() for tag_set in tag_sets})
+
+    def _tag_sets(self) -> List[MetricTags]:
+        return [t for t in list(self.aggregates) if t is not None]
+
+    def tags(self) -> Iterable[str]:
+        s: Set[str] = set()
+        for tag_set in self._tag_sets():
+            s.update(tag_set)
+        return sorted(s)
+
+    def tag_values(self, tag: str) -> Iterable[str]:
+        s: Set[str] = set()
+        for tag_set in self._tag_sets():
+            s.update(tag_set[tag])
+        return sorted(s)
+
+    def filter(
+        self: Self, *extra_tags, tags: Union[Iterable[str], Mapping[str, str]] = (), **extra_tags_assigned
+    ) -> Self:
+        tags_to_match = _tags_to_match(extra_tags, tags, extra_tags_assigned)
+        return self._select(
+            t for t in list(self.aggregates) if (tags_to_match.issubset(t) if t is not None else not tags_to_match)
+        )
+
+    def filter_not(
+        self: Self, *extra_tags, tags: Union[Iterable[str], Mapping[str, str]] = (), **extra_tags_assigned
+    ) -> Self:
+        tags_to_match = _tags_to_match(extra_tags, tags, extra_tags_assigned)
+        return self._select(
+            t for t in list(self.aggregates) if not (tags_to_match.issubset(t) if t is not None else not tags_to_match)
+        )
+
+    @overload
+    def split(self: Self, tag: str) -> Dict[Optional[str], Self]: ...
+
+    @overload
+    def split(self: Self, tag: Tuple[str, ...]) -> Dict[Tuple[Optional[str], ...], Self]: ...
+
+    def split(self: Self, tag: Union[str, Tuple[str, ...]]) -> Dict[Any, Self]:
+        if isinstance(tag, str):
+
+            def get_keys(tags: MetricTags):
+                return tags.get(tag, ())
+
+        else:
+
+            def get_keys(tags: MetricTags):
+                return product(*(tags.get(t, ()) for t in tag))
+
+        tag_sets_by_key: Dict[Any, List[Optional[MetricTags]]] = {}
+        for tag_set in self._tag_sets():
+            for key in get_keys(tag_set):
+                tag_sets_by_key.setdefault(key, []).append(tag_set)
+        return {key: self._select(tag_sets) for key, tag_sets in tag_sets_by_key.items()}
+
+
+class AggregatedCountMetric(AggregatedMetrics[CountAggregate]):
+    AGGREGATE_CLASS = CountAggregate
+
+    def total(self) -> float:
+        return self.merged().total
+
+
+class AggregatedHistogramMetric(AggregatedMetrics[HistogramAggregate]):
+    AGGREGATE_CLASS = HistogramAggregate
+
+    def avg(self) -> float:
+        merged = self.merged()
+        return merged.weighted_sum / merged.sketch.count
+
+    def min(self) -> float:
+        merged = self.merged()
+        if not merged.sketch.count:
+            raise ValueError("min of an empty aggregate")
+        return merged.sketch.min
+
+    def max(self) -> float:
+        merged = self.merged()
+        if not merged.sketch.count:
+            raise ValueError("max of an empty aggregate")
+        return merged.sketch.max
+
+    def sketch(self) -> DDSketch:
+        return self.merged().sketch
+
+    def percentile(self, p: float) -> float:
+        return self.sketch().quantile(p / 100)
+
+    def quantiles(self, n: int = 4) -> List[float]:
+        return self.sketch().quantiles(i / n for i in range(1, n))
+
+
+class AggregatedGaugeMetric(AggregatedMetrics[GaugeAggregate]):
+    AGGREGATE_CLASS = GaugeAggregate
+
+    def last(self) -> float:
+        return self.merged().last
+
+    def min(self, default: Optional[float] = None) -> float:
+        merged = self.merged()
+        if merged.last_sequence < 0:
+            if default is None:
+                raise ValueError("min of an empty aggregate")
+            return default
+        return merged.min
+
+    def max(self, default: Optional[float] = None) -> float:
+        merged = self.merged()
+        if merged.last_sequence < 0:
+            if default is None:
+                raise ValueError("max of an empty aggregate")
+            return default
+        return merged.max
+
+
+class AggregatedSetMetric(AggregatedMetrics[SetAggregate]):
+    AGGREGATE_CLASS = SetAggregate
+
+    def unique_count(self) -> float:
+        """
+        An estimate of the number of unique values, see HyperLogLog for its accuracy.
+        """
+        return self.merged().distinct.estimate()
+
+
+class AggregatedMetricsCollection(MetricsCollectionBase[AggregatedMetrics]):
+    """
+    A collection that only keeps running aggregates of the metrics of every name, type and tag set, rather than the
+    metrics themselves, so that its memory does not grow with the number of metrics captured.
+    Gauges of different tag sets are aggregated separately, so the min and max of a gauge over multiple tag sets is
+    the min and max of the individual tag sets, rather than of their interleaved values.
+    """
+
+    METRIC_TYPES_TO_CLASS: ClassVar[Dict[str, Type[AggregatedMetrics]]] = {
+        "c": AggregatedCountMetric,
+        "g": AggregatedGaugeMetric,
+        "ms": AggregatedHistogramMetric,
+        "h": AggregatedHistogramMetric,
+        "s": AggregatedSetMetric,
+        "d": AggregatedHistogramMetric,
+    }
+
+    def _new_capture(self, metric_type: str) -> AggregatedMetrics:
+        return self.METRIC_TYPES_TO_CLASS.get(metric_type, AggregatedMetrics)()
+
+    def count(self, name: str) -> AggregatedCountMetric:
+        return self[name, "c"]  # type: ignore[return-value]
+
+    def get_count(self, name: str, tags=(), **tags_kwargs) -> AggregatedCountMetric:
+        return self.get((name, "c"), AggregatedCountMetric()).filter(tags=tags, **tags_kwargs)  # type: ignore[return-value]
+
+    def gauge(self, name: str) -> AggregatedGaugeMetric:
+        return self[name, "g"]  # type: ignore[return-value]
+
+    def get_gauge(self, name: str, tags=(), **tags_kwargs) -> AggregatedGaugeMetric:
+        return self.get((name, "g"), AggregatedGaugeMetric()).filter(tags=tags, **tags_kwargs)  # type: ignore[return-value]
+
+    def histogram(self, name: str) -> AggregatedHistogramMetric:
+        return self[name, "h"]  # type: ignore[return-value]
+
+    def get_histogram(self, name: str, tags=(), **tags_kwargs) -> AggregatedHistogramMetric:
+        return self.get((name, "h"), AggregatedHistogramMetric()).filter(tags=tags, **tags_kwargs)  # type: ignore[return-value]
+
+    def set(self, name: str) -> AggregatedSetMetric:
+        return self[name, "s"]  # type: ignore[return-value]
+
+    def get_set(self, name: str, tags=(), **tags_kwargs) -> AggregatedSetMetric:
+        return self.get((name, "s"), AggregatedSetMetric()).filter(tags=tags, **tags_kwargs)  # type: ignore[return-value]
+
+    def timing(self, name: str) -> AggregatedHistogramMetric:
+        return self[name, "ms"]  # type: ignore[return-value]
+
+    def get_timing(self, name: str, tags=(), **tags_kwargs) -> AggregatedHistogramMetric:
+        return self.get((name, "ms"), AggregatedHistogramMetric()).filter(tags=tags, **tags_kwargs)  # type: ignore[return-value]
+
+    def distribution(self, name: str) -> AggregatedHistogramMetric:
+        return self[name, "d"]  # type: ignore[return-value]
+
+    def get_distribution(self, name: str, tags=(), **tags_kwargs) -> AggregatedHistogramMetric:
+        return self.get((name, "d"), AggregatedHistogramMetric()).filter(tags=tags, **tags_kwargs)  # type: ignore[return-value]
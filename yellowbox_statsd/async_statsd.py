@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+from asyncio import BaseTransport, DatagramProtocol, DatagramTransport, Task, ensure_future, gather, get_running_loop
+from contextlib import asynccontextmanager
+from inspect import isawaitable
+from traceback import print_exc, print_exception
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Literal,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    overload,
+)
+
+from yellowbox_statsd.aggregates import AggregatedMetricsCollection
+from yellowbox_statsd.dispatch import CallbackDispatcher
+from yellowbox_statsd.metrics import CapturedMetricsCollection
+from yellowbox_statsd.routing import CaptureFilter, CaptureRoute
+from yellowbox_statsd.statsd import StatsdServiceBase
+
+Self = TypeVar("Self", bound="AsyncStatsdService")
+
+
+class _StatsdProtocol(DatagramProtocol):
+    def __init__(self, service: AsyncStatsdService):
+        self.service = service
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        self.service._handle_batch((data,))  # noqa: SLF001
+
+
+class AsyncStatsdService(StatsdServiceBase):
+    """
+    A statsd service that listens on the running event loop, without a listener thread.
+    Metric and datagram callbacks may be either regular functions or coroutine functions, coroutines are scheduled as
+    tasks on the event loop. Coroutine callbacks can only be dispatched by a LoopCallbackDispatcher of the same loop.
+    """
+
+    transport: Optional[DatagramTransport]
+
+    def __init__(
+        self,
+        port: int = 0,
+        host="0.0.0.0",
+        parse_cache_size: Optional[int] = None,
+        callback_dispatcher: Optional[CallbackDispatcher] = None,
+    ):
+        super().__init__(port, host, parse_cache_size, callback_dispatcher)
+        self.transport = None
+        self._callback_tasks: Set[Task] = set()
+
+    async def start(self: Self) -> Self:
+        loop = get_running_loop()
+        transport: BaseTransport
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _StatsdProtocol(self), local_addr=(self.host, self.port)
+        )
+        self.transport = transport  # type: ignore[assignment]
+        if self.callback_dispatcher is not None:
+            self.callback_dispatcher.start()
+        if self.port == 0:
+            self.port = transport.get_extra_info("sockname")[1]
+        return self
+
+    async def stop(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self.callback_dispatcher is not None:
+            # stopping waits for the dispatcher's workers to call the queued callbacks, without blocking the loop
+            await get_running_loop().run_in_executor(None, self.callback_dispatcher.stop)
+        if self._callback_tasks:
+            # errors in callbacks were already reported when their tasks completed
+            await gather(*self._callback_tasks, return_exceptions=True)
+
+    def is_alive(self) -> bool:
+        return self.transport is not None
+
+    async def __aenter__(self: Self) -> Self:
+        if not self.is_alive():
+            await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+        return False
+
+    @overload
+    def capture(
+        self,
+        mode: Literal["raw"] = "raw",
+        *,
+        tag: Optional[str] = None,
+        container_id: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        names: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        tags: Union[Iterable[str], Mapping[str, str], None] = None,
+    ) -> AsyncContextManager[CapturedMetricsCollection]: ...
+
+    @overload
+    def capture(
+        self,
+        mode: Literal["aggregate"],
+        *,
+        tag: Optional[str] = None,
+        container_id: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        names: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        tags: Union[Iterable[str], Mapping[str, str], None] = None,
+    ) -> AsyncContextManager[AggregatedMetricsCollection]: ...
+
+    @asynccontextmanager
+    async def capture(  # noqa: PLR0913
+        self,
+        mode: str = "raw",
+        *,
+        tag: Optional[str] = None,
+        container_id: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        names: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        tags: Union[Iterable[str], Mapping[str, str], None] = None,
+    ) -> AsyncIterator[Any]:
+        cap = self._push_capture(
+            mode, CaptureRoute(tag, container_id, name_prefix), CaptureFilter(names, prefixes, types, tags)
+        )
+        try:
+            with self._entered_capture(cap):
+                yield cap
+        finally:
+            self._pop_capture(cap)
+
+    def _call_callback(self, callback: Callable[[Any], Any], arg: Any, description: str) -> None:
+        try:
+            result = callback(arg)
+        except Exception:  # noqa: BLE001
+            self._thread_stats().callback_errors += 1
+            print(f"unexpected error when calling {description}")  # noqa: T201
+            print_exc()
+            return
+        if isawaitable(result):
+            task = ensure_future(result)
+            self._callback_tasks.add(task)
+            task.add_done_callback(lambda t: self._on_callback_done(t, description))
+
+    def _on_callback_done(self, task: Task, description: str) -> None:
+        self._callback_tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self._thread_stats().callback_errors += 1
+            print(f"unexpected error when calling {description}")  # noqa: T201
+            print_exception(type(exc), exc, exc.__traceback__)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from asyncio import AbstractEventLoop
+from collections import deque
+from threading import Condition, Thread
+from traceback import print_exc
+from typing import Any, Callable, Deque, List, Tuple
+
+# what to do when a callback is dispatched while the queue is full:
+# * block: wait until the queue has room, stalling the listener (and letting the kernel drop datagrams instead)
+# * drop_oldest: drop the oldest queued callback to make room
+# * drop_newest: drop the callback being dispatched
+FULL_QUEUE_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+Job = Tuple[Callable[[Any], Any], Any]
+
+
+class CallbackDispatcher:
+    """
+    Calls the callbacks of a service outside of its listener, through a bounded queue, so that slow callbacks don't
+    stall the listener. Callbacks are queued per batch of metrics or datagrams.
+    Attributes:
+        full: the number of times a callback was dispatched while the queue was full.
+        dropped: the number of callbacks that were dropped because the queue was full.
+    """
+
+    def __init__(self, max_queue_size: int = 1024, full_policy: str = "block"):
+        if max_queue_size < 1:
+            raise ValueError("max_queue_size must be at least 1")
+        if full_policy not in FULL_QUEUE_POLICIES:
+            raise ValueError(f"unknown full queue policy {full_policy!r}, expected one of {FULL_QUEUE_POLICIES}")
+        self.max_queue_size = max_queue_size
+        self.full_policy = full_policy
+        self.full = 0
+        self.dropped = 0
+        self._queue: Deque[Job] = deque()
+        # notified whenever a job is queued or taken, and when the dispatcher stops
+        self._condition = Condition()
+        self._stopping = False
+
+    def submit(self, func: Callable[[Any], Any], arg: Any) -> None:
+        with self._condition:
+            if self._stopping:
+                return
+            if len(self._queue) >= self.max_queue_size:
+                self.full += 1
+                if self.full_policy == "drop_newest":
+                    self.dropped += 1
+                    return
+                if self.full_policy == "drop_oldest":
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._condition.wait_for(lambda: len(self._queue) < self.max_queue_size or self._stopping)
+                    if self._stopping:
+                        return
+            self._queue.append((func, arg))
+            self._condition.notify_all()
+            self._on_submit()
+
+    def _on_submit(self) -> None:
+        """
+        Called (under the condition's lock) whenever a job is queued.
+        """
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    @staticmethod
+    def _run(job: Job) -> None:
+        func, arg = job
+        try:
+            func(arg)
+        except Exception:  # noqa: BLE001
+            # the service reports errors in the callbacks themselves, this is only reached by errors in dispatching
+            print("unexpected error when dispatching callbacks")  # noqa: T201
+            print_exc()
+
+    def start(self) -> None:
+        self._stopping = False
+
+    def stop(self) -> None:
+        """
+        Stop accepting callbacks, callbacks that were already queued are still called.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+
+class ThreadCallbackDispatcher(CallbackDispatcher):
+    """
+    Calls callbacks in a pool of worker threads. Callbacks of different batches may be called concurrently if there is
+    more than one worker.
+    """
+
+    def __init__(self, workers: int = 1, max_queue_size: int = 1024, full_policy: str = "block"):
+        super().__init__(max_queue_size, full_policy)
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.workers = workers
+        self._threads: List[Thread] = []
+
+    def start(self) -> None:
+        super().start()
+        self._threads = [
+            Thread(target=self._work, daemon=True, name=f"statsd-callbacks-{i}") for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._stopping)
+                if not self._queue:
+                    return
+                job = self._queue.popleft()
+                self._condition.notify_all()
+            self._run(job)
+
+    def stop(self) -> None:
+        """
+        Stop accepting callbacks, and wait for the workers to call the callbacks that were already queued.
+        """
+        super().stop()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class LoopCallbackDispatcher(CallbackDispatcher):
+    """
+    Calls callbacks on an event loop, which may be running in another thread. The "block" policy must not be used when
+    callbacks are dispatched from the loop's own thread, since the queue can only be drained by the blocked loop.
+    """
+
+    def __init__(self, loop: AbstractEventLoop, max_queue_size: int = 1024, full_policy: str = "block"):
+        super().__init__(max_queue_size, full_policy)
+        self.loop = loop
+        self._drain_scheduled = False
+
+    def _on_submit(self) -> None:
+        # a single drain calls all the callbacks queued until it runs
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self.loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self) -> None:
+        with self._condition:
+            jobs = list(self._queue)
+            self._queue.clear()
+            self._drain_scheduled = False
+            self._condition.notify_all()
+        for job in jobs:
+            self._run(job)
@@ -1,10 +1,27 @@
 from __future__ import annotations
 
+import os
 import re
+from abc import ABC, abstractmethod
+from array import array
+from asyncio import (
+    AbstractEventLoop,
+    Event,
+    TimeoutError as asyncio_TimeoutError,
+    get_running_loop,
+    wait_for as asyncio_wait_for,
+)
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
-from itertools import chain, product
+from functools import lru_cache
+from itertools import chain, count, product
+from math import ceil, isnan, nan
+from threading import Condition
+from time import monotonic
 from typing import (
+    TYPE_CHECKING,
     Any,
+    Callable,
     ClassVar,
     Dict,
     FrozenSet,
@@ -14,8 +31,10 @@ from typing import (
     KeysView,
     List,
     Mapping,
+    NamedTuple,
     Optional,
     Set,
+    Sized,
     Tuple,
     Type,
     TypeVar,
@@ -24,20 +43,74 @@ from typing import (
     overload,
 )
 
+from yellowbox_statsd.sketches import DDSketch
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore[assignment]
+
+# the minimum number of values in a capture, for aggregations to be vectorized with numpy (if it is installed)
+NUMPY_MIN_SIZE = 4096
+
+# the maximum number of entries in each of the interning tables, tables that are full are cleared, so that high
+# cardinality tags don't grow them indefinitely
+INTERN_LIMIT = 16384
+
+# a unique generation for every rebuild of the columns of a capture, positions in a capture are only valid within its
+# generation
+_generations = count()
+
+# a predicate on the raw name of a metric line, lines whose names it rejects are skipped by the parser
+NameFilter = Callable[[bytes], bool]
+
+_K = TypeVar("_K")
+_V = TypeVar("_V")
+
+
+def _bounded_setdefault(d: Dict[_K, _V], key: _K, value: _V) -> _V:
+    ret = d.get(key)
+    if ret is not None:
+        return ret
+    if len(d) >= INTERN_LIMIT:
+        d.clear()
+    return d.setdefault(key, value)
+
 
 class MetricTags(FrozenSet[str]):
-    assigned: Dict[str, FrozenSet[str]]
+    __slots__ = ("_assigned",)
+    _assigned: Dict[str, FrozenSet[str]]
+
+    # interned tag sets by their canonical string
+    _interned: ClassVar[Dict[str, MetricTags]] = {}
 
-    def __new__(cls, tags: Iterable[str]):
-        ret = super().__new__(cls, tags)  # type: ignore[arg-type, type-var]
+    @classmethod
+    def interned(cls, tags: Iterable[str]) -> MetricTags:
+        """
+        Get a MetricTags of the tags, that is shared with all other interned MetricTags of the same tags.
+        """
+        ret = cls(tags)
+        return _bounded_setdefault(cls._interned, ",".join(sorted(ret)), ret)
+
+    def __reduce__(self):
+        # tags are interned when unpickled (such as when parsed in worker processes), the index is rebuilt lazily
+        return type(self).interned, (list(self),)
+
+    @property
+    def assigned(self) -> Dict[str, FrozenSet[str]]:
+        # most tags are never queried by key, so the index is only built when first needed
+        try:
+            return self._assigned
+        except AttributeError:
+            pass
         assigned: Dict[str, List[str]] = {}
-        for tag in ret:
+        for tag in self:
             key, sep, value = tag.partition(":")
             if not sep:
                 continue
             assigned.setdefault(key, []).append(value)
-        ret.assigned = {k: frozenset(v) for k, v in assigned.items()}
-        return ret
+        self._assigned = {k: frozenset(v) for k, v in assigned.items()}
+        return self._assigned
 
     def __getitem__(self, key) -> FrozenSet[str]:
         return self.assigned[key]
@@ -67,6 +140,60 @@ DOGSTATSD_PATTERN = re.compile(
 )
 
 
+def _char_classes(classes: Mapping[bytes, bytes]) -> bytes:
+    # a translation table that maps each character in a class to its representative, and all others to "!"
+    table = bytearray(b"!" * 256)
+    for chars, representative in classes.items():
+        for c in chars:
+            table[c] = ord(representative)
+    return bytes(table)
+
+
+_LETTERS = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_DIGITS = b"0123456789"
+# translation tables that reduce the ascii characters allowed by DOGSTATSD_PATTERN to a few representatives, so that
+# each component can be validated with a handful of calls to bytes methods
+_NAME_TABLE = _char_classes({_LETTERS + _DIGITS + b"_.": b"a"})
+_NUMBER_TABLE = _char_classes({_DIGITS + b".": b"0"})
+_VALUES_TABLE = _char_classes({_DIGITS: b"0", b".": b".", b":": b":", b"+-": b"+"})
+_TAGS_TABLE = _char_classes({_LETTERS: b"a", _DIGITS + b"_.-:/\\": b"0", b",": b","})
+_CONTAINER_TABLE = _char_classes({b"abcdefghijklmnopqrstuvwxyz" + _DIGITS: b"a"})
+
+
+def _is_number(raw: bytes) -> bool:
+    # [0-9][0-9.]*
+    return raw[:1].isdigit() and raw.translate(_NUMBER_TABLE).isdigit()
+
+
+def _are_values(raw: bytes) -> bool:
+    # [+-]?[0-9][0-9.]*(?::[+-]?[0-9][0-9.]*)*
+    if _is_number(raw):
+        # the common case of a single unsigned value
+        return True
+    # every value starts with an optional sign and then a digit, signs only appear at the start of a value
+    classes = b":" + raw.translate(_VALUES_TABLE)
+    return (
+        b"!" not in classes
+        and classes.count(b":") == classes.count(b":0") + classes.count(b":+0")
+        and classes.count(b"+") == classes.count(b":+")
+    )
+
+
+def _are_tags(raw: bytes) -> bool:
+    # [a-zA-Z][\w\-:./\\]*(?:,[a-zA-Z][\w\-:./\\]*)*
+    classes = b"," + raw.translate(_TAGS_TABLE)
+    return classes.count(b",") == classes.count(b",a") and classes.replace(b",", b"").isalnum()
+
+
+# interned tags by the raw tags section of the metric lines they were parsed from
+_TAGS_BY_RAW: Dict[bytes, MetricTags] = {}
+
+_MetricFields = Tuple[str, List[str], str, Optional[float], Optional["MetricTags"], Optional[int], Optional[str]]
+_FrozenMetricFields = Tuple[
+    str, Tuple[str, ...], str, Optional[float], Optional["MetricTags"], Optional[int], Optional[str]
+]
+
+
 @dataclass
 class Metric:
     name: str
@@ -88,12 +215,184 @@ class Metric:
         sample_rate_raw = match.group("sample_rate")
         sample_rate = float(sample_rate_raw) if sample_rate_raw is not None else None
         tags_raw = match.group("tags")
-        tags = MetricTags(set(tags_raw.split(","))) if tags_raw is not None else None
+        tags = MetricTags.interned(tags_raw.split(",")) if tags_raw is not None else None
         metric_timestamp_raw = match.group("time")
         metric_timestamp = int(metric_timestamp_raw) if metric_timestamp_raw is not None else None
         container_id = match.group("container")
         return cls(name, values, type, sample_rate, tags, metric_timestamp, container_id)
 
+    @staticmethod
+    def _parse_bytes_fields(line: bytes) -> Optional[_MetricFields]:  # noqa: PLR0911
+        """
+        Parse a well-formed ascii metric line into the fields of a Metric without the regex. Returns None if the line
+        is anything unusual, in which case the regex parser has the final word.
+        """
+        name, sep, rest = line.partition(b":")
+        if not sep or not name.translate(_NAME_TABLE).isalpha():
+            return None
+        values_raw, sep, rest = rest.partition(b"|")
+        if not sep or not _are_values(values_raw):
+            return None
+        type, sep, rest = rest.partition(b"|")
+        if not (type.isalpha() and type.islower()):
+            return None
+
+        sample_rate = None
+        tags = None
+        container_id = None
+        metric_timestamp = None
+        if sep:
+            # the optional sections must appear in this order, each at most once
+            stage = 0
+            for section in rest.split(b"|"):
+                prefix = section[:1]
+                if prefix == b"#" and stage < 2:  # noqa: PLR2004
+                    tags_raw = section[1:]
+                    # a tags section that was already seen was also already validated
+                    tags = _TAGS_BY_RAW.get(tags_raw)
+                    if tags is None:
+                        if not _are_tags(tags_raw):
+                            return None
+                        tags = _bounded_setdefault(
+                            _TAGS_BY_RAW, tags_raw, MetricTags.interned(tags_raw.decode().split(","))
+                        )
+                    stage = 2
+                elif prefix == b"@" and stage < 1:
+                    sample_rate_raw = section[1:]
+                    if not _is_number(sample_rate_raw) or sample_rate_raw.count(b".") > 1:
+                        return None
+                    sample_rate = float(sample_rate_raw)
+                    stage = 1
+                elif prefix == b"c" and section[1:2] == b":" and stage < 3:  # noqa: PLR2004
+                    container_raw = section[2:]
+                    if not container_raw.translate(_CONTAINER_TABLE).isalpha():
+                        return None
+                    container_id = container_raw.decode()
+                    stage = 3
+                elif prefix == b"T" and stage < 4:  # noqa: PLR2004
+                    timestamp_raw = section[1:]
+                    if not timestamp_raw.isdigit():
+                        return None
+                    metric_timestamp = int(timestamp_raw)
+                    stage = 4
+                else:
+                    return None
+        return (
+            name.decode(),
+            values_raw.decode().split(":"),
+            type.decode(),
+            sample_rate,
+            tags,
+            metric_timestamp,
+            container_id,
+        )
+
+    @classmethod
+    def parse_bytes(cls, line: bytes) -> Metric:
+        """
+        Parse a single metric line from raw bytes, equivalent to cls.parse(line.decode("utf-8")), but faster for
+        well-formed lines.
+        """
+        fields = cls._parse_bytes_fields(line)
+        if fields is None:
+            return cls.parse(line.decode("utf-8"))
+        return cls(*fields)
+
+    @classmethod
+    def parse_datagram(cls, data: bytes, name_filter: Optional[NameFilter] = None) -> List[Metric]:
+        """
+        Parse all the metrics in a datagram, equivalent to parsing each of the lines of the decoded datagram.
+        Args:
+            data: the datagram.
+            name_filter: if set, lines whose (raw) names are rejected by the filter are skipped before the rest of the
+                line is parsed.
+        Raises:
+            ValueError: if any of the lines are invalid.
+        """
+        ret = []
+        for line in data.strip().splitlines():
+            if name_filter is not None and not name_filter(line.partition(b":")[0]):
+                continue
+            fields = cls._parse_bytes_fields(line)
+            if fields is None:
+                return cls._parse_str_datagram(data, name_filter)
+            ret.append(cls(*fields))
+        return ret
+
+    @classmethod
+    def _parse_str_datagram(cls, data: bytes, name_filter: Optional[NameFilter] = None) -> List[Metric]:
+        # str and bytes disagree on some whitespace and line separators, so when falling back to the regex parser, we
+        # do so for the entire datagram
+        ret = [cls.parse(line) for line in str(data, "utf-8").strip().splitlines()]
+        if name_filter is not None:
+            ret = [metric for metric in ret if name_filter(metric.name.encode("utf-8"))]
+        return ret
+
+
+class MetricParseCache:
+    """
+    A bounded LRU cache of parsed metric lines, keyed by the raw bytes of the line. Services tend to send the same
+    lines over and over, repeated lines skip parsing and tags construction entirely.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self._cached_fields = lru_cache(maxsize)(self._immutable_fields)
+
+    @staticmethod
+    def _immutable_fields(line: bytes) -> Optional[_FrozenMetricFields]:
+        fields = Metric._parse_bytes_fields(line)  # noqa: SLF001
+        if fields is None:
+            return None
+        name, values, type, sample_rate, tags, metric_timestamp, container_id = fields
+        # the cached values are shared between all the metrics parsed from the same line, so they must not be mutable
+        return name, tuple(values), type, sample_rate, tags, metric_timestamp, container_id
+
+    def parse_datagram(self, data: bytes, name_filter: Optional[NameFilter] = None) -> List[Metric]:
+        """
+        Equivalent to Metric.parse_datagram(data, name_filter), each metric gets its own copy of the cached values.
+        """
+        ret = []
+        for line in data.strip().splitlines():
+            if name_filter is not None and not name_filter(line.partition(b":")[0]):
+                continue
+            fields = self._cached_fields(line)
+            if fields is None:
+                return Metric._parse_str_datagram(data, name_filter)  # noqa: SLF001
+            name, values, type, sample_rate, tags, metric_timestamp, container_id = fields
+            ret.append(Metric(name, list(values), type, sample_rate, tags, metric_timestamp, container_id))
+        return ret
+
+    @property
+    def hits(self) -> int:
+        return self._cached_fields.cache_info().hits
+
+    @property
+    def misses(self) -> int:
+        return self._cached_fields.cache_info().misses
+
+    def __len__(self) -> int:
+        return self._cached_fields.cache_info().currsize
+
+    def clear(self) -> None:
+        """
+        Empty the cache and reset its hit/miss counters.
+        """
+        self._cached_fields.cache_clear()
+
+
+def _tags_to_match(
+    extra_tags: Iterable[str], tags: Union[Iterable[str], Mapping[str, str]], extra_tags_assigned: Mapping[str, str]
+) -> FrozenSet[str]:
+    tags_to_match = set(chain(extra_tags, (f"{k}:{v}" for k, v in extra_tags_assigned.items())))
+    if isinstance(tags, Mapping):
+        tags_to_match.update(f"{k}:{v}" for k, v in tags.items())
+    else:
+        tags_to_match.update(tags)
+    return frozenset(tags_to_match)
+
 
 @dataclass
 class CapturedMetric:
@@ -106,11 +405,7 @@ class CapturedMetric:
     def tags_match(
         self, *extra_tags, tags: Union[Iterable[str], Mapping[str, str]] = (), **extra_tags_assigned
     ) -> bool:
-        tags_to_match = set(chain(extra_tags, (f"{k}:{v}" for k, v in extra_tags_assigned.items())))
-        if isinstance(tags, Mapping):
-            tags_to_match.update(f"{k}:{v}" for k, v in tags.items())
-        else:
-            tags_to_match.update(tags)
+        tags_to_match = _tags_to_match(extra_tags, tags, extra_tags_assigned)
         if self.tags is None:
             return not tags_to_match
         return tags_to_match.issubset(self.tags)
@@ -131,29 +426,397 @@ Self = TypeVar("Self", bound="CapturedMetrics")
 
 
 class CapturedMetrics(List[CapturedMetric]):
+    """
+    A list of captured metrics of the same name and type. Alongside the list, the numeric values of all the metrics
+    are kept in flat columns, parsed once as metrics are appended, so that aggregations don't need to re-parse them.
+    The positions of the metrics are also indexed by their tags, so that filtering and splitting only visit the
+    distinct tag sets of the metrics, rather than every metric.
+    """
+
+    _received: array[float]  # the time.monotonic() time that each metric was received (or appended) at
+    _values: array[float]  # the value of every value of every metric, in order
+    _sample_rates: array[float]  # the sample rate of the metric of each value
+    _offsets: array[int]  # the index of each metric's first value in the value columns
+    _invalid_value: Optional[str]  # the first value that could not be parsed as a number, stored as nan
+    _multi_valued: bool  # whether any of the metrics has more than one value
+    _positions_by_tags: Dict[Optional[MetricTags], List[int]]  # the positions of the metrics of each distinct tag set
+    _tag_sets_by_tag: Dict[str, List[MetricTags]]  # the distinct tag sets that include each tag
+    _indexed: int  # the number of metrics that were fully ingested, positions beyond it are still being ingested
+    # the tag sets that matched a filter, along with the number of metrics that were indexed when they were found
+    _filter_cache: Dict[Tuple[FrozenSet[str], bool], Tuple[int, List[Optional[MetricTags]]]]
+    # if set, the metrics of a loaded capture have not been materialized yet, only its columns and index were loaded
+    _loader: Optional[Callable[[], List[CapturedMetric]]]
+    _generation: int  # changed whenever the columns are rebuilt, rather than appended to
+
+    def __init__(self, metrics: Iterable[CapturedMetric] = ()):
+        super().__init__()
+        self._reset()
+        self.extend(metrics)
+
+    def __reduce__(self):
+        # the columns are rebuilt from the metrics when reconstructed, only the receive times are kept
+        return type(self), (list(self),), {"_received": self._received}
+
+    def _reset(self) -> None:
+        self._received = array("d")
+        self._values = array("d")
+        self._sample_rates = array("d")
+        self._offsets = array("q")
+        self._invalid_value = None
+        self._multi_valued = False
+        self._positions_by_tags = {}
+        self._tag_sets_by_tag = {}
+        self._indexed = 0
+        self._filter_cache = {}
+        self._loader = None
+        self._generation = next(_generations)
+
+    def _received_by_metric(self) -> Dict[int, float]:
+        """
+        The receive times of the metrics by their ids, to be restored after the list is mutated.
+        """
+        self._materialize()
+        return dict(zip(map(id, super().__iter__()), self._received))
+
+    def _rebuild(self, received: Dict[int, float]) -> None:
+        self._reset()
+        now = monotonic()
+        prev = float("-inf")
+        for metric in self:
+            # the receive times are kept in order, so that they can be searched, metrics that were inserted or moved
+            # are considered to be received no earlier than the metrics before them
+            prev = max(prev, received.get(id(metric), now))
+            self._ingest(metric, prev)
+
+    def _materialize(self) -> None:
+        loader = self._loader
+        if loader is not None:
+            self._loader = None
+            super().extend(loader())
+
+    def _ingest(self, metric: CapturedMetric, received_at: float) -> None:
+        self._received.append(received_at)
+        self._ingest_values(metric)
+        # indexing is the last step, so that indexed metrics are always fully ingested
+        self._index(metric)
+
+    def _ingest_values(self, metric: CapturedMetric) -> None:
+        self._offsets.append(len(self._values))
+        if len(metric.values) != 1:
+            self._multi_valued = True
+        sample_rate = metric.sample_rate or 1.0
+        for value in metric.values:
+            try:
+                number = float(value)
+            except ValueError:
+                # the metric pattern allows values such as "1.2.3", which only fail when aggregated
+                number = nan
+                if self._invalid_value is None:
+                    self._invalid_value = value
+            self._values.append(number)
+            self._sample_rates.append(sample_rate)
+
+    def _value_columns(self) -> Tuple[array, ...]:
+        """
+        All the columns that have an entry for every value.
+        """
+        return self._values, self._sample_rates
+
+    def _index(self, metric: CapturedMetric) -> None:
+        positions = self._positions_by_tags.get(metric.tags)
+        if positions is None:
+            positions = self._add_tag_set(metric.tags, [])
+        positions.append(self._indexed)
+        self._indexed += 1
+
+    def _matching_tag_sets(self, tags_to_match: FrozenSet[str], negate: bool) -> List[Optional[MetricTags]]:
+        if not tags_to_match:
+            return [] if negate else list(self._positions_by_tags)
+        if negate:
+            return [t for t in list(self._positions_by_tags) if t is None or not tags_to_match.issubset(t)]
+        # only the tag sets that include the rarest of the tags can match
+        candidates = min((self._tag_sets_by_tag.get(tag, ()) for tag in tags_to_match), key=len)
+        return [t for t in candidates if tags_to_match.issubset(t)]
+
+    def _cached_matching_tag_sets(
+        self, tags_to_match: FrozenSet[str], negate: bool
+    ) -> Tuple[int, List[Optional[MetricTags]]]:
+        indexed = self._indexed
+        cached = self._filter_cache.get((tags_to_match, negate))
+        if cached is None or cached[0] != indexed:
+            cached = self._filter_cache[tags_to_match, negate] = (
+                indexed,
+                self._matching_tag_sets(tags_to_match, negate),
+            )
+        return cached
+
+    def _filtered(self: Self, tags_to_match: FrozenSet[str], negate: bool) -> Self:
+        indexed, tag_sets = self._cached_matching_tag_sets(tags_to_match, negate)
+        return self._subset(tag_sets, indexed)
+
+    def _subset(self: Self, tag_sets: List[Optional[MetricTags]], indexed: int, start: int = 0) -> Self:
+        """
+        A new capture of the metrics with the given tag sets, with columns and index copied from this capture.
+        Only the metrics at positions from start up to `indexed` are included, so that all the results of a query are
+        consistent while metrics are being ingested. Subsets that start after the first metric (such as windows of
+        time) are of all the tag sets.
+        """
+        tag_positions = []
+        for tag_set in tag_sets:
+            positions = self._positions_by_tags[tag_set]
+            positions = positions[bisect_left(positions, start) : bisect_left(positions, indexed)]
+            if positions:
+                tag_positions.append((tag_set, positions))
+        # tag sets are ordered by their first metric, like they would be had the metrics been appended one by one
+        tag_positions.sort(key=lambda t: t[1][0])
+        positions = sorted(chain.from_iterable(p for _, p in tag_positions))
+        self._materialize()
+        metrics = list(map(super().__getitem__, positions))
+        ret = type(self)()
+        self._seed_subset(ret, start)
+        received = array("d", map(self._received.__getitem__, positions))
+        if self._invalid_value is not None:
+            # the values need to be re-parsed to know which of them are invalid
+            for metric, received_at in zip(metrics, received):
+                ret._append_received(metric, received_at)  # noqa: SLF001
+            return ret
+        list.extend(ret, metrics)
+        ret._received = received  # noqa: SLF001
+        self._copy_columns(ret, positions, metrics)
+        # the index of the subset is translated from this index, rather than built metric by metric
+        if len(tag_positions) == 1:
+            tag_set, _ = tag_positions[0]
+            ret._add_tag_set(tag_set, list(range(len(positions))))  # noqa: SLF001
+        else:
+            rank = dict(zip(positions, range(len(positions))))
+            for tag_set, tag_set_positions in tag_positions:
+                ret._add_tag_set(tag_set, list(map(rank.__getitem__, tag_set_positions)))  # noqa: SLF001
+        # only the tag sets whose metrics are all in the subset can share its state, the state of the others is
+        # rebuilt from the copied columns
+        complete = [
+            tag_set
+            for tag_set, tag_set_positions in tag_positions
+            if len(tag_set_positions) == len(self._positions_by_tags[tag_set])
+        ]
+        self._copy_tag_set_state(ret, complete, indexed)
+        ret._indexed = len(metrics)  # noqa: SLF001
+        ret._aggregate_columns()  # noqa: SLF001
+        return ret
+
+    def _seed_subset(self, target: CapturedMetrics, start: int) -> None:
+        """
+        Set up a subset of this capture that starts at position start, before any of its metrics are added.
+        """
+
+    def _copy_tag_set_state(self, target: CapturedMetrics, tag_sets: List[Optional[MetricTags]], indexed: int) -> None:
+        """
+        Copy any state that subclasses keep per tag set to a subset of this capture, for tag sets whose metrics are
+        all in the subset, up to position `indexed`. State that is not copied is rebuilt by _aggregate_columns.
+        """
+
+    def _copy_columns(self, target: CapturedMetrics, positions: List[int], metrics: List[CapturedMetric]) -> None:
+        if self._multi_valued:
+            offsets = self._offsets
+            value_positions: List[int] = []
+            for i, metric in zip(positions, metrics):
+                target._offsets.append(len(value_positions))
+                start = offsets[i]
+                value_positions.extend(range(start, start + len(metric.values)))
+            target._multi_valued = True
+        else:
+            value_positions = positions
+            target._offsets = array("q", range(len(positions)))
+        for column, target_column in zip(self._value_columns(), target._value_columns()):
+            target_column.extend(array(column.typecode, map(column.__getitem__, value_positions)))
+
+    def _aggregate_columns(self) -> None:
+        """
+        Recompute the running aggregates of the capture from its columns and index, for captures whose columns were
+        copied or loaded, rather than ingested metric by metric.
+        """
+
+    def _value_positions(self, positions: Iterable[int]) -> List[int]:
+        """
+        The positions in the value columns of the values of the metrics at the given positions.
+        """
+        if not self._multi_valued:
+            return list(positions)
+        offsets = self._offsets
+        ends = [*offsets[1:], len(self._values)]
+        return [j for i in positions for j in range(offsets[i], ends[i])]
+
+    def _add_tag_set(self, tag_set: Optional[MetricTags], positions: List[int]) -> List[int]:
+        self._positions_by_tags[tag_set] = positions
+        for tag in tag_set or ():
+            self._tag_sets_by_tag.setdefault(tag, []).append(tag_set)  # type: ignore[arg-type]
+        return positions
+
+    def _numeric_values(self) -> array[float]:
+        if self._invalid_value is not None:
+            # raise the same error the value would have raised when parsed
+            float(self._invalid_value)
+        return self._values
+
+    def _numpy_columns(self, *columns: array) -> Optional[Tuple[Any, ...]]:
+        """
+        Copies of the columns as numpy arrays, or None if numpy is not available or the columns are too small to
+        benefit from it.
+        """
+        if np is None or len(self._values) < NUMPY_MIN_SIZE:
+            return None
+        # the arrays are copied, a view of an array would prevent it from being appended to by the listener
+        return tuple(np.frombuffer(column.tobytes(), dtype=np.float64) for column in columns)
+
+    def _append_received(self, metric: CapturedMetric, received_at: float) -> None:
+        self._materialize()
+        super().append(metric)
+        self._ingest(metric, received_at)
+
+    def append(self, metric: CapturedMetric) -> None:
+        self._append_received(metric, monotonic())
+
+    def extend(self, metrics: Iterable[CapturedMetric]) -> None:
+        for metric in metrics:
+            self.append(metric)
+
+    def __iadd__(self: Self, metrics: Iterable[CapturedMetric]) -> Self:  # type: ignore[override, misc]
+        self.extend(metrics)
+        return self
+
+    # any other mutation rebuilds the columns from scratch
+
+    def __setitem__(self, index, value) -> None:
+        received = self._received_by_metric()
+        super().__setitem__(index, value)
+        self._rebuild(received)
+
+    def __delitem__(self, index) -> None:
+        received = self._received_by_metric()
+        super().__delitem__(index)
+        self._rebuild(received)
+
+    def __imul__(self: Self, n: int) -> Self:  # type: ignore[override, misc]
+        received = self._received_by_metric()
+        super().__imul__(n)
+        self._rebuild(received)
+        return self
+
+    def insert(self, index, metric: CapturedMetric) -> None:
+        received = self._received_by_metric()
+        super().insert(index, metric)
+        self._rebuild(received)
+
+    def pop(self, index=-1) -> CapturedMetric:
+        received = self._received_by_metric()
+        ret = super().pop(index)
+        self._rebuild(received)
+        return ret
+
+    def remove(self, metric: CapturedMetric) -> None:
+        received = self._received_by_metric()
+        super().remove(metric)
+        self._rebuild(received)
+
+    def clear(self) -> None:
+        super().clear()
+        self._reset()
+
+    def sort(self, *args, **kwargs) -> None:
+        received = self._received_by_metric()
+        super().sort(*args, **kwargs)
+        self._rebuild(received)
+
+    def reverse(self) -> None:
+        received = self._received_by_metric()
+        super().reverse()
+        self._rebuild(received)
+
+    # reading the list materializes the metrics of a loaded capture first
+
+    def __len__(self) -> int:
+        if self._loader is not None:
+            return len(self._offsets)
+        return super().__len__()
+
+    def __iter__(self) -> Iterator[CapturedMetric]:
+        self._materialize()
+        return super().__iter__()
+
+    def __reversed__(self) -> Iterator[CapturedMetric]:
+        self._materialize()
+        return super().__reversed__()
+
+    def __getitem__(self, index):
+        self._materialize()
+        return super().__getitem__(index)
+
+    def __contains__(self, metric) -> bool:
+        self._materialize()
+        return super().__contains__(metric)
+
+    def __eq__(self, other) -> bool:
+        self._materialize()
+        if isinstance(other, CapturedMetrics):
+            other._materialize()
+        return super().__eq__(other)
+
+    def __ne__(self, other) -> bool:
+        return not self == other
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        self._materialize()
+        return super().__repr__()
+
+    def index(self, *args) -> int:
+        self._materialize()
+        return super().index(*args)
+
+    def count(self, metric) -> int:
+        self._materialize()
+        return super().count(metric)
+
+    def copy(self) -> List[CapturedMetric]:
+        self._materialize()
+        return super().copy()
+
+    def __add__(self, other):
+        self._materialize()
+        return super().__add__(other)
+
+    def __mul__(self, n):
+        self._materialize()
+        return super().__mul__(n)
+
+    __rmul__ = __mul__
+
+    def _tag_sets(self) -> Iterator[MetricTags]:
+        return (t for t in list(self._positions_by_tags) if t is not None)
+
     def tags(self) -> Iterable[str]:
         s: Set[str] = set()
-        for m in self:
-            if m.tags is not None:
-                s.update(m.tags)
+        for tag_set in self._tag_sets():
+            s.update(tag_set)
         return sorted(s)
 
     def tag_values(self, tag: str) -> Iterable[str]:
         s: Set[str] = set()
-        for m in self:
-            if m.tags is not None:
-                s.update(m.tags[tag])
+        for tag_set in self._tag_sets():
+            s.update(tag_set[tag])
         return sorted(s)
 
     def filter(
         self: Self, *extra_tags, tags: Union[Iterable[str], Mapping[str, str]] = (), **extra_tags_assigned
     ) -> Self:
-        return type(self)(m for m in self if m.tags_match(*extra_tags, tags=tags, **extra_tags_assigned))
+        tags_to_match = _tags_to_match(extra_tags, tags, extra_tags_assigned)
+        return self._filtered(tags_to_match, negate=False)
 
     def filter_not(
         self: Self, *extra_tags, tags: Union[Iterable[str], Mapping[str, str]] = (), **extra_tags_assigned
     ) -> Self:
-        return type(self)(m for m in self if not m.tags_match(*extra_tags, tags=tags, **extra_tags_assigned))
+        tags_to_match = _tags_to_match(extra_tags, tags, extra_tags_assigned)
+        return self._filtered(tags_to_match, negate=True)
 
     @overload
     def split(self: Self, tag: str) -> Dict[Optional[str], Self]: ...
@@ -164,120 +827,565 @@ class CapturedMetrics(List[CapturedMetric]):
     def split(self: Self, tag: Union[str, Tuple[str, ...]]) -> Dict[Any, Self]:
         if isinstance(tag, str):
 
-            def get_keys(metric: CapturedMetric):
-                return metric.tags.get(tag, ()) if metric.tags is not None else ()
+            def get_keys(tags: MetricTags):
+                return tags.get(tag, ())
 
         else:
 
-            def get_keys(metric: CapturedMetric):
-                return product(*(metric.tags.get(t, ()) for t in tag)) if metric.tags is not None else ()
+            def get_keys(tags: MetricTags):
+                return product(*(tags.get(t, ()) for t in tag))
 
-        ret: Dict[Any, Self] = {}
-        for metric in self:
-            keys = get_keys(metric)
-            for key in keys:
-                cm = ret.get(key)
-                if cm is None:
-                    cm = ret[key] = type(self)()
-                cm.append(metric)
-        return ret
+        indexed = self._indexed
+        tag_sets_by_key: Dict[Any, List[Optional[MetricTags]]] = {}
+        for tag_set in self._tag_sets():
+            for key in get_keys(tag_set):
+                tag_sets_by_key.setdefault(key, []).append(tag_set)
+        return {key: self._subset(tag_sets, indexed) for key, tag_sets in tag_sets_by_key.items()}
 
     def unbunch(self: Self) -> Self:
-        return type(self)(chain.from_iterable(m.unbunch() for m in self))
+        ret = type(self)()
+        for metric, received_at in zip(self, self._received):
+            for unbunched in metric.unbunch():
+                ret._append_received(unbunched, received_at)  # noqa: SLF001
+        return ret
+
+    def _received_range(self, start: float, end: float, lo: int = 0) -> Tuple[int, int]:
+        # the positions of the indexed metrics that were received in [start, end)
+        indexed = self._indexed
+        lo = bisect_left(self._received, start, lo, indexed)
+        return lo, bisect_left(self._received, end, lo, indexed)
+
+    def between(self: Self, start: float, end: float) -> Self:
+        """
+        The metrics that were received from start (inclusive) to end (exclusive), in seconds of time.monotonic().
+        """
+        lo, hi = self._received_range(start, end)
+        return self._subset(list(self._positions_by_tags), hi, lo)
+
+    def rate(self, window: float, end: Optional[float] = None) -> float:
+        """
+        The number of metrics received per second, in the window seconds before end (by default, now).
+        """
+        if end is None:
+            end = monotonic()
+        lo, hi = self._received_range(end - window, end)
+        return (hi - lo) / window
+
+    def resample(
+        self: Self, bucket: float, start: Optional[float] = None, end: Optional[float] = None
+    ) -> List[Tuple[float, Self]]:
+        """
+        Split the metrics into consecutive buckets of bucket seconds by the time they were received.
+        Args:
+            bucket: the length of every bucket, in seconds.
+            start: the start of the first bucket, by default the time the first metric was received.
+            end: the end of the last bucket, by default the bucket of the last metric.
+        Returns:
+            The start of every bucket, along with the metrics that were received in it. Empty buckets are included.
+            If start is not given and there are no metrics, there are no buckets.
+        """
+        if bucket <= 0:
+            raise ValueError("bucket must be positive")
+        indexed = self._indexed
+        tag_sets = list(self._positions_by_tags)
+        if start is None:
+            if not indexed:
+                return []
+            start = self._received[0]
+        if end is not None:
+            count = ceil((end - start) / bucket)
+        elif indexed:
+            count = int((self._received[indexed - 1] - start) // bucket) + 1
+        else:
+            count = 0
+        ret = []
+        lo = 0
+        for i in range(count):
+            bucket_start = start + i * bucket
+            lo, hi = self._received_range(bucket_start, bucket_start + bucket, lo)
+            ret.append((bucket_start, self._subset(tag_sets, hi, lo)))
+            lo = hi
+        return ret
 
 
 class CountCapturedMetric(CapturedMetrics):
+    """
+    Captured counts. The total of the counts, corrected by their sample rates, is kept as they are captured, both of
+    all the counts and of each tag set, so that polling the total doesn't go over every count.
+    """
+
+    _total: float
+    _totals: Dict[Optional[MetricTags], float]
+
+    def _reset(self) -> None:
+        super()._reset()
+        self._total = 0.0
+        self._totals = {}
+
+    def _ingest_values(self, metric: CapturedMetric) -> None:
+        super()._ingest_values(metric)
+        sample_rate = metric.sample_rate or 1.0
+        total = self._total
+        tag_set_total = self._totals.get(metric.tags, 0.0)
+        for value in self._values[self._offsets[-1] :]:
+            weighted = value / sample_rate
+            total += weighted
+            tag_set_total += weighted
+        self._totals[metric.tags] = tag_set_total
+        self._total = total
+
+    def _aggregate_columns(self) -> None:
+        columns = self._numpy_columns(self._values, self._sample_rates)
+        if columns is not None:
+            values, sample_rates = columns
+            weighted = values / sample_rates
+            self._total = float(weighted.sum())
+            self._totals = {
+                tag_set: float(weighted[self._value_positions(positions)].sum())
+                for tag_set, positions in self._positions_by_tags.items()
+            }
+            return
+        weighted_list = [v / r for v, r in zip(self._values, self._sample_rates)]
+        self._total = sum(weighted_list)
+        self._totals = {
+            tag_set: sum(map(weighted_list.__getitem__, self._value_positions(positions)))
+            for tag_set, positions in self._positions_by_tags.items()
+        }
+
     def total(self) -> float:
-        return sum(float(v) / (m.sample_rate or 1.0) for m in self for v in m.values)
+        self._numeric_values()
+        return self._total
+
+    def rate(self, window: float, end: Optional[float] = None) -> float:
+        """
+        The total of the counts received per second, in the window seconds before end (by default, now).
+        """
+        if end is None:
+            end = monotonic()
+        return self.between(end - window, end).total() / window
+
+    def filtered_total(
+        self, *extra_tags, tags: Union[Iterable[str], Mapping[str, str]] = (), **extra_tags_assigned
+    ) -> float:
+        """
+        Equivalent to filter(...).total() (up to floating point rounding), summed from the totals of the matching tag
+        sets, without copying the metrics.
+        """
+        self._numeric_values()
+        tags_to_match = _tags_to_match(extra_tags, tags, extra_tags_assigned)
+        _, tag_sets = self._cached_matching_tag_sets(tags_to_match, negate=False)
+        return sum(self._totals.get(tag_set, 0.0) for tag_set in tag_sets)
 
 
 class HistogramCapturedMetric(CapturedMetrics):
+    """
+    Captured histograms, timings or distributions. Alongside the values, a DDSketch of the values of each tag set is
+    kept, to estimate percentiles within a relative error of SKETCH_RELATIVE_ACCURACY.
+    """
+
+    SKETCH_RELATIVE_ACCURACY: ClassVar[float] = 0.01
+
+    _sketches: Dict[Optional[MetricTags], DDSketch]
+    # running aggregates of all the values, the sums are corrected by the sample rates
+    _weighted_sum: float
+    _weighted_count: float
+    _min: float
+    _max: float
+
+    def _reset(self) -> None:
+        super()._reset()
+        self._sketches = {}
+        self._weighted_sum = 0.0
+        self._weighted_count = 0.0
+        self._min = float("inf")
+        self._max = float("-inf")
+
+    def _ingest_values(self, metric: CapturedMetric) -> None:
+        super()._ingest_values(metric)
+        sketch = self._sketches.get(metric.tags)
+        if sketch is None:
+            sketch = self._sketches[metric.tags] = DDSketch(self.SKETCH_RELATIVE_ACCURACY)
+        sample_rate = metric.sample_rate or 1.0
+        weight = 1 / sample_rate
+        for value in self._values[self._offsets[-1] :]:
+            self._weighted_sum += value / sample_rate
+            self._weighted_count += weight
+            # invalid values are stored as nan, and are reported when the values are aggregated
+            if not isnan(value):
+                sketch.add(value, weight)
+                self._min = min(self._min, value)
+                self._max = max(self._max, value)
+
+    def _aggregate_columns(self) -> None:
+        columns = self._numpy_columns(self._values, self._sample_rates)
+        if columns is not None:
+            values, sample_rates = columns
+            self._weighted_sum = float((values / sample_rates).sum())
+            self._weighted_count = float((1 / sample_rates).sum())
+        else:
+            self._weighted_sum = sum(v / r for v, r in zip(self._values, self._sample_rates))
+            self._weighted_count = sum(1 / r for r in self._sample_rates)
+        numbers = [v for v in self._values if not isnan(v)]
+        self._min = min(numbers, default=float("inf"))
+        self._max = max(numbers, default=float("-inf"))
+        # the sketches of tag sets that were not copied whole are built from the values of the subset
+        for tag_set, positions in self._positions_by_tags.items():
+            if tag_set in self._sketches:
+                continue
+            sketch = self._sketches[tag_set] = DDSketch(self.SKETCH_RELATIVE_ACCURACY)
+            for i in self._value_positions(positions):
+                value = self._values[i]
+                if not isnan(value):
+                    sketch.add(value, 1 / self._sample_rates[i])
+
+    def _copy_tag_set_state(self, target: CapturedMetrics, tag_sets: List[Optional[MetricTags]], indexed: int) -> None:
+        sketches = {tag_set: self._sketches[tag_set].copy() for tag_set in tag_sets}
+        # metrics beyond indexed are added to the sketches as they are ingested, the copies are only used if no such
+        # metric was ingested before they were made
+        if len(self._offsets) == indexed:
+            target._sketches.update(sketches)  # type: ignore[attr-defined]  # noqa: SLF001
+
+    def sketch(self) -> DDSketch:
+        """
+        A sketch of all the values, weighted by their sample rates, merged from the sketches of every tag set. Sketches
+        of different captures (such as the results of split) can be merged with each other.
+        """
+        self._numeric_values()
+        ret = DDSketch(self.SKETCH_RELATIVE_ACCURACY)
+        for sketch in list(self._sketches.values()):
+            ret.merge(sketch)
+        return ret
+
+    def percentile(self, p: float) -> float:
+        """
+        The estimated p-th percentile (between 0 and 100) of the values.
+        """
+        return self.sketch().quantile(p / 100)
+
+    def quantiles(self, n: int = 4) -> List[float]:
+        """
+        The estimated n-1 cut points that divide the values into n intervals of equal probability, like
+        statistics.quantiles.
+        """
+        return self.sketch().quantiles(i / n for i in range(1, n))
+
+    def total(self) -> float:
+        """
+        The sum of the values, corrected by their sample rates.
+        """
+        self._numeric_values()
+        return self._weighted_sum
+
+    def weighted_count(self) -> float:
+        """
+        The number of values, corrected by their sample rates.
+        """
+        self._numeric_values()
+        return self._weighted_count
+
     def avg(self) -> float:
-        total_ms = 0.0
-        total_inv_sample_rate = 0.0
-        for m in self:
-            sample_rate = m.sample_rate or 1.0
-            total_ms += sum(float(v) / sample_rate for v in m.values)
-            total_inv_sample_rate += len(m.values) / sample_rate
-        return total_ms / total_inv_sample_rate
+        return self.total() / self._weighted_count
 
     def min(self) -> float:
-        return min(float(v) for m in self for v in m.values)
+        if not self._numeric_values():
+            raise ValueError("min() arg is an empty sequence")
+        return self._min
 
     def max(self) -> float:
-        return max(float(v) for m in self for v in m.values)
+        if not self._numeric_values():
+            raise ValueError("max() arg is an empty sequence")
+        return self._max
 
 
 class GaugeCapturedMetric(CapturedMetrics):
+    """
+    Captured gauges. Alongside the values, the timeline of the gauge is resolved as they are captured: the gauge after
+    every value (with relative changes applied to the gauge before it), along with its running minimum and maximum.
+    """
+
+    _relative: array[int]  # whether each value is a relative (signed) change
+    _resolved: array[float]  # the gauge after each value
+    _base: float = 0.0  # the gauge before the first value, relative changes of a window of time apply to it
+    _min: float
+    _max: float
+
+    def _reset(self) -> None:
+        super()._reset()
+        self._relative = array("b")
+        self._resolved = array("d")
+        self._min = float("inf")
+        self._max = float("-inf")
+
+    def _value_columns(self) -> Tuple[array, ...]:
+        return self._values, self._sample_rates, self._relative
+
+    def _ingest_values(self, metric: CapturedMetric) -> None:
+        super()._ingest_values(metric)
+        resolved = self._resolved
+        prev = resolved[-1] if resolved else self._base
+        for value, number in zip(metric.values, self._values[self._offsets[-1] :]):
+            relative = value.startswith(("+", "-"))
+            self._relative.append(relative)
+            prev = prev + number if relative else number
+            resolved.append(prev)
+            # invalid values are stored as nan, which min and max skip
+            self._min = min(self._min, prev)
+            self._max = max(self._max, prev)
+
+    def _seed_subset(self, target: CapturedMetrics, start: int) -> None:
+        # a window of time starts from the gauge before it, while the relative changes of other subsets (such as the
+        # results of filter) apply to the gauge before them in the subset
+        if start:
+            offsets = self._offsets
+            # the values before the window are of fully ingested metrics
+            before = offsets[start] if start < len(offsets) else len(self._values)
+            target._base = self._resolved[before - 1]  # type: ignore[attr-defined]  # noqa: SLF001
+
+    def _aggregate_columns(self) -> None:
+        # relative changes in a subset apply to the gauge before them in the subset, so subsets resolve their own
+        # timeline, in a single pass over the columns they were copied with
+        resolved = array("d")
+        prev = self._base
+        for number, relative in zip(self._values, self._relative):
+            prev = prev + number if relative else number
+            resolved.append(prev)
+        self._resolved = resolved
+        numbers = [v for v in resolved if not isnan(v)]
+        self._min = min(numbers, default=float("inf"))
+        self._max = max(numbers, default=float("-inf"))
+
     def last(self) -> float:
-        rev_values_iter = chain.from_iterable(reversed(m.values) for m in reversed(self))
-        addant = 0.0
-        for v in rev_values_iter:
-            if v.startswith("+"):
-                addant += float(v[1:])
-            elif v.startswith("-"):
-                addant -= float(v[1:])
-            else:
-                return float(v) + addant
-        return addant
+        self._numeric_values()
+        resolved = self._resolved
+        return resolved[-1] if resolved else self._base
 
     def values(self) -> Iterator[float]:
-        prev = 0.0
-        for m in self:
-            for v in m.values:
-                if v.startswith("+"):
-                    prev += float(v[1:])
-                elif v.startswith("-"):
-                    prev -= float(v[1:])
-                else:
-                    prev = float(v)
-                yield prev
+        self._numeric_values()
+        yield from self._resolved
+
+    def value_at(self, index: Optional[int] = None, *, time: Optional[float] = None) -> float:
+        """
+        The gauge right after the metric at an index, or right after the last metric received at or before a time.
+        Args:
+            index: the index of the metric, negative indices count from the end.
+            time: a time.monotonic() time, exclusive with index.
+        Raises:
+            IndexError: if there is no metric at the index, or no metric was received by the time.
+        """
+        if (index is None) == (time is None):
+            raise TypeError("exactly one of index and time must be given")
+        self._numeric_values()
+        indexed = self._indexed
+        if index is None:
+            index = bisect_right(self._received, time, 0, indexed) - 1  # type: ignore[arg-type]
+            if index < 0:
+                raise IndexError(f"no gauge was received by {time}")
+        elif index < 0:
+            index += indexed
+        if not 0 <= index < indexed:
+            raise IndexError("gauge index out of range")
+        # the gauge after the last value of the metric
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else len(self._values)
+        return self._resolved[end - 1]
+
+    def _extremum(self, extremum: float, default: Optional[float], description: str) -> float:
+        self._numeric_values()
+        if not self._resolved:
+            if default is None:
+                raise ValueError(f"{description}() arg is an empty sequence")
+            return default
+        return extremum
 
     def min(self, default: Optional[float] = None) -> float:
-        if default is None:
-            return min(self.values())
-        return min(self.values(), default=default)
+        return self._extremum(self._min, default, "min")
 
     def max(self, default: Optional[float] = None) -> float:
-        if default is None:
-            return max(self.values())
-        return max(self.values(), default=default)
+        return self._extremum(self._max, default, "max")
 
 
 class SetCapturedMetric(CapturedMetrics):
     def unique(self) -> Set[float]:
-        return {float(v) for m in self for v in m.values}
+        return set(self._numeric_values())
 
+    def unique_count(self) -> int:
+        return len(self.unique())
 
-class CapturedMetricsCollection(Dict[Tuple[str, str], CapturedMetrics]):
-    METRIC_TYPES_TO_CLASS: ClassVar[Dict[str, Type[CapturedMetrics]]] = {
-        "c": CountCapturedMetric,
-        "g": GaugeCapturedMetric,
-        "ms": HistogramCapturedMetric,
-        "h": HistogramCapturedMetric,
-        "s": SetCapturedMetric,
-        "d": HistogramCapturedMetric,
-    }
 
-    def append(self, metric: Metric):
+def _metric_not_found(key: Tuple[str, str], available: Iterable[Tuple[str, str]]) -> KeyError:
+    return KeyError(f"Metric {key[0]} of type {key[1]} not found, available metrics: {sorted(available)}")
+
+
+C = TypeVar("C", bound=Sized)
+Collection = TypeVar("Collection", bound="MetricsCollectionBase")
+
+
+class MetricsCollectionBase(Dict[Tuple[str, str], C], ABC):
+    """
+    A collection of captured metrics by their name and type, that can be waited on until metrics arrive.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._init_sync()
+
+    def _init_sync(self) -> None:
+        # notified (under the condition's lock) whenever new metrics are appended
+        self._condition = Condition()
+        self._async_waiters: Set[Tuple[AbstractEventLoop, Event]] = set()
+        self._metrics_count = sum(len(v) for v in self.values())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_condition"]
+        del state["_async_waiters"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_sync()
+
+    @abstractmethod
+    def _new_capture(self, metric_type: str) -> C:
+        """
+        A new, empty capture of metrics of the type.
+        """
+
+    def _append(self, metric: Metric, received_at: float) -> None:
         key = metric.name, metric.type
         if key not in self:
-            capture_cls = self.METRIC_TYPES_TO_CLASS.get(metric.type, CapturedMetrics)
-            self[key] = capture_cls()
+            self[key] = self._new_capture(metric.type)
         m = CapturedMetric.from_metric(metric)
-        self[key].append(m)
+        super().__getitem__(key)._append_received(m, received_at)  # type: ignore[attr-defined]  # noqa: SLF001
+        self._metrics_count += 1
 
-    def __getitem__(self, key: Tuple[str, str]) -> CapturedMetrics:
+    def _notify(self) -> None:
+        self._condition.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def append(self, metric: Metric):
+        with self._condition:
+            self._append(metric, monotonic())
+            self._notify()
+
+    def extend(self, metrics: Iterable[Metric]):
+        """
+        Append multiple metrics, waking up waiters only once.
+        """
+        with self._condition:
+            # all the metrics of a batch are received at the same time
+            received_at = monotonic()
+            for metric in metrics:
+                self._append(metric, received_at)
+            self._notify()
+
+    def metrics_count(self) -> int:
+        """
+        The total number of captured metrics, across all names and types.
+        """
+        return self._metrics_count
+
+    def wait_for(self: Collection, predicate: Callable[[Collection], Any], timeout: Optional[float] = None) -> None:
+        """
+        Block until predicate(self) is true. The predicate is re-evaluated whenever new metrics are captured.
+        Args:
+            predicate: called with the collection, while no new metrics can be appended.
+            timeout: the maximum number of seconds to wait, or None to wait indefinitely.
+        Raises:
+            TimeoutError: if the timeout expired before the predicate became true.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: predicate(self), timeout):
+                raise TimeoutError(f"timed out waiting for metrics after {timeout} seconds")
+
+    async def async_wait_for(
+        self: Collection, predicate: Callable[[Collection], Any], timeout: Optional[float] = None
+    ) -> None:
+        """
+        Asynchronous version of wait_for, that waits without blocking the running event loop.
+        """
+        event = Event()
+        waiter = (get_running_loop(), event)
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            self._async_waiters.add(waiter)
+        try:
+            while True:
+                with self._condition:
+                    if predicate(self):
+                        return
+                    event.clear()
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"timed out waiting for metrics after {timeout} seconds")
+                try:
+                    await asyncio_wait_for(event.wait(), remaining)
+                except asyncio_TimeoutError:
+                    raise TimeoutError(f"timed out waiting for metrics after {timeout} seconds") from None
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+
+    @abstractmethod
+    def get_count(self, name: str, tags=(), **tags_kwargs) -> Any:
+        """
+        The captured counts of the name, filtered by tags, empty if no such counts were captured.
+        """
+
+    def _count_predicate(self, name: str, total: Optional[float], tags, tags_kwargs) -> Callable[[Any], bool]:
+        def predicate(collection: MetricsCollectionBase) -> bool:
+            captured = collection.get_count(name, tags, **tags_kwargs)
+            if total is None:
+                return bool(captured)
+            return captured.total() >= total
+
+        return predicate
+
+    def wait_for_count(
+        self, name: str, total: Optional[float] = None, tags=(), *, timeout: Optional[float] = None, **tags_kwargs
+    ) -> None:
+        """
+        Block until the total of the count metric (filtered by tags) is at least total, or until any such metric is
+        captured if total is None.
+        """
+        self.wait_for(self._count_predicate(name, total, tags, tags_kwargs), timeout)
+
+    async def async_wait_for_count(
+        self, name: str, total: Optional[float] = None, tags=(), *, timeout: Optional[float] = None, **tags_kwargs
+    ) -> None:
+        await self.async_wait_for(self._count_predicate(name, total, tags, tags_kwargs), timeout)
+
+    def wait_for_metrics(self, n: int, timeout: Optional[float] = None) -> None:
+        """
+        Block until at least n metrics were captured in total.
+        """
+        self.wait_for(lambda c: c.metrics_count() >= n, timeout)
+
+    async def async_wait_for_metrics(self, n: int, timeout: Optional[float] = None) -> None:
+        await self.async_wait_for(lambda c: c.metrics_count() >= n, timeout)
+
+    def __getitem__(self, key: Tuple[str, str]) -> C:
         try:
             return super().__getitem__(key)
         except KeyError:
             if self:
-                raise KeyError(
-                    f"Metric {key[0]} of type {key[1]} not found, available metrics: {sorted(self.keys())}"
-                ) from None
+                raise _metric_not_found(key, self.keys()) from None
             else:
                 raise
 
+
+if TYPE_CHECKING:
+    _QueriesBase = Mapping[Tuple[str, str], CapturedMetrics]
+else:
+    # the queries are mixed into a dict, whose methods the abstract mapping's methods must not override
+    _QueriesBase = object
+
+
+class _CapturedMetricsQueries(_QueriesBase):
+    """
+    The accessors of captured metrics by name and type, shared by collections and snapshots of captured metrics.
+    """
+
     def count(self, name: str) -> CountCapturedMetric:
         return self[name, "c"]  # type: ignore[return-value]
 
@@ -313,3 +1421,140 @@ class CapturedMetricsCollection(Dict[Tuple[str, str], CapturedMetrics]):
 
     def get_distribution(self, name: str, tags=(), **tags_kwargs) -> HistogramCapturedMetric:
         return self.get((name, "d"), HistogramCapturedMetric()).filter(tags=tags, **tags_kwargs)  # type: ignore[return-value]
+
+
+class CapturedMetricsCollection(_CapturedMetricsQueries, MetricsCollectionBase[CapturedMetrics]):
+    METRIC_TYPES_TO_CLASS: ClassVar[Dict[str, Type[CapturedMetrics]]] = {
+        "c": CountCapturedMetric,
+        "g": GaugeCapturedMetric,
+        "ms": HistogramCapturedMetric,
+        "h": HistogramCapturedMetric,
+        "s": SetCapturedMetric,
+        "d": HistogramCapturedMetric,
+    }
+
+    def _new_capture(self, metric_type: str) -> CapturedMetrics:
+        return self.METRIC_TYPES_TO_CLASS.get(metric_type, CapturedMetrics)()
+
+    def save(self, path: Union[str, os.PathLike[str]]) -> None:
+        """
+        Write the capture to a file, in a compact columnar format that can be loaded with load.
+        """
+        # storage depends on this module, so it is imported lazily
+        from yellowbox_statsd.storage import save_capture  # noqa: PLC0415
+
+        save_capture(self, path)
+
+    @classmethod
+    def load(cls: Type[Collection], path: Union[str, os.PathLike[str]]) -> Collection:
+        """
+        Load a capture that was written with save. The file is memory-mapped, the metrics of every name and type are
+        only materialized when they are first accessed, aggregations and tag queries don't need them.
+        """
+        from yellowbox_statsd.storage import load_capture  # noqa: PLC0415
+
+        return load_capture(path, cls)  # type: ignore[type-var, return-value]
+
+    def snapshot(self) -> CapturedMetricsSnapshot:
+        """
+        A consistent view of the metrics captured so far, that metrics captured later are not added to. Only the number
+        of metrics of every name and type is recorded, the metrics are copied when the snapshot is first accessed.
+        Snapshots can be taken while metrics are being captured, and subtracted to get the metrics captured between
+        them.
+        """
+        with self._condition:
+            # the listener appends under the lock, so the watermarks of all the names and types are of the same batch
+            watermarks = {
+                key: _Watermark(series, series._generation, 0, series._indexed)  # noqa: SLF001
+                for key, series in self.items()
+                if series._indexed  # noqa: SLF001
+            }
+        return CapturedMetricsSnapshot(self, watermarks)
+
+    def _count_predicate(self, name: str, total: Optional[float], tags, tags_kwargs) -> Callable[[Any], bool]:
+        if total is None:
+            return super()._count_predicate(name, total, tags, tags_kwargs)
+
+        def predicate(collection: CapturedMetricsCollection) -> bool:
+            # the running totals are polled, rather than the total of a filtered copy of the counts
+            captured = collection.get((name, "c"))
+            return captured is not None and captured.filtered_total(tags=tags, **tags_kwargs) >= total  # type: ignore[attr-defined]
+
+        return predicate
+
+
+class _Watermark(NamedTuple):
+    series: CapturedMetrics
+    generation: int  # the generation of the series when the watermark was taken
+    start: int
+    stop: int
+
+
+class CapturedMetricsSnapshot(_CapturedMetricsQueries, Mapping[Tuple[str, str], CapturedMetrics]):
+    """
+    An immutable view of some of the metrics of a CapturedMetricsCollection, taken with snapshot, by name and type.
+    The view only holds the range of positions (watermarks) of the metrics of every name and type in the collection,
+    the metrics of a name and type are copied out of the collection when they are first accessed.
+    Subtracting a snapshot from a later snapshot of the same collection gives the metrics captured between them.
+    """
+
+    def __init__(self, collection: CapturedMetricsCollection, watermarks: Dict[Tuple[str, str], _Watermark]):
+        self._collection = collection
+        self._watermarks = watermarks
+        self._views: Dict[Tuple[str, str], CapturedMetrics] = {}
+
+    def __getitem__(self, key: Tuple[str, str]) -> CapturedMetrics:
+        ret = self._views.get(key)
+        if ret is not None:
+            return ret
+        watermark = self._watermarks.get(key)
+        if watermark is None:
+            if self:
+                raise _metric_not_found(key, self.keys())
+            raise KeyError(key)
+        series, generation, start, stop = watermark
+        # positions are only valid in the generation they were taken in, metrics that were appended since are beyond
+        # the watermark
+        self._check_generation(key, series, generation)
+        ret = series._subset(list(series._positions_by_tags), stop, start)  # noqa: SLF001
+        # the series may have been modified while the subset was being copied
+        self._check_generation(key, series, generation)
+        self._views[key] = ret
+        return ret
+
+    @staticmethod
+    def _check_generation(key: Tuple[str, str], series: CapturedMetrics, generation: int) -> None:
+        if series._generation != generation:  # noqa: SLF001
+            raise RuntimeError(f"metric {key[0]} of type {key[1]} was modified after the snapshot was taken")
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        return iter(self._watermarks)
+
+    def __len__(self) -> int:
+        return len(self._watermarks)
+
+    def metrics_count(self) -> int:
+        """
+        The total number of metrics in the snapshot, across all names and types.
+        """
+        return sum(watermark.stop - watermark.start for watermark in self._watermarks.values())
+
+    def __sub__(self, other: CapturedMetricsSnapshot) -> CapturedMetricsSnapshot:
+        """
+        The metrics of this snapshot that were captured after other was taken.
+        """
+        if not isinstance(other, CapturedMetricsSnapshot):
+            return NotImplemented
+        if other._collection is not self._collection:
+            raise ValueError("only snapshots of the same capture can be subtracted")
+        watermarks = {}
+        for key, watermark in self._watermarks.items():
+            start = watermark.start
+            prev = other._watermarks.get(key)
+            if prev is not None:
+                if prev.generation != watermark.generation:
+                    raise RuntimeError(f"metric {key[0]} of type {key[1]} was modified between the snapshots")
+                start = max(start, prev.stop)
+            if start < watermark.stop:
+                watermarks[key] = watermark._replace(start=start)
+        return type(self)(self._collection, watermarks)
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import argparse
+import mmap
+import os
+from socket import AF_INET, SOCK_DGRAM, socket
+from struct import Struct
+from threading import Lock
+from time import perf_counter, sleep, time_ns
+from types import TracebackType
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Type, TypeVar, Union, overload
+
+from yellowbox_statsd.metrics import CapturedMetricsCollection, MetricParseCache, MetricsCollectionBase
+from yellowbox_statsd.statsd import parse_datagrams
+
+# a recording is the magic, followed by records of a header (the receive time in nanoseconds since the epoch, and the
+# datagram's length) and the datagram itself
+RECORDING_MAGIC = b"YBSTATSD\x01"
+RECORD_HEADER = Struct("<qI")
+# datagrams that are due within this many seconds of each other are replayed together, without sleeping between them
+REPLAY_RESOLUTION = 0.001
+
+PathLike = Union[str, "os.PathLike[str]"]
+Self = TypeVar("Self", bound="DatagramRecorder")
+M = TypeVar("M", bound=MetricsCollectionBase)
+
+
+class DatagramRecorder:
+    """
+    A datagram callback that appends every datagram, along with the time it was received, to a recording file.
+    Usage:
+        with DatagramRecorder("burst.rec") as recorder:
+            statsd.add_datagram_callback(recorder)
+            ...
+            statsd.remove_datagram_callback(recorder)
+    """
+
+    def __init__(self, path: PathLike, append: bool = False):
+        """
+        Args:
+            path: the path of the recording file.
+            append: if true and the file exists, datagrams are appended to the existing recording, otherwise the file
+                is overwritten.
+        """
+        self.path = path
+        self.count = 0
+        # the recorder may be called from multiple listener threads
+        self._lock = Lock()
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                _check_magic(f, path)
+            self._file: BinaryIO = open(path, "ab")  # noqa: SIM115
+        else:
+            self._file = open(path, "wb")  # noqa: SIM115
+            self._file.write(RECORDING_MAGIC)
+
+    def __call__(self, datagram: bytes) -> None:
+        record = RECORD_HEADER.pack(time_ns(), len(datagram)) + datagram
+        with self._lock:
+            self._file.write(record)
+            self.count += 1
+
+    def flush(self) -> None:
+        with self._lock:
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self: Self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_tb: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
+def _check_magic(f: BinaryIO, path: PathLike) -> None:
+    if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+        raise ValueError(f"{path} is not a datagram recording")
+
+
+def iter_recording(path: PathLike) -> Iterator[Tuple[int, memoryview]]:
+    """
+    Iterate over the datagrams of a recording, along with the time they were received (in nanoseconds since the epoch).
+    The recording is memory-mapped, so that only the pages of the datagrams being read are loaded, and the datagrams are
+    views into the mapping that are only valid until the iteration continues.
+    """
+    with open(path, "rb") as f:
+        _check_magic(f, path)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                offset = len(RECORDING_MAGIC)
+                end = len(mapped)
+                header_size = RECORD_HEADER.size
+                while offset + header_size <= end:
+                    timestamp, length = RECORD_HEADER.unpack_from(mapped, offset)
+                    offset += header_size
+                    if offset + length > end:
+                        # the recorder was interrupted mid-write, the last record is incomplete
+                        break
+                    datagram = view[offset : offset + length]
+                    try:
+                        yield timestamp, datagram
+                    finally:
+                        datagram.release()
+                    offset += length
+            finally:
+                view.release()
+
+
+@overload
+def capture_recording(
+    path: PathLike,
+    collection: None = None,
+    parse_cache: Optional[MetricParseCache] = None,
+    batch_size: int = 1024,
+) -> CapturedMetricsCollection: ...
+
+
+@overload
+def capture_recording(
+    path: PathLike,
+    collection: M,
+    parse_cache: Optional[MetricParseCache] = None,
+    batch_size: int = 1024,
+) -> M: ...
+
+
+def capture_recording(
+    path: PathLike,
+    collection: Optional[MetricsCollectionBase] = None,
+    parse_cache: Optional[MetricParseCache] = None,
+    batch_size: int = 1024,
+) -> MetricsCollectionBase:
+    """
+    Parse the datagrams of a recording straight into a collection, without sending them through sockets.
+    Args:
+        path: the path of the recording file.
+        collection: the collection to add the metrics to, a new CapturedMetricsCollection by default.
+        parse_cache: if set, the cache to parse the metric lines with.
+        batch_size: the number of datagrams to parse and add to the collection at a time.
+    Returns:
+        The collection.
+    """
+    ret = CapturedMetricsCollection() if collection is None else collection
+    batch = []
+    for _, datagram in iter_recording(path):
+        # the view is only valid until the next datagram
+        batch.append(bytes(datagram))
+        if len(batch) >= batch_size:
+            ret.extend(parse_datagrams(batch, parse_cache))
+            batch.clear()
+    if batch:
+        ret.extend(parse_datagrams(batch, parse_cache))
+    return ret
+
+
+def replay_recording(path: PathLike, host: str, port: int, speed: Optional[float] = 1.0) -> int:
+    """
+    Send the datagrams of a recording to a host and port.
+    Args:
+        path: the path of the recording file.
+        host: the host to send the datagrams to.
+        port: the port to send the datagrams to.
+        speed: the factor to speed up the recording by, 1 to replay it at its original speed. None to send the
+            datagrams as fast as possible.
+    Returns:
+        The number of datagrams sent.
+    """
+    if speed is not None and speed <= 0:
+        raise ValueError("speed must be positive")
+    sent = 0
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        # a connected socket doesn't resolve the address on every send
+        sock.connect((host, port))
+        send = sock.send
+        first_timestamp: Optional[int] = None
+        start = perf_counter()
+        for timestamp, datagram in iter_recording(path):
+            if speed is not None:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = (timestamp - first_timestamp) / 1e9 / speed - (perf_counter() - start)
+                # datagrams that are due soon are sent immediately, so that bursts are sent back to back
+                if delay > REPLAY_RESOLUTION:
+                    sleep(delay)
+            try:
+                send(datagram)
+            except ConnectionRefusedError:
+                # an earlier datagram was rejected, since udp is connectionless, the error is raised on a later send
+                continue
+            sent += 1
+    return sent
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="replay a datagram recording to a statsd host and port")
+    parser.add_argument("path")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8125)
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument("--speed", type=float, default=1.0, help="the factor to speed up the recording by")
+    speed.add_argument("--fast", action="store_true", help="send the datagrams as fast as possible")
+    args = parser.parse_args(argv)
+    start = perf_counter()
+    sent = replay_recording(args.path, args.host, args.port, None if args.fast else args.speed)
+    print(f"sent {sent} datagrams in {perf_counter() - start:.2f} seconds")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
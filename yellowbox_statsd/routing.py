@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+from threading import Lock
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+
+from yellowbox_statsd.metrics import INTERN_LIMIT, Metric, MetricsCollectionBase, MetricTags, _tags_to_match
+
+# the key that the routes of a metric are cached by
+_MetricKey = Tuple[str, str, Optional[MetricTags], Optional[str]]
+
+
+class CaptureRoute(NamedTuple):
+    """
+    The metrics that a capture receives. A route with no fields set receives every metric.
+    """
+
+    tag: Optional[str] = None  # only metrics with this tag, such as "test_id:1234"
+    container_id: Optional[str] = None  # only metrics with this container id
+    name_prefix: Optional[str] = None  # only metrics whose names start with this prefix
+
+
+class CompiledNameFilter:
+    """
+    A predicate on the raw name of a metric line, so that the parser can skip the lines that no capture is interested
+    in without parsing their values and tags.
+    """
+
+    def __init__(self, names: Iterable[str] = (), prefixes: Iterable[str] = ()):
+        self.names = frozenset(name.encode() for name in names)
+        # str.startswith with a tuple of prefixes is faster than matching against a trie in python
+        self.prefixes = tuple(prefix.encode() for prefix in prefixes)
+
+    def __call__(self, name: bytes) -> bool:
+        return name in self.names or name.startswith(self.prefixes)
+
+
+class CaptureFilter:
+    """
+    The metrics that a capture is interested in, compiled once into set lookups, so that other metrics are rejected
+    before they are captured.
+    """
+
+    def __init__(
+        self,
+        names: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        tags: Union[Iterable[str], Mapping[str, str], None] = None,
+    ):
+        """
+        Args:
+            names: if set, only metrics with these names (or the prefixes) are accepted.
+            prefixes: if set, only metrics whose names start with one of these prefixes (or have one of the names)
+                are accepted.
+            types: if set, only metrics of these types (such as "c" or "ms") are accepted.
+            tags: if set, only metrics that have all of these tags are accepted.
+        """
+        self.names: Optional[FrozenSet[str]] = None if names is None else frozenset(names)
+        self.prefixes: Optional[Tuple[str, ...]] = None if prefixes is None else tuple(prefixes)
+        self.types: Optional[FrozenSet[str]] = None if types is None else frozenset(types)
+        self.tags = _tags_to_match((), () if tags is None else tags, {})
+
+    def accepts_any_name(self) -> bool:
+        return self.names is None and self.prefixes is None
+
+    def accepts_all(self) -> bool:
+        return self.accepts_any_name() and self.types is None and not self.tags
+
+    def matches(self, name: str, metric_type: str, tags: Optional[MetricTags]) -> bool:
+        if not (
+            self.accepts_any_name()
+            or (self.names is not None and name in self.names)
+            or (self.prefixes is not None and name.startswith(self.prefixes))
+        ):
+            return False
+        if self.types is not None and metric_type not in self.types:
+            return False
+        return not self.tags or (tags is not None and self.tags.issubset(tags))
+
+
+class _Routes:
+    """
+    An immutable snapshot of the active captures, their routes and their filters, replaced whenever a capture is added
+    or removed.
+    """
+
+    def __init__(self, entries: Sequence[Tuple[MetricsCollectionBase, CaptureRoute, CaptureFilter]]):
+        self.entries = tuple(entries)
+        self.captures = [capture for capture, _, _ in self.entries]
+        # the indices of the captures that are not routed (though they may still be filtered)
+        self.unrouted = tuple(i for i, (_, route, _) in enumerate(self.entries) if route == CaptureRoute())
+        # whether every capture receives every metric
+        self.receive_all = len(self.unrouted) == len(self.entries) and all(
+            capture_filter.accepts_all() for _, _, capture_filter in self.entries
+        )
+        self.by_tag: Dict[str, List[int]] = {}
+        self.by_container_id: Dict[str, List[int]] = {}
+        self.by_name_prefix: List[Tuple[str, int]] = []
+        for i, (_, route, _) in enumerate(self.entries):
+            if route.tag is not None:
+                self.by_tag.setdefault(route.tag, []).append(i)
+            elif route.container_id is not None:
+                self.by_container_id.setdefault(route.container_id, []).append(i)
+            elif route.name_prefix is not None:
+                self.by_name_prefix.append((route.name_prefix, i))
+        self.name_filter = self._name_filter()
+        # listeners add to the cache concurrently, which is safe since every key always maps to the same indices
+        self._cache: Dict[_MetricKey, Tuple[int, ...]] = {}
+
+    def _name_filter(self) -> Optional[CompiledNameFilter]:
+        # the names that any of the captures might accept, None if there are no captures or some capture might accept
+        # any name
+        if not self.entries:
+            return None
+        names: List[str] = []
+        prefixes: List[str] = []
+        for _, route, capture_filter in self.entries:
+            if route.name_prefix is not None:
+                prefixes.append(route.name_prefix)
+            elif capture_filter.accepts_any_name():
+                return None
+            else:
+                names.extend(capture_filter.names or ())
+                prefixes.extend(capture_filter.prefixes or ())
+        return CompiledNameFilter(names, prefixes)
+
+    def _targets(self, key: _MetricKey) -> Tuple[int, ...]:
+        ret = self._cache.get(key)
+        if ret is not None:
+            return ret
+        name, metric_type, tags, container_id = key
+        targets = set(self.unrouted)
+        for tag in tags or ():
+            targets.update(self.by_tag.get(tag, ()))
+        if container_id is not None:
+            targets.update(self.by_container_id.get(container_id, ()))
+        targets.update(i for prefix, i in self.by_name_prefix if name.startswith(prefix))
+        ret = tuple(sorted(i for i in targets if self.entries[i][2].matches(name, metric_type, tags)))
+        if len(self._cache) >= INTERN_LIMIT:
+            self._cache.clear()
+        self._cache[key] = ret
+        return ret
+
+    def route(self, metrics: List[Metric]) -> List[Tuple[MetricsCollectionBase, List[Metric]]]:
+        if self.receive_all:
+            return [(capture, metrics) for capture in self.captures]
+        routed: List[List[Metric]] = [[] for _ in self.entries]
+        for metric in metrics:
+            for i in self._targets((metric.name, metric.type, metric.tags, metric.container_id)):
+                routed[i].append(metric)
+        return [(capture, routed_metrics) for capture, routed_metrics in zip(self.captures, routed) if routed_metrics]
+
+
+class CaptureRouter:
+    """
+    The active captures of a service, which may overlap. Adding and removing captures replaces an immutable snapshot
+    of the routes under a lock, so routing metrics (by the listeners) only reads the current snapshot, without locking.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._routes = _Routes(())
+
+    def add(
+        self,
+        capture: MetricsCollectionBase,
+        route: Optional[CaptureRoute] = None,
+        capture_filter: Optional[CaptureFilter] = None,
+    ) -> None:
+        if route is None:
+            route = CaptureRoute()
+        elif sum(key is not None for key in route) > 1:
+            raise ValueError("a capture can only be routed by one of tag, container_id, or name_prefix")
+        if capture_filter is None:
+            capture_filter = CaptureFilter()
+        with self._lock:
+            self._routes = _Routes((*self._routes.entries, (capture, route, capture_filter)))
+
+    def remove(self, capture: MetricsCollectionBase) -> None:
+        with self._lock:
+            entries = self._routes.entries
+            if not any(c is capture for c, _, _ in entries):
+                raise ValueError("capture is not active")
+            self._routes = _Routes(tuple(entry for entry in entries if entry[0] is not capture))
+
+    def route(self, metrics: List[Metric]) -> List[Tuple[MetricsCollectionBase, List[Metric]]]:
+        """
+        The metrics that every capture should receive, captures that receive no metrics are omitted.
+        """
+        return self._routes.route(metrics)
+
+    def name_filter(self) -> Optional[CompiledNameFilter]:
+        """
+        A filter of the metric names that any of the active captures might accept, or None if any name might be
+        accepted.
+        """
+        return self._routes.name_filter
+
+    def __iter__(self) -> Iterator[MetricsCollectionBase]:
+        return iter(self._routes.captures)
+
+    def __len__(self) -> int:
+        return len(self._routes.entries)
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+from hashlib import blake2b
+from math import ceil, exp, log
+from typing import Any, Dict, Iterable, List, Optional
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+class DDSketch:
+    """
+    A mergeable quantile sketch (https://arxiv.org/abs/1908.10693). Every quantile is within `relative_accuracy` of
+    the true value (relative to the value), as long as the sketch has not collapsed any of its bins. Values are
+    weighted, so that sampled metrics can be counted by the inverse of their sample rate.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = log(self._gamma)
+        # weights of positive values by bin, and of negative values by the bin of their absolute value
+        self._positive: Dict[int, float] = {}
+        self._negative: Dict[int, float] = {}
+        self._zero = 0.0
+        self.count = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def _key(self, value: float) -> int:
+        return ceil(log(value) / self._log_gamma)
+
+    def _value(self, key: int) -> float:
+        # the value with the smallest relative error to all the values in the bin
+        return 2 * exp(key * self._log_gamma) / (self._gamma + 1)
+
+    def add(self, value: float, weight: float = 1.0) -> None:
+        if value > 0:
+            bins = self._positive
+            key = self._key(value)
+            bins[key] = bins.get(key, 0.0) + weight
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        elif value < 0:
+            bins = self._negative
+            key = self._key(-value)
+            bins[key] = bins.get(key, 0.0) + weight
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        else:
+            self._zero += weight
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @staticmethod
+    def _collapse(bins: Dict[int, float]) -> None:
+        # the two lowest bins are merged, so only the accuracy of the smallest absolute values is lost
+        lowest, second = sorted(bins)[:2]
+        bins[second] += bins.pop(lowest)
+
+    def merge(self, other: DDSketch) -> None:
+        if other._gamma != self._gamma:
+            raise ValueError("cannot merge sketches with different relative accuracies")
+        for bins, other_bins in ((self._positive, other._positive), (self._negative, other._negative)):
+            for key, weight in list(other_bins.items()):
+                bins[key] = bins.get(key, 0.0) + weight
+            while len(bins) > self.max_bins:
+                self._collapse(bins)
+        self._zero += other._zero
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def copy(self) -> DDSketch:
+        ret = DDSketch(self.relative_accuracy, self.max_bins)
+        ret.merge(self)
+        return ret
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        The state of the sketch as a JSON-serializable dict, that can be restored with from_dict.
+        """
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_bins": self.max_bins,
+            "positive": list(self._positive.items()),
+            "negative": list(self._negative.items()),
+            "zero": self._zero,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> DDSketch:
+        ret = cls(d["relative_accuracy"], d["max_bins"])
+        ret._positive = dict(d["positive"])
+        ret._negative = dict(d["negative"])
+        ret._zero = d["zero"]
+        ret.count = d["count"]
+        if d["min"] is not None:
+            ret.min = d["min"]
+            ret.max = d["max"]
+        return ret
+
+    def quantile(self, q: float) -> float:
+        """
+        The estimated value at quantile q (between 0 and 1) of the added values.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("quantile must be between 0 and 1")
+        if self.count <= 0:
+            raise ValueError("quantile of an empty sketch")
+        rank = q * self.count
+        cumulative = 0.0
+        for key in sorted(self._negative, reverse=True):
+            cumulative += self._negative[key]
+            if cumulative >= rank:
+                return self._clamp(-self._value(key))
+        cumulative += self._zero
+        if cumulative >= rank and self._zero:
+            return 0.0
+        for key in sorted(self._positive):
+            cumulative += self._positive[key]
+            if cumulative >= rank:
+                return self._clamp(self._value(key))
+        # only reachable through floating point errors in the cumulative weight
+        return self.max
+
+    def _clamp(self, value: float) -> float:
+        # the value of a bin may be outside of the range of the values added to it
+        return min(max(value, self.min), self.max)
+
+    def quantiles(self, qs: Iterable[float]) -> List[float]:
+        return [self.quantile(q) for q in qs]
+
+
+class HyperLogLog:
+    """
+    A mergeable estimator of the number of distinct values, with a standard error of about 1.04/sqrt(2**precision),
+    in 2**precision bytes.
+    """
+
+    def __init__(self, precision: int = 12, registers: Optional[bytearray] = None):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(f"precision must be between {MIN_PRECISION} and {MAX_PRECISION}")
+        self.precision = precision
+        self._registers = bytearray(1 << precision) if registers is None else registers
+
+    def add(self, value: str) -> None:
+        # a stable hash, the built-in str hash is salted per process, so registers of different processes (such as of
+        # pickled estimators) could not be merged
+        h = int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        self._registers[index] = max(self._registers[index], rank)
+
+    def merge(self, other: HyperLogLog) -> None:
+        if other.precision != self.precision:
+            raise ValueError("cannot merge estimators with different precisions")
+        registers = self._registers
+        for i, rank in enumerate(other._registers):
+            registers[i] = max(registers[i], rank)
+
+    def copy(self) -> HyperLogLog:
+        return HyperLogLog(self.precision, bytearray(self._registers))
+
+    def estimate(self) -> float:
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0**-r for r in self._registers)
+        zeros = self._registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            return m * log(m / zeros)
+        return raw
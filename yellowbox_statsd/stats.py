@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List
+
+# latencies are counted in buckets of powers of two nanoseconds, the last bucket counts everything above ~9 minutes
+LATENCY_BUCKETS = 40
+
+
+class LatencyHistogram:
+    """
+    A histogram of latencies, in buckets whose upper bounds are powers of two nanoseconds. Recording a latency is a
+    handful of integer operations, so histograms can be kept on at all times.
+    """
+
+    __slots__ = ("buckets", "count", "max_ns", "total_ns")
+
+    def __init__(self):
+        self.buckets: List[int] = [0] * LATENCY_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns: int) -> None:
+        self.buckets[min(ns.bit_length(), LATENCY_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_ns += ns
+        self.max_ns = max(self.max_ns, ns)
+
+    def merge(self, other: LatencyHistogram) -> None:
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+
+    def percentile_ns(self, p: float) -> int:
+        """
+        An upper bound of the p-th percentile (between 0 and 100), within a factor of two.
+        """
+        rank = p / 100 * self.count
+        cumulative = 0
+        for i, n in enumerate(self.buckets):
+            cumulative += n
+            if n and cumulative >= rank:
+                return min(1 << i, self.max_ns)
+        return self.max_ns
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean_us": self.total_ns / self.count / 1000 if self.count else 0.0,
+            "p50_us": self.percentile_ns(50) / 1000,
+            "p99_us": self.percentile_ns(99) / 1000,
+            "max_us": self.max_ns / 1000,
+            # the number of latencies below each upper bound (in nanoseconds), excluding the previous bounds
+            "buckets": {1 << i: n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+class ServiceStats:
+    """
+    Counters and latency histograms of a statsd service's pipeline.
+    Attributes:
+        datagrams: the number of datagrams received.
+        bytes: the total size of the datagrams received.
+        lines: the number of metric lines parsed.
+        parse_failures: the number of datagrams that could not be parsed, and were skipped.
+        truncated_datagrams: the number of datagrams that were larger than the receive buffer, and were truncated.
+        kernel_drops: the number of datagrams dropped by the kernel because the socket's receive buffer was full.
+            Only available on linux (with SO_RXQ_OVFL), and only updated when a datagram is received after the drop.
+        callback_errors: the number of callbacks that raised an exception.
+        callback_queue_full: the number of batches whose callbacks were dispatched while the dispatcher's queue was
+            full.
+        callbacks_dropped: the number of batches whose callbacks were dropped because the dispatcher's queue was full.
+        latencies: latency histograms of each of the pipeline's stages, by the stage's name. Stages are "recv",
+            "parse", "capture", and "callback:<name>" for every callback.
+    """
+
+    COUNTERS = (
+        "datagrams",
+        "bytes",
+        "lines",
+        "parse_failures",
+        "truncated_datagrams",
+        "kernel_drops",
+        "callback_errors",
+        "callback_queue_full",
+        "callbacks_dropped",
+    )
+
+    def __init__(self):
+        self.datagrams = 0
+        self.bytes = 0
+        self.lines = 0
+        self.parse_failures = 0
+        self.truncated_datagrams = 0
+        self.kernel_drops = 0
+        self.callback_errors = 0
+        self.callback_queue_full = 0
+        self.callbacks_dropped = 0
+        self.latencies: Dict[str, LatencyHistogram] = {}
+
+    def latency(self, stage: str) -> LatencyHistogram:
+        ret = self.latencies.get(stage)
+        if ret is None:
+            ret = self.latencies[stage] = LatencyHistogram()
+        return ret
+
+    def merge(self, other: ServiceStats) -> None:
+        for counter in self.COUNTERS:
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+        for stage, histogram in list(other.latencies.items()):
+            self.latency(stage).merge(histogram)
+
+    def as_dict(self) -> Dict[str, Any]:
+        ret: Dict[str, Any] = {counter: getattr(self, counter) for counter in self.COUNTERS}
+        ret["latencies"] = {stage: histogram.as_dict() for stage, histogram in sorted(self.latencies.items())}
+        return ret
@@ -1,53 +1,181 @@
 from __future__ import annotations
 
 import platform
+import socket as socket_module
+import stat
 import subprocess
+import sys
 from collections.abc import Callable
-from contextlib import contextmanager
-from os import getenv
-from socket import AF_INET, SOCK_DGRAM, socket, timeout
-from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from math import ceil
+from multiprocessing import get_context
+from os import chmod, getenv, lstat, unlink
+from os.path import abspath, basename, dirname
+from selectors import EVENT_READ, DefaultSelector
+from socket import AF_INET, MSG_PEEK, MSG_TRUNC, SO_RCVBUF, SOCK_DGRAM, SOL_SOCKET, socket, socketpair
+from threading import Lock, Thread, local
+from time import perf_counter_ns
 from traceback import print_exc
-from typing import Any, Iterator, List, Set
+from typing import (
+    Any,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    overload,
+)
+from warnings import warn
 
 from yellowbox import YellowService
 from yellowbox.utils import docker_host_name
 
-from yellowbox_statsd.metrics import CapturedMetricsCollection, Metric
+from yellowbox_statsd.aggregates import AggregatedMetricsCollection
+from yellowbox_statsd.dispatch import CallbackDispatcher
+from yellowbox_statsd.metrics import (
+    CapturedMetricsCollection,
+    Metric,
+    MetricParseCache,
+    MetricsCollectionBase,
+    NameFilter,
+)
+from yellowbox_statsd.routing import CaptureFilter, CaptureRoute, CaptureRouter
+from yellowbox_statsd.stats import ServiceStats
 
+SO_REUSEPORT: Optional[int] = getattr(socket_module, "SO_REUSEPORT", None)
+# python doesn't expose SO_RXQ_OVFL, with it the kernel reports the number of datagrams it dropped for the socket
+SO_RXQ_OVFL: Optional[int] = getattr(socket_module, "SO_RXQ_OVFL", 40 if sys.platform.startswith("linux") else None)
+# recvmsg is not available on windows, where truncation and drops are not reported
+HAS_RECVMSG = hasattr(socket_module.socket, "recvmsg_into")
+ANCILLARY_SIZE = socket_module.CMSG_SPACE(4) if HAS_RECVMSG else 0
+# linux doubles the requested SO_RCVBUF (to account for its bookkeeping overhead), and reports the doubled size
+RECEIVE_BUFFER_FACTOR = 2 if sys.platform.startswith("linux") else 1
+# only on linux does a peek with MSG_TRUNC return the full size of the datagram
+SUPPORTS_AUTO_BUFFER_SIZE = sys.platform.startswith("linux")
+# the maximum size of a udp datagram
+MAX_DATAGRAM_SIZE = 65535
+# the default size of the datagram buffers, unix sockets carry larger datagrams, since they are not fragmented
+DEFAULT_BUFFER_SIZE = 4096
+UDS_BUFFER_SIZE = 8192
+# the directory that a unix socket's directory is mounted to in containers, where dogstatsd clients look for it
+UDS_CONTAINER_DIR = "/var/run/datadog"
+# unix sockets are not available on windows
+AF_UNIX: Optional[int] = getattr(socket_module, "AF_UNIX", None)
+# the memory the kernel accounts for each datagram in the receive buffer, beyond the datagram itself
+DATAGRAM_OVERHEAD = 768
+
+# the captures entered in the current context, along with their services, innermost last
+_current_captures: ContextVar[Tuple[Tuple[StatsdServiceBase, MetricsCollectionBase], ...]] = ContextVar(
+    "_current_captures", default=()
+)
+
+# the collections that captures store metrics in, by the capture's mode
+CAPTURE_MODES: Dict[str, Type[MetricsCollectionBase]] = {
+    "raw": CapturedMetricsCollection,
+    "aggregate": AggregatedMetricsCollection,
+}
+
+
+def parse_datagrams_counted(
+    datagrams: Iterable[Union[bytes, memoryview]],
+    cache: Optional[MetricParseCache] = None,
+    name_filter: Optional[NameFilter] = None,
+) -> Tuple[List[Metric], int]:
+    """
+    Parse the metrics of multiple datagrams, datagrams that fail to parse are reported and skipped.
+    Returns the metrics, and the number of datagrams that failed to parse.
+    """
+    parse_datagram = Metric.parse_datagram if cache is None else cache.parse_datagram
+    metrics: List[Metric] = []
+    failures = 0
+    for raw in datagrams:
+        try:
+            metrics.extend(parse_datagram(bytes(raw), name_filter))
+        except Exception:  # noqa: BLE001
+            print("unexpected error when parsing statsd metrics")  # noqa: T201
+            print_exc()
+            failures += 1
+    return metrics, failures
 
-class StatsdService(YellowService):
-    sock: socket
 
-    def __init__(self, port: int = 0, buffer_size: int = 4096, polling_time: float = 0.1, host="0.0.0.0"):
-        super().__init__()
+def parse_datagrams(
+    datagrams: Iterable[Union[bytes, memoryview]],
+    cache: Optional[MetricParseCache] = None,
+    name_filter: Optional[NameFilter] = None,
+) -> List[Metric]:
+    """
+    Parse the metrics of multiple datagrams, datagrams that fail to parse are reported and skipped.
+    """
+    return parse_datagrams_counted(datagrams, cache, name_filter)[0]
+
+
+def _stage_name(callback: Callable[[Any], Any]) -> str:
+    return f"callback:{getattr(callback, '__qualname__', type(callback).__qualname__)}"
+
+
+class StatsdServiceBase:
+    """
+    The parts of a statsd service that are independent of how datagrams are received: callbacks, the active captures,
+    and the pipeline that parses datagrams into the captures.
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        host="0.0.0.0",
+        parse_cache_size: Optional[int] = None,
+        callback_dispatcher: Optional[CallbackDispatcher] = None,
+    ):
         self.port = port
         self.host = host
-        self.buffer_size = buffer_size
-        self.polling_time = polling_time
-
-        self.should_stop = False
-        self.listening_thread = Thread(target=self._listen_loop, daemon=True, name="statsd-listener")
-        self.captures: List[CapturedMetricsCollection] = []
+        # if set, repeated metric lines are parsed only once, and then retrieved from the cache
+        self.parse_cache = MetricParseCache(parse_cache_size) if parse_cache_size else None
+        # if set, callbacks are called through the dispatcher's queue, instead of by the listener
+        self.callback_dispatcher = callback_dispatcher
+        # captures may overlap, across threads and tasks
+        self.captures = CaptureRouter()
         self.metric_callbacks: Set[Callable[[Metric], Any]] = set()
         self.datagram_callbacks: Set[Callable[[bytes], Any]] = set()
+        self.metric_batch_callbacks: Set[Callable[[List[Metric]], Any]] = set()
+        self.datagram_batch_callbacks: Set[Callable[[List[bytes]], Any]] = set()
+        # every thread that handles datagrams keeps its own stats, so that they can be updated without locking
+        self._local_stats = local()
+        self._all_stats: List[ServiceStats] = []
+        self._all_stats_lock = Lock()
 
-    def start(self):
-        self.sock = socket(AF_INET, SOCK_DGRAM)
-        self.sock.settimeout(self.polling_time)
-        self.sock.bind((self.host, self.port))
-        if self.port == 0:
-            self.port = self.sock.getsockname()[1]
-        self.listening_thread.start()
-        return super().start()
+    def _thread_stats(self) -> ServiceStats:
+        try:
+            return self._local_stats.stats
+        except AttributeError:
+            pass
+        stats = self._local_stats.stats = ServiceStats()
+        with self._all_stats_lock:
+            self._all_stats.append(stats)
+        return stats
 
-    def stop(self):
-        self.should_stop = True
-        self.listening_thread.join()
-        self.sock.close()
-
-    def is_alive(self):
-        return self.sock is not None
+    def stats(self) -> ServiceStats:
+        """
+        The counters and latency histograms of the service's pipeline, since the service was created.
+        """
+        ret = ServiceStats()
+        with self._all_stats_lock:
+            all_stats = list(self._all_stats)
+        for stats in all_stats:
+            ret.merge(stats)
+        if self.callback_dispatcher is not None:
+            ret.callback_queue_full = self.callback_dispatcher.full
+            ret.callbacks_dropped = self.callback_dispatcher.dropped
+        return ret
 
     def add_metric_callback(self, callback: Callable[[Metric], Any]) -> None:
         self.metric_callbacks.add(callback)
@@ -61,49 +189,139 @@ class StatsdService(YellowService):
     def remove_datagram_callback(self, callback: Callable[[bytes], Any]) -> None:
         self.datagram_callbacks.remove(callback)
 
+    def add_metric_batch_callback(self, callback: Callable[[List[Metric]], Any]) -> None:
+        """
+        Add a callback that is called once for every batch of metrics received together, rather than for every metric.
+        The list must not be modified by the callback.
+        """
+        self.metric_batch_callbacks.add(callback)
+
+    def remove_metric_batch_callback(self, callback: Callable[[List[Metric]], Any]) -> None:
+        self.metric_batch_callbacks.remove(callback)
+
+    def add_datagram_batch_callback(self, callback: Callable[[List[bytes]], Any]) -> None:
+        """
+        Add a callback that is called once for every batch of datagrams received together, rather than for every
+        datagram. The list must not be modified by the callback.
+        """
+        self.datagram_batch_callbacks.add(callback)
+
+    def remove_datagram_batch_callback(self, callback: Callable[[List[bytes]], Any]) -> None:
+        self.datagram_batch_callbacks.remove(callback)
+
+    def _push_capture(
+        self,
+        mode: str = "raw",
+        route: Optional[CaptureRoute] = None,
+        capture_filter: Optional[CaptureFilter] = None,
+    ) -> Any:
+        collection_cls = CAPTURE_MODES.get(mode)
+        if collection_cls is None:
+            raise ValueError(f"unknown capture mode {mode!r}, expected one of {sorted(CAPTURE_MODES)}")
+        cap = collection_cls()
+        self.captures.add(cap, route, capture_filter)
+        return cap
+
+    def _pop_capture(self, cap: MetricsCollectionBase) -> None:
+        self.captures.remove(cap)
+
     @contextmanager
-    def capture(self) -> Iterator[CapturedMetricsCollection]:
-        cap = CapturedMetricsCollection()
-        self.captures.append(cap)
+    def _entered_capture(self, cap: MetricsCollectionBase) -> Iterator[None]:
+        _current_captures.set((*_current_captures.get(), (self, cap)))
         try:
-            yield cap
+            yield
         finally:
-            if self.captures.pop() is not cap:
-                raise RuntimeError("capture stack is corrupted, concurrent captures are not allowed")
+            # captures are not necessarily exited in the reverse order they were entered in, so only this capture is
+            # removed, rather than resetting the context to its state before the capture was entered
+            _current_captures.set(tuple(entry for entry in _current_captures.get() if entry[1] is not cap))
 
-    def _listen_loop(self) -> None:
-        while not self.should_stop:
-            try:
-                data: bytes = self.sock.recv(self.buffer_size)
-            except (TimeoutError, timeout):
-                continue
-            except Exception:  # noqa: BLE001
-                print("unexpected error when listening to statsd socket")  # noqa: T201
-                print_exc()
-                continue
-            for dgram_callback in self.datagram_callbacks:
-                try:
-                    dgram_callback(data)
-                except Exception:  # noqa: BLE001
-                    print("unexpected error when calling datagram callback")  # noqa: T201
-                    print_exc()
-            try:
-                metrics = [Metric.parse(line) for line in data.decode("utf-8").strip().splitlines()]
-            except Exception:  # noqa: BLE001
-                print("unexpected error when parsing statsd metrics")  # noqa: T201
-                print_exc()
-                continue
-            for cap in self.captures:
-                for metric in metrics:
-                    cap.append(metric)
-
-            for metric_callback in self.metric_callbacks:
-                for metric in metrics:
-                    try:
-                        metric_callback(metric)
-                    except Exception:  # noqa: BLE001
-                        print("unexpected error when calling message callback")  # noqa: T201
-                        print_exc()
+    def current_capture(self) -> Optional[Any]:
+        """
+        The innermost capture of this service that was entered in the current context (thread or asyncio task), or None
+        if no capture was entered.
+        """
+        for service, cap in reversed(_current_captures.get()):
+            if service is self:
+                return cap
+        return None
+
+    def _call_callback(self, callback: Callable[[Any], Any], arg: Any, description: str) -> None:
+        try:
+            callback(arg)
+        except Exception:  # noqa: BLE001
+            self._thread_stats().callback_errors += 1
+            print(f"unexpected error when calling {description}")  # noqa: T201
+            print_exc()
+
+    def _call_callbacks(
+        self, callbacks: Set[Callable[[Any], Any]], args: Sequence[Any], description: str, stats: ServiceStats
+    ) -> None:
+        for callback in list(callbacks):
+            latency = stats.latency(_stage_name(callback))
+            for arg in args:
+                start = perf_counter_ns()
+                self._call_callback(callback, arg, description)
+                latency.record(perf_counter_ns() - start)
+
+    def _call_datagram_callbacks(self, datagrams: List[bytes]) -> None:
+        stats = self._thread_stats()
+        self._call_callbacks(self.datagram_callbacks, datagrams, "datagram callback", stats)
+        self._call_callbacks(self.datagram_batch_callbacks, (datagrams,), "datagram batch callback", stats)
+
+    def _call_metric_callbacks(self, metrics: List[Metric]) -> None:
+        stats = self._thread_stats()
+        self._call_callbacks(self.metric_callbacks, metrics, "message callback", stats)
+        self._call_callbacks(self.metric_batch_callbacks, (metrics,), "message batch callback", stats)
+
+    def _dispatch_callbacks(self, call: Callable[[List[Any]], None], args: List[Any]) -> None:
+        if self.callback_dispatcher is None:
+            call(args)
+        else:
+            self.callback_dispatcher.submit(call, args)
+
+    def _dispatch_metrics(self, metrics: List[Metric]) -> None:
+        if not metrics:
+            return
+
+        stats = self._thread_stats()
+        stats.lines += len(metrics)
+        if self.captures:
+            start = perf_counter_ns()
+            for cap, cap_metrics in self.captures.route(metrics):
+                cap.extend(cap_metrics)
+            stats.latency("capture").record(perf_counter_ns() - start)
+
+        if self.metric_callbacks or self.metric_batch_callbacks:
+            self._dispatch_callbacks(self._call_metric_callbacks, metrics)
+
+    def _count_datagrams(self, datagrams: Sequence[Union[bytes, memoryview]]) -> None:
+        stats = self._thread_stats()
+        stats.datagrams += len(datagrams)
+        stats.bytes += sum(map(len, datagrams))
+
+    def _name_filter(self) -> Optional[NameFilter]:
+        """
+        The filter to parse datagrams with, metric callbacks receive every metric, so lines can only be skipped when
+        there are none.
+        """
+        if self.metric_callbacks or self.metric_batch_callbacks:
+            return None
+        return self.captures.name_filter()
+
+    def _parse(self, datagrams: Sequence[Union[bytes, memoryview]]) -> List[Metric]:
+        start = perf_counter_ns()
+        metrics, failures = parse_datagrams_counted(datagrams, self.parse_cache, self._name_filter())
+        stats = self._thread_stats()
+        stats.latency("parse").record(perf_counter_ns() - start)
+        stats.parse_failures += failures
+        return metrics
+
+    def _handle_batch(self, datagrams: Sequence[Union[bytes, memoryview]]) -> None:
+        self._count_datagrams(datagrams)
+        if self.datagram_callbacks or self.datagram_batch_callbacks:
+            # the datagrams are views of the listener's buffers, which are reused by the next batch
+            self._dispatch_callbacks(self._call_datagram_callbacks, [bytes(raw) for raw in datagrams])
+        self._dispatch_metrics(self._parse(datagrams))
 
     def container_host(self):
         uname = platform.uname().release.lower()
@@ -124,3 +342,367 @@ class StatsdService(YellowService):
             else:
                 return proc.stdout.decode("utf-8").strip()
         return docker_host_name
+
+
+class StatsdService(StatsdServiceBase, YellowService):
+    sock: socket
+
+    def __init__(  # noqa: PLR0913
+        self,
+        port: int = 0,
+        buffer_size: Optional[int] = None,
+        polling_time: Optional[float] = None,
+        host="0.0.0.0",
+        *,
+        batch_size: int = 64,
+        workers: int = 1,
+        parse_processes: int = 0,
+        parse_cache_size: Optional[int] = None,
+        receive_buffer_size: Optional[int] = None,
+        auto_buffer_size: Optional[bool] = None,
+        callback_dispatcher: Optional[CallbackDispatcher] = None,
+        socket_path: Optional[str] = None,
+    ):
+        """
+        Args:
+            port: the port to listen on, 0 to choose a free port.
+            buffer_size: the maximum size of a single datagram, larger datagrams are truncated. Defaults to
+                DEFAULT_BUFFER_SIZE, or UDS_BUFFER_SIZE when listening on a unix socket.
+            polling_time: deprecated, has no effect.
+            host: the hostname to bind to.
+            batch_size: the maximum number of datagrams drained from the socket in a single wakeup.
+            workers: the number of listener threads, each with its own socket bound to the same port with
+                SO_REUSEPORT. The kernel distributes datagrams between the sockets by their sender.
+            parse_processes: if positive, datagrams are parsed in a pool of this many worker processes instead of in
+                the listener threads.
+            parse_cache_size: if set, the maximum number of distinct metric lines to keep parsed in an LRU cache.
+            receive_buffer_size: if set, the SO_RCVBUF of the sockets, the size of the kernel's queue of datagrams that
+                were not yet received. The size the kernel actually granted is stored in receive_buffer_size_granted
+                when the service starts. On linux, this is the size as reported by the kernel, which is double the
+                requested size (capped at net.core.rmem_max) to account for its overhead.
+            auto_buffer_size: if true, the size of every datagram is peeked before it is received, and the buffers grow
+                to fit larger datagrams instead of truncating them. This costs an extra system call per datagram, and
+                is only supported on linux. Defaults to true when listening on a unix socket on linux.
+            callback_dispatcher: if set, metric and datagram callbacks are queued to the dispatcher (such as a
+                ThreadCallbackDispatcher) instead of being called by the listener, so that slow callbacks don't stall
+                it. The dispatcher is started and stopped along with the service.
+            socket_path: if set, listen on a unix datagram socket bound to this path (as dogstatsd clients do with
+                socket_path) instead of on host and port. Senders block when the socket's queue is full, rather than
+                having their datagrams dropped. The socket is removed when the service stops.
+        """
+        super().__init__(port, host, parse_cache_size, callback_dispatcher)
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if workers > 1 and SO_REUSEPORT is None:
+            raise ValueError("multiple workers require SO_REUSEPORT, which is not supported on this platform")
+        if parse_processes > 0 and parse_cache_size:
+            raise ValueError("a parse cache cannot be shared with parse processes")
+        if socket_path is not None:
+            if AF_UNIX is None:
+                raise ValueError("unix sockets are not supported on this platform")
+            if workers > 1:
+                raise ValueError("multiple workers are not supported with a unix socket")
+        if buffer_size is None:
+            buffer_size = DEFAULT_BUFFER_SIZE if socket_path is None else UDS_BUFFER_SIZE
+        if auto_buffer_size is None:
+            auto_buffer_size = socket_path is not None and SUPPORTS_AUTO_BUFFER_SIZE
+        if auto_buffer_size and not SUPPORTS_AUTO_BUFFER_SIZE:
+            raise ValueError("auto_buffer_size is only supported on linux")
+        if polling_time is not None:
+            warn(
+                "polling_time is deprecated and has no effect, the listener is woken up by events",
+                DeprecationWarning,
+                stacklevel=2,
+            )
+        self.buffer_size = buffer_size
+        self.polling_time = polling_time
+        self.batch_size = batch_size
+        self.workers = workers
+        self.parse_processes = parse_processes
+        self.receive_buffer_size = receive_buffer_size
+        self.receive_buffer_size_granted: Optional[int] = None
+        self.auto_buffer_size = auto_buffer_size
+        self.socket_path = socket_path
+
+        self.should_stop = False
+        self.socks: List[socket] = []
+        self._parse_executor: Optional[ProcessPoolExecutor] = None
+        if workers == 1:
+            self.listening_threads = [Thread(target=self._listen_loop, args=(0,), daemon=True, name="statsd-listener")]
+        else:
+            self.listening_threads = [
+                Thread(target=self._listen_loop, args=(i,), daemon=True, name=f"statsd-listener-{i}")
+                for i in range(workers)
+            ]
+        self.listening_thread = self.listening_threads[0]
+
+    @classmethod
+    def for_rate(
+        cls,
+        datagrams_per_second: float,
+        datagram_size: int = 1432,
+        burst_seconds: float = 0.5,
+        **kwargs: Any,
+    ) -> StatsdService:
+        """
+        Create a service sized to ingest a target rate of datagrams without drops:
+        * the kernel's receive buffer can hold burst_seconds worth of datagrams, so that the listener can be stalled
+            (by the GIL, a slow callback, or a garbage collection) for that long.
+        * every wakeup of the listener drains up to a millisecond worth of datagrams, between 64 and 1024.
+        * the datagram buffers fit datagram_size (by default, the largest datagram that is not fragmented on a typical
+            network), and on linux, grow automatically to fit larger datagrams.
+        The kernel caps the receive buffer at net.core.rmem_max, a warning is issued on start if the buffer was capped.
+        Args:
+            datagrams_per_second: the expected peak rate of datagrams.
+            datagram_size: the expected maximum size of a datagram.
+            burst_seconds: the longest stall of the listener that should not cause drops.
+            **kwargs: forwarded to the constructor, and take precedence over the computed sizes.
+        """
+        sizes: Dict[str, Any] = {
+            "receive_buffer_size": ceil(datagrams_per_second * burst_seconds * (datagram_size + DATAGRAM_OVERHEAD)),
+            "batch_size": min(max(ceil(datagrams_per_second / 1000), 64), 1024),
+            "buffer_size": datagram_size,
+            "auto_buffer_size": SUPPORTS_AUTO_BUFFER_SIZE,
+        }
+        sizes.update(kwargs)
+        return cls(**sizes)
+
+    def _bind_socket(self) -> socket:
+        sock = socket(AF_INET if self.socket_path is None else AF_UNIX, SOCK_DGRAM)
+        sock.setblocking(False)
+        if self.workers > 1:
+            sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.receive_buffer_size is not None:
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, self.receive_buffer_size)
+        if SO_RXQ_OVFL is not None:
+            # if the option is not supported, kernel drops are not reported
+            with suppress(OSError):
+                sock.setsockopt(SOL_SOCKET, SO_RXQ_OVFL, 1)
+        if self.socket_path is None:
+            sock.bind((self.host, self.port))
+            return sock
+        # a socket left over by a service that was not stopped
+        with suppress(FileNotFoundError):
+            if stat.S_ISSOCK(lstat(self.socket_path).st_mode):
+                unlink(self.socket_path)
+        sock.bind(self.socket_path)
+        # like the datadog agent's socket, anyone may send to it, including containers that run as other users
+        chmod(self.socket_path, 0o722)  # noqa: S103
+        return sock
+
+    def start(self):
+        self.sock = self._bind_socket()
+        if self.port == 0 and self.socket_path is None:
+            self.port = self.sock.getsockname()[1]
+        self.socks = [self.sock, *(self._bind_socket() for _ in range(self.workers - 1))]
+        # linux caps the requested size at net.core.rmem_max before doubling it
+        self.receive_buffer_size_granted = self.sock.getsockopt(SOL_SOCKET, SO_RCVBUF)
+        if (
+            self.receive_buffer_size is not None
+            and self.receive_buffer_size_granted < self.receive_buffer_size * RECEIVE_BUFFER_FACTOR
+        ):
+            warn(
+                f"requested a receive buffer of {self.receive_buffer_size} bytes, but the kernel only granted"
+                f" {self.receive_buffer_size_granted} bytes (see net.core.rmem_max)",
+                RuntimeWarning,
+                stacklevel=2,
+            )
+        if self.parse_processes > 0:
+            # forking a process with running threads is unsafe, so the workers are spawned, and warmed up in advance
+            self._parse_executor = ProcessPoolExecutor(self.parse_processes, mp_context=get_context("spawn"))
+            self._parse_executor.submit(parse_datagrams, ()).result()
+        if self.callback_dispatcher is not None:
+            self.callback_dispatcher.start()
+        # writing to the wakeup pair interrupts the listeners' selects, so that stopping doesn't wait for a timeout
+        self._wakeup_reader, self._wakeup_writer = socketpair()
+        self._wakeup_reader.setblocking(False)
+        for thread in self.listening_threads:
+            thread.start()
+        return super().start()
+
+    def stop(self):
+        self.should_stop = True
+        self._wakeup_writer.send(b"\0")
+        for thread in self.listening_threads:
+            thread.join()
+        for sock in self.socks:
+            sock.close()
+        if self.socket_path is not None:
+            with suppress(FileNotFoundError):
+                unlink(self.socket_path)
+        if self.callback_dispatcher is not None:
+            # callbacks that were already queued are still called
+            self.callback_dispatcher.stop()
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    def is_alive(self):
+        return self.sock is not None
+
+    def _unix_socket_path(self) -> str:
+        if self.socket_path is None:
+            raise ValueError("the service is not listening on a unix socket")
+        return self.socket_path
+
+    def container_volumes(self, container_dir: str = UDS_CONTAINER_DIR) -> Dict[str, Dict[str, str]]:
+        """
+        The volumes that mount the unix socket's directory into a container at container_dir, in the format of docker's
+        containers.create. Only the socket's directory can be mounted, since a socket file that is mounted directly
+        is not replaced when the service binds a new socket.
+        """
+        return {dirname(abspath(self._unix_socket_path())): {"bind": container_dir, "mode": "rw"}}
+
+    def container_socket_path(self, container_dir: str = UDS_CONTAINER_DIR) -> str:
+        """
+        The path of the unix socket in a container that was created with container_volumes(container_dir), to send
+        metrics to (such as with the DD_DOGSTATSD_URL environment variable, as unix://<path>).
+        """
+        return f"{container_dir.rstrip('/')}/{basename(self._unix_socket_path())}"
+
+    @overload
+    def capture(
+        self,
+        mode: Literal["raw"] = "raw",
+        *,
+        tag: Optional[str] = None,
+        container_id: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        names: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        tags: Union[Iterable[str], Mapping[str, str], None] = None,
+    ) -> ContextManager[CapturedMetricsCollection]: ...
+
+    @overload
+    def capture(
+        self,
+        mode: Literal["aggregate"],
+        *,
+        tag: Optional[str] = None,
+        container_id: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        names: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        tags: Union[Iterable[str], Mapping[str, str], None] = None,
+    ) -> ContextManager[AggregatedMetricsCollection]: ...
+
+    @contextmanager
+    def capture(  # noqa: PLR0913
+        self,
+        mode: str = "raw",
+        *,
+        tag: Optional[str] = None,
+        container_id: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        names: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        tags: Union[Iterable[str], Mapping[str, str], None] = None,
+    ) -> Iterator[Any]:
+        """
+        Capture all the metrics received while in the context. Captures may overlap, across threads and tasks.
+        Args:
+            mode: "raw" to keep every metric in a CapturedMetricsCollection, or "aggregate" to only keep running
+                aggregates of the metrics in an AggregatedMetricsCollection, in memory that does not grow with the
+                number of metrics.
+            tag: if set, only capture metrics with this tag (such as "test_id:1234").
+            container_id: if set, only capture metrics with this container id.
+            name_prefix: if set, only capture metrics whose names start with this prefix.
+            Only one of tag, container_id, and name_prefix may be set, metrics are routed to the captures that match
+            them by a lookup, rather than by checking every capture.
+            names: if set, only capture metrics with these names (or the prefixes).
+            prefixes: if set, only capture metrics whose names start with one of these prefixes (or have the names).
+            types: if set, only capture metrics of these types (such as "c" or "ms").
+            tags: if set, only capture metrics that have all of these tags.
+            The filters are checked before metrics are captured, and when no capture (or callback) is interested in
+            a metric name, its lines are skipped by the parser without parsing their values and tags.
+        """
+        cap = self._push_capture(
+            mode, CaptureRoute(tag, container_id, name_prefix), CaptureFilter(names, prefixes, types, tags)
+        )
+        try:
+            with self._entered_capture(cap):
+                yield cap
+        finally:
+            self._pop_capture(cap)
+
+    def _parse(self, datagrams: Sequence[Union[bytes, memoryview]]) -> List[Metric]:
+        if self._parse_executor is None:
+            return super()._parse(datagrams)
+        start = perf_counter_ns()
+        raw_datagrams = [bytes(raw) for raw in datagrams]
+        metrics, failures = self._parse_executor.submit(
+            parse_datagrams_counted, raw_datagrams, None, self._name_filter()
+        ).result()
+        stats = self._thread_stats()
+        stats.latency("parse").record(perf_counter_ns() - start)
+        stats.parse_failures += failures
+        return metrics
+
+    def _recv_batch(self, sock: socket, buffers: List[memoryview], stats: ServiceStats) -> List[memoryview]:
+        """
+        Drain pending datagrams from the (non-blocking) socket into the preallocated buffers, until either the socket
+        has no more datagrams or all the buffers are filled.
+        Returns views of the received datagrams, valid until the next call.
+        """
+        ret = []
+        for i in range(len(buffers)):
+            try:
+                if self.auto_buffer_size:
+                    size = sock.recv_into(buffers[i], 1, MSG_PEEK | MSG_TRUNC)
+                    if size > len(buffers[i]):
+                        self._grow_buffers(buffers, size)
+                if HAS_RECVMSG:
+                    nbytes, ancdata, flags, _ = sock.recvmsg_into((buffers[i],), ANCILLARY_SIZE)
+                else:
+                    nbytes = sock.recv_into(buffers[i])
+                    ancdata, flags = [], 0
+            except (BlockingIOError, InterruptedError):
+                break
+            if flags & MSG_TRUNC:
+                stats.truncated_datagrams += 1
+            for level, kind, data in ancdata:
+                if level == SOL_SOCKET and kind == SO_RXQ_OVFL:
+                    # the total number of drops since the socket was created
+                    stats.kernel_drops = int.from_bytes(data[:4], sys.byteorder)
+            ret.append(buffers[i][:nbytes])
+        return ret
+
+    def _grow_buffers(self, buffers: List[memoryview], size: int) -> None:
+        # buffers grow to the next power of two, so that a slowly growing datagram doesn't reallocate every time
+        new_size = 1 << (size - 1).bit_length()
+        if self.socket_path is None:
+            new_size = min(new_size, MAX_DATAGRAM_SIZE)
+        # previously received views still refer to the old buffers, so they are replaced rather than resized
+        buffers[:] = [memoryview(bytearray(new_size)) for _ in buffers]
+        self.buffer_size = max(self.buffer_size, new_size)
+
+    def _listen_loop(self, worker_index: int) -> None:
+        sock = self.socks[worker_index]
+        # the buffer pool is allocated once, and reused for every batch
+        buffers = [memoryview(bytearray(self.buffer_size)) for _ in range(self.batch_size)]
+        stats = self._thread_stats()
+        with DefaultSelector() as selector:
+            selector.register(sock, EVENT_READ)
+            selector.register(self._wakeup_reader, EVENT_READ)
+            while not self.should_stop:
+                try:
+                    # no timeout, an idle listener sleeps until either a datagram or a wakeup arrives
+                    events = selector.select()
+                    if self.should_stop:
+                        break
+                    if not any(key.fileobj is sock for key, _ in events):
+                        continue
+                    start = perf_counter_ns()
+                    datagrams = self._recv_batch(sock, buffers, stats)
+                    stats.latency("recv").record(perf_counter_ns() - start)
+                except Exception:  # noqa: BLE001
+                    print("unexpected error when listening to statsd socket")  # noqa: T201
+                    print_exc()
+                    continue
+                self._handle_batch(datagrams)
@@ -0,0 +1,300 @@
+# the format is tied to the columns and index of CapturedMetrics, which are private to it
+# ruff: noqa: SLF001
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import sys
+from array import array
+from math import isnan, nan
+from struct import Struct
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar, Union
+
+from yellowbox_statsd.metrics import (
+    CapturedMetric,
+    CapturedMetrics,
+    CapturedMetricsCollection,
+    HistogramCapturedMetric,
+    MetricTags,
+)
+from yellowbox_statsd.sketches import DDSketch
+
+# a stored capture is the magic, the length of a JSON header, the header, and then the columns of every series. The
+# header holds the interned tag sets and container ids, and for every series its name, type and the spans of its
+# columns (relative to the end of the header).
+CAPTURE_MAGIC = b"YBSTATSD-CAPTURE\x01"
+HEADER_LENGTH = Struct("<Q")
+FORMAT_VERSION = 1
+# stored in place of a missing metric timestamp
+NO_TIMESTAMP = -(2**63)
+
+PathLike = Union[str, "os.PathLike[str]"]
+Span = Tuple[int, int]
+Collection = TypeVar("Collection", bound=CapturedMetricsCollection)
+
+
+class _ColumnWriter:
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+    def add(self, data: bytes) -> Span:
+        start = self.size
+        self.chunks.append(data)
+        self.size += len(data)
+        return start, self.size
+
+    def add_column(self, column: array, trivial: bool = False) -> Optional[Span]:
+        # columns that only hold their default values are not stored
+        return None if trivial else self.add(column.tobytes())
+
+
+def _series_header(
+    series: CapturedMetrics,
+    writer: _ColumnWriter,
+    tag_set_ids: Dict[MetricTags, int],
+    container_ids: Dict[str, int],
+) -> Dict[str, Any]:
+    tag_ids = array("i")
+    timestamps = array("q")
+    containers = array("i")
+    sample_rates = array("d")
+    has_sample_rates = False
+    values: List[str] = []
+    for metric in series:
+        tag_ids.append(-1 if metric.tags is None else tag_set_ids.setdefault(metric.tags, len(tag_set_ids)))
+        timestamps.append(NO_TIMESTAMP if metric.metric_timestamp is None else metric.metric_timestamp)
+        containers.append(
+            -1 if metric.container_id is None else container_ids.setdefault(metric.container_id, len(container_ids))
+        )
+        if metric.sample_rate is None:
+            sample_rates.append(nan)
+        else:
+            sample_rates.append(metric.sample_rate)
+            has_sample_rates = True
+        values.extend(metric.values)
+    # the positions of each tag set are stored consecutively, in the order of the index
+    index = []
+    positions = array("q")
+    for tag_set, tag_set_positions in series._positions_by_tags.items():
+        index.append((-1 if tag_set is None else tag_set_ids[tag_set], len(tag_set_positions)))
+        positions.extend(tag_set_positions)
+    value_columns = dict(zip(("values", "value_sample_rates", "relative"), series._value_columns()))
+    value_sample_rates = value_columns["value_sample_rates"]
+    columns = {
+        # values can't contain newlines, since datagrams are split by them
+        "raw_values": writer.add("\n".join(values).encode("utf-8")),
+        "received": writer.add_column(series._received),
+        "sample_rates": writer.add_column(sample_rates, trivial=not has_sample_rates),
+        "tag_ids": writer.add_column(tag_ids),
+        "timestamps": writer.add_column(timestamps, trivial=timestamps.count(NO_TIMESTAMP) == len(timestamps)),
+        "container_ids": writer.add_column(containers, trivial=containers.count(-1) == len(containers)),
+        "positions": writer.add_column(positions),
+        "offsets": writer.add_column(series._offsets, trivial=not series._multi_valued),
+        "values": writer.add_column(value_columns["values"]),
+        "value_sample_rates": writer.add_column(
+            value_sample_rates, trivial=value_sample_rates.count(1.0) == len(value_sample_rates)
+        ),
+    }
+    if "relative" in value_columns:
+        columns["relative"] = writer.add_column(value_columns["relative"])
+    ret: Dict[str, Any] = {
+        "metrics": len(series._offsets),
+        "values": len(series._values),
+        "invalid_value": series._invalid_value,
+        "multi_valued": series._multi_valued,
+        "index": index,
+        "columns": columns,
+    }
+    if isinstance(series, HistogramCapturedMetric):
+        ret["sketches"] = [
+            (-1 if tag_set is None else tag_set_ids[tag_set], sketch.to_dict())
+            for tag_set, sketch in series._sketches.items()
+        ]
+    return ret
+
+
+def save_capture(collection: CapturedMetricsCollection, path: PathLike) -> None:
+    """
+    Write a capture to a file, in a columnar format that can be loaded with load_capture.
+    """
+    writer = _ColumnWriter()
+    tag_set_ids: Dict[MetricTags, int] = {}
+    container_ids: Dict[str, int] = {}
+    with collection._condition:
+        # no metrics can be captured while the capture is being written
+        series = [
+            {"name": name, "type": metric_type, **_series_header(captured, writer, tag_set_ids, container_ids)}
+            for (name, metric_type), captured in collection.items()
+        ]
+    header = json.dumps(
+        {
+            "version": FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "tag_sets": [sorted(tag_set) for tag_set in tag_set_ids],
+            "container_ids": list(container_ids),
+            "series": series,
+        },
+        separators=(",", ":"),
+    ).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(CAPTURE_MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        f.writelines(writer.chunks)
+
+
+class _StoredColumns:
+    """
+    The columns of a stored capture, read from a memory-mapped file.
+    """
+
+    def __init__(self, mapped: mmap.mmap, start: int, swap: bool):
+        self.mapped = mapped
+        self.start = start
+        self.swap = swap
+        # the number of series whose metrics were not materialized yet, the mapping is closed once all of them were
+        self.pending = 0
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            self.pending += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self.pending -= 1
+            if not self.pending:
+                self.mapped.close()
+
+    def read(self, typecode: str, span: Optional[Span], length: int = 0, default: Any = None) -> array:
+        """
+        Read a column, or if it was not stored, a column of length default values.
+        """
+        if span is None:
+            return array(typecode, (default,)) * length
+        ret = array(typecode)
+        with memoryview(self.mapped) as view:
+            ret.frombytes(view[self.start + span[0] : self.start + span[1]])
+        if self.swap:
+            ret.byteswap()
+        return ret
+
+    def read_str(self, span: Span) -> str:
+        return str(self.mapped[self.start + span[0] : self.start + span[1]], "utf-8")
+
+
+def _offsets(columns: _StoredColumns, header: Dict[str, Any]) -> array:
+    if header["columns"]["offsets"] is None:
+        # every metric has a single value
+        return array("q", range(header["metrics"]))
+    return columns.read("q", header["columns"]["offsets"])
+
+
+def _metrics_loader(
+    columns: _StoredColumns,
+    header: Dict[str, Any],
+    tag_sets: List[Optional[MetricTags]],
+    container_ids: List[Optional[str]],
+) -> Callable[[], List[CapturedMetric]]:
+    def load() -> List[CapturedMetric]:
+        try:
+            return _load_metrics(columns, header, tag_sets, container_ids)
+        finally:
+            columns.release()
+
+    columns.acquire()
+    return load
+
+
+def _load_metrics(
+    columns: _StoredColumns,
+    header: Dict[str, Any],
+    tag_sets: List[Optional[MetricTags]],
+    container_ids: List[Optional[str]],
+) -> List[CapturedMetric]:
+    spans = header["columns"]
+    n = header["metrics"]
+    values = columns.read_str(spans["raw_values"]).split("\n") if header["values"] else []
+    offsets = _offsets(columns, header)
+    ends = [*offsets[1:], header["values"]]
+    return [
+        CapturedMetric(
+            values[start:end],
+            None if isnan(sample_rate) else sample_rate,
+            tag_sets[tag_id],
+            None if timestamp == NO_TIMESTAMP else timestamp,
+            container_ids[container_id],
+        )
+        for start, end, sample_rate, tag_id, timestamp, container_id in zip(
+            offsets,
+            ends,
+            columns.read("d", spans["sample_rates"], n, nan),
+            columns.read("i", spans["tag_ids"]),
+            columns.read("q", spans["timestamps"], n, NO_TIMESTAMP),
+            columns.read("i", spans["container_ids"], n, -1),
+        )
+    ]
+
+
+def _load_series(
+    series: CapturedMetrics,
+    columns: _StoredColumns,
+    header: Dict[str, Any],
+    tag_sets: List[Optional[MetricTags]],
+    container_ids: List[Optional[str]],
+) -> None:
+    spans = header["columns"]
+    value_columns = {"values": ("d", None), "value_sample_rates": ("d", 1.0), "relative": ("b", None)}
+    for (name, (typecode, default)), column in zip(value_columns.items(), series._value_columns()):
+        column.extend(columns.read(typecode, spans[name], header["values"], default))
+    series._offsets = _offsets(columns, header)
+    series._received = columns.read("d", spans["received"])
+    series._invalid_value = header["invalid_value"]
+    series._multi_valued = header["multi_valued"]
+    positions = columns.read("q", spans["positions"]).tolist()
+    start = 0
+    for tag_id, count in header["index"]:
+        series._add_tag_set(tag_sets[tag_id], positions[start : start + count])
+        start += count
+    series._indexed = header["metrics"]
+    if isinstance(series, HistogramCapturedMetric):
+        series._sketches = {tag_sets[tag_id]: DDSketch.from_dict(sketch) for tag_id, sketch in header["sketches"]}
+    series._aggregate_columns()
+    # the metrics themselves are only materialized when the list is read
+    series._loader = _metrics_loader(columns, header, tag_sets, container_ids)
+
+
+def load_capture(path: PathLike, collection_cls: Type[Collection] = CapturedMetricsCollection) -> Collection:  # type: ignore[assignment]
+    """
+    Load a capture that was written with save_capture. The file is memory-mapped, and only the header and the numeric
+    columns are read eagerly, so that aggregations and tag queries don't need the metrics themselves. The metrics of
+    every name and type are only materialized as CapturedMetric objects when they are first accessed.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a stored capture")
+        # the mapping remains valid after the file is closed, and is closed once the metrics of all the series are
+        # materialized (or when it is garbage collected, if some series are discarded before they are materialized)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_start = len(CAPTURE_MAGIC) + HEADER_LENGTH.size
+    (header_length,) = HEADER_LENGTH.unpack_from(mapped, len(CAPTURE_MAGIC))
+    header = json.loads(mapped[header_start : header_start + header_length])
+    if header["version"] != FORMAT_VERSION:
+        raise ValueError(f"unsupported capture format version {header['version']}")
+    columns = _StoredColumns(mapped, header_start + header_length, header["byteorder"] != sys.byteorder)
+    # id -1 stands for no tags, or no container id
+    tag_sets: List[Optional[MetricTags]] = [MetricTags.interned(tag_set) for tag_set in header["tag_sets"]]
+    tag_sets.append(None)
+    container_ids: List[Optional[str]] = [*header["container_ids"], None]
+    ret = collection_cls()
+    for series_header in header["series"]:
+        series = ret._new_capture(series_header["type"])
+        _load_series(series, columns, series_header, tag_sets, container_ids)
+        ret[series_header["name"], series_header["type"]] = series
+    ret._metrics_count = sum(len(series) for series in ret.values())
+    if not columns.pending:
+        mapped.close()
+    return ret